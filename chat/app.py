@@ -2,11 +2,20 @@ from flask import Flask, request, jsonify, render_template
 from flask_cors import CORS
 import requests
 from chatbot import NorwegianImmigrationAssistant
-import re
+from config import ERROR_ROADMAP, sessions
+from citations import format_citations
+import os
+
+RAG_URL = os.environ.get('RAG_URL', 'http://localhost:8888')
+# (connect, read) timeouts; the read timeout covers the whole LLM generation
+RAG_TIMEOUT = (5, float(os.environ.get('RAG_TIMEOUT', 60.0)))
 
 app = Flask(__name__)
 CORS(app)
 
+# Keep-alive connections to the RAG server, shared by all requests
+rag_session = requests.Session()
+
 # Initialize immigration assistant
 assistant = NorwegianImmigrationAssistant()
 
@@ -22,73 +31,11 @@ def add_header(response):
 def home():
     return render_template('index.html')
 
-def format_response_with_sources(response_text, docs):
-    # Split into sentences (looking for [DOC: pattern)
-    parts = re.split(r'(\[DOC:[^\]]+\])', response_text)
-    formatted_text = ""
-    
-    # Track unique content/URL combinations
-    seen_content = {}  # (content, url) -> first doc_id mapping
-    unique_doc_ids = []  # preserve order of first appearance
-    doc_id_mapping = {}  # mapping to find first doc_id for deduplication
-    
-    # First pass: collect unique docs by content and URL
-    for i in range(0, len(parts)-1, 2):
-        doc_refs = parts[i+1] if i+1 < len(parts) else ""
-        doc_ids = re.findall(r'DOC:\d+', doc_refs)
-        for doc_id in doc_ids:
-            if doc_id in docs:
-                doc = docs[doc_id]
-                content = doc.get('content', '').strip()
-                url = doc.get('url', '').strip()
-                content_key = (content, url)
-                
-                if content_key not in seen_content:
-                    seen_content[content_key] = doc_id
-                    unique_doc_ids.append(doc_id)
-                doc_id_mapping[doc_id] = seen_content[content_key]
-    
-    # Create citation mapping (DOC:X -> sequential number)
-    citation_map = {doc_id: idx + 1 for idx, doc_id in enumerate(unique_doc_ids)}
-    
-    # Second pass: format text with sequential citations
-    for i in range(0, len(parts)-1, 2):
-        sentence = parts[i].strip()
-        doc_refs = parts[i+1] if i+1 < len(parts) else ""
-        
-        # Get doc numbers and map to deduplicated citations
-        doc_ids = list(dict.fromkeys(re.findall(r'DOC:\d+', doc_refs)))
-        citations = set()  # use set to remove duplicates within the same citation block
-        
-        for doc_id in doc_ids:
-            if doc_id in docs:
-                # Use the first doc_id that had this content/URL combination
-                deduplicated_doc_id = doc_id_mapping.get(doc_id)
-                if deduplicated_doc_id in citation_map:
-                    citations.add(str(citation_map[deduplicated_doc_id]))
-        
-        if citations:
-            formatted_text += sentence + f" [{','.join(sorted(citations))}] "
-        else:
-            formatted_text += sentence + " "
-    
-    # Add any remaining text without sources
-    if len(parts) % 2 == 1:
-        formatted_text += parts[-1].strip()
-    
-    # Create final sources dict with sequential citation numbers
-    final_sources = {}
-    for doc_id in unique_doc_ids:
-        citation_num = citation_map[doc_id]
-        final_sources[f"DOC:{citation_num-1}"] = docs[doc_id]
-    
-    return formatted_text.strip(), final_sources
-
 @app.route('/api/translate', methods=['POST'])
 def translate():
     try:
         data = request.json
-        response = requests.post('http://localhost:8888/translate', json=data)
+        response = rag_session.post(f'{RAG_URL}/translate', json=data, timeout=RAG_TIMEOUT)
         return jsonify(response.json()), response.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -98,11 +45,14 @@ def translate():
 def chat():
     try:
         message = request.json.get('message', '')
+        session_id = request.json.get('sessionId')
 
         # Query the endpoint directly
-        response = requests.post(
-            'http://localhost:8888/query/',
-            json={'query': message, 'k': 10, 'rerank': True}
+        response = rag_session.post(
+            f'{RAG_URL}/query',
+            json={'query': message, 'k': 10, 'rerank': True, 'history': sessions.context(session_id),
+                  'session_id': session_id},
+            timeout=RAG_TIMEOUT
         )
         
         if response.status_code == 200:
@@ -110,7 +60,10 @@ def chat():
             # Make sure we have the expected fields
             if 'response' in data:
                 # Format the response to remove [DOC:X] references and collect sources
-                formatted_response, sources = format_response_with_sources(data['response'], data.get('docs', {}))
+                formatted_response, sources = format_citations(data['response'], data.get('docs', {}))
+                if session_id:
+                    sessions.append(session_id, 'user', message)
+                    sessions.append(session_id, 'assistant', formatted_response)
                 return jsonify({
                     'success': True,
                     'response': formatted_response,
@@ -134,23 +87,40 @@ def chat():
             'error': str(e)
         }), 500
 
+@app.route('/api/chat/prefetch', methods=['POST'])
+def chat_prefetch():
+    """Start retrieval for the message being typed, reused by /api/chat when it is sent"""
+    try:
+        message = request.json.get('message', '')
+        session_id = request.json.get('sessionId')
+        if not message.strip() or not session_id:
+            return jsonify({'success': False})
+        response = rag_session.post(
+            f'{RAG_URL}/prefetch',
+            json={'query': message, 'k': 10, 'rerank': True, 'history': sessions.context(session_id),
+                  'session_id': session_id},
+            timeout=RAG_TIMEOUT
+        )
+        return jsonify({'success': response.status_code == 200})
+    except Exception as e:
+        print(f"Error in prefetch endpoint: {str(e)}")
+        return jsonify({'success': False}), 500
+
 @app.route('/api/get-actions', methods=['POST'])
 def get_actions():
     try:
         data = request.get_json()
         message = data.get('message', '')
         
-        # Create a new chatbot instance
-        chatbot = NorwegianImmigrationAssistant()
+        # Chatbot for this browser session, sharing its conversation with /api/chat
+        chatbot = NorwegianImmigrationAssistant(session_id=data.get('sessionId'), store=sessions,
+                                                http=rag_session, timeout=RAG_TIMEOUT)
         
-        # Add user message and get response
+        # Add user message and get response and roadmap from one retrieval
         chatbot.add_message("user", message)
-        chat_response = chatbot.get_response()
+        chat_response, roadmap = chatbot.get_response_and_roadmap()
         chatbot.add_message("assistant", chat_response)
         
-        # Generate roadmap based on conversation
-        roadmap = chatbot.generate_roadmap()
-        
         # Return both chat response and roadmap
         return jsonify({
             'response': chat_response,
@@ -162,19 +132,7 @@ def get_actions():
         return jsonify({
             'error': 'Failed to process request',
             'response': 'I apologize, but I encountered an error. Please try again.',
-            'roadmap': """IMMEDIATE ACTIONS:
-1. Contact Forbrukerrådet (Norwegian Consumer Authority)
-   - Call 23 400 500 for urgent guidance
-   - Opening hours: Mon-Fri, 9:00-15:00
-
-REQUIRED DOCUMENTS:
-• Lease Agreement
-• Any communication with landlord
-
-HELPFUL RESOURCES:
-• Forbrukerrådet
-  Website: forbrukerradet.no/housing
-  Phone: 23 400 500"""
+            'roadmap': ERROR_ROADMAP
         }), 500
 
 @app.route('/api/mark-substep-done', methods=['POST'])
@@ -197,19 +155,15 @@ def mark_substep_done():
 def get_source():
     try:
         data = request.get_json()
-        doc_ids = data.get('docIds', [])
+        # Chunk ids come with each source in a chat response
+        chunk_ids = data.get('chunkIds', [])
 
-        # Get response data from the query endpoint
-        response = requests.post(
-            'http://localhost:8888/query/',
-            json={'query': ' '.join(doc_ids)}  # Use doc IDs as query to get their content
-        )
+        response = rag_session.post(f'{RAG_URL}/chunks', json={'ids': chunk_ids}, timeout=RAG_TIMEOUT)
 
         if response.status_code == 200:
-            query_data = response.json()
             return jsonify({
                 'success': True,
-                'sources': query_data.get('docs', {})
+                'sources': response.json().get('chunks', {})
             })
         else:
             return jsonify({
@@ -1,134 +1,129 @@
 import os
 import json
+import uuid
 import requests
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from pydantic import BaseModel
+from sessions import SessionStore
+from config import NO_SOURCES_ROADMAP
 
 class QueryRequest(BaseModel):
     query: str
     k: int = 10
     rerank: bool = False
+    include_sources: bool = False
+    history: str = ""
+
+def build_roadmap(docs: Dict[str, Dict[str, Any]]) -> str:
+    """Build a roadmap from retrieved docs (tag -> {url, content, roadmap}).
+
+    roadmap holds the facets the RAG server tagged each chunk with at ingest time
+    (action, document, deadline and resource sentences, contact details), so this is
+    a lookup rather than a scan of every chunk's text.
+    """
+    sections: Dict[str, Dict[str, None]] = {
+        "IMMEDIATE ACTIONS": {},
+        "REQUIRED DOCUMENTS": {},
+        "HELPFUL RESOURCES": {},
+        "IMPORTANT DEADLINES": {}
+    }
+
+    for doc in docs.values():
+        facets = doc.get("roadmap") or {}
+        for sentence in facets.get("action", []):
+            sections["IMMEDIATE ACTIONS"][f"- {sentence}"] = None
+        for sentence in facets.get("document", []):
+            sections["REQUIRED DOCUMENTS"][f"• {sentence}"] = None
+        sections["HELPFUL RESOURCES"][f"• {doc['url'].replace('https://', '')}"] = None
+        for item in facets.get("resource", []) + facets.get("contact", []):
+            sections["HELPFUL RESOURCES"][f"• {item}"] = None
+        for sentence in facets.get("deadline", []):
+            sections["IMPORTANT DEADLINES"][f"• {sentence}"] = None
+
+    # Format the roadmap text
+    roadmap = []
+    for section, items in sections.items():
+        if items:
+            roadmap.append(f"\n{section}:")
+            roadmap.extend(items)
+
+    return "\n".join(roadmap)
 
 class NorwegianImmigrationAssistant:
-    def __init__(self):
+    def __init__(self, session_id: Optional[str] = None, store: Optional[SessionStore] = None,
+                 http: Optional[requests.Session] = None, timeout: Tuple[float, float] = (5, 60.0)):
         """Initialize the Norwegian Immigration Assistant."""
-        self.conversation_history = []
-        self.query_url = "http://localhost:8888/query"
-        
+        self.session_id = session_id or uuid.uuid4().hex
+        self.sessions = store or SessionStore()
+        self.query_url = f"{os.environ.get('RAG_URL', 'http://localhost:8888')}/query"
+        # Keep-alive connections to the RAG server (the app passes its shared session),
+        # and (connect, read) timeouts, the read timeout covering the whole LLM generation
+        self.http = http or requests.Session()
+        self.timeout = timeout
+        # Sources retrieved for the latest answer, which the roadmap is built from
+        self.last_sources: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def conversation_history(self) -> List[Dict[str, str]]:
+        """Recent turns of this session; older ones are summarised by the session store."""
+        return self.sessions.turns(self.session_id)
+
     def add_message(self, role: str, content: str) -> None:
         """Add a message to the conversation history."""
-        self.conversation_history.append({
-            "role": role,
-            "content": content
-        })
+        self.sessions.append(self.session_id, role, content)
+
+    def history_context(self) -> str:
+        """Compact context of the turns before the latest message."""
+        return self.sessions.context(self.session_id, skip_last=True)
+
+    def _query(self) -> Dict[str, Any]:
+        """Query the RAG server with the latest user message, keeping the retrieved sources."""
+        self.last_sources = {}
+        response = self.http.post(
+            self.query_url,
+            json=QueryRequest(
+                query=self.conversation_history[-1]["content"],
+                k=10,
+                rerank=True,
+                include_sources=True,
+                history=self.history_context()
+            ).dict(),
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        data = response.json()
+        self.last_sources = data.get("sources", {})
+        return data
 
     def get_response(self) -> str:
         """Get a response based on the latest user message."""
         if not self.conversation_history:
             return "Hello! How can I help you with immigration to Norway?"
 
-        # Get the last user message
-        last_message = self.conversation_history[-1]["content"]
-        
         try:
-            # Query the local endpoint with just the last message
-            response = requests.post(
-                self.query_url,
-                json=QueryRequest(
-                    query=last_message,
-                    k=10,
-                    rerank=True
-                ).dict()
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data["success"]:
-                    return data["response"]
-                else:
-                    return "I apologize, but I couldn't process your request. Please try again."
-            else:
-                return "I encountered an error processing your request. Please try again."
-                
+            data = self._query()
+        except requests.HTTPError:
+            return "I encountered an error processing your request. Please try again."
         except Exception as e:
             print(f"Error getting response: {str(e)}")
             return "I apologize, but I'm having trouble connecting to my knowledge base. Please try again in a moment."
 
+        if data["success"]:
+            return data["response"]
+        return "I apologize, but I couldn't process your request. Please try again."
+
     def generate_roadmap(self) -> str:
-        """Generate a roadmap based on the conversation history."""
+        """Roadmap for the sources retrieved with the latest response, without another query."""
         if not self.conversation_history:
             return "Please start a conversation first so I can provide relevant guidance."
+        return build_roadmap(self.last_sources) or NO_SOURCES_ROADMAP
 
-        # Get the last user message
-        last_message = self.conversation_history[-1]["content"]
-        
-        try:
-            # Query the local endpoint for roadmap information with just the last query
-            response = requests.post(
-                self.query_url,
-                json=QueryRequest(
-                    query=f"What are the specific steps and requirements for: {last_message}",
-                    k=10,
-                    rerank=True
-                ).dict()
-            )
-            
-            if response.status_code != 200:
-                raise Exception("Failed to get roadmap information")
-                
-            data = response.json()
-            if not data["success"]:
-                raise Exception("Query was not successful")
-                
-            # Extract relevant information from docs
-            docs = data["docs"]
-            
-            # Format the roadmap sections
-            sections = {
-                "IMMEDIATE ACTIONS": [],
-                "REQUIRED DOCUMENTS": [],
-                "HELPFUL RESOURCES": [],
-                "IMPORTANT DEADLINES": []
-            }
-            
-            # Process each document
-            for doc in docs.values():
-                content = doc["content"]
-                url = doc["url"]
-                
-                # Look for actions
-                if any(word in content.lower() for word in ["must", "need to", "should", "can", "have to"]):
-                    sections["IMMEDIATE ACTIONS"].append(f"- {content}")
-                
-                # Look for documents
-                if any(word in content.lower() for word in ["document", "form", "card", "id", "passport"]):
-                    sections["REQUIRED DOCUMENTS"].append(f"• {content}")
-                
-                # Add resource
-                sections["HELPFUL RESOURCES"].append(f"• {url.replace('https://', '')}")
-                
-                # Look for deadlines
-                if any(word in content.lower() for word in ["deadline", "within", "by", "before", "after"]):
-                    sections["IMPORTANT DEADLINES"].append(f"• {content}")
-            
-            # Format the roadmap text
-            roadmap = []
-            for section, items in sections.items():
-                if items:
-                    roadmap.append(f"\n{section}:")
-                    roadmap.extend(items)
-            
-            return "\n".join(roadmap)
-                
-        except Exception as e:
-            print(f"Error generating roadmap: {str(e)}")
-            return """IMMEDIATE ACTIONS:
-• Contact appropriate authorities for guidance
-• Review official documentation requirements
-
-HELPFUL RESOURCES:
-• udi.no/en
-• norway.no/en"""
+    def get_response_and_roadmap(self) -> Tuple[str, str]:
+        """Get a response and a roadmap for the latest user message from a single RAG query."""
+        # The roadmap uses every source retrieved for the response, not only the ones it cites,
+        # and falls back to NO_SOURCES_ROADMAP when none of them has roadmap facets
+        response = self.get_response()
+        return response, self.generate_roadmap()
 
 def main():
     """Main function to run the chatbot."""
@@ -146,13 +141,12 @@ def main():
                 
             # Add user message and get response
             chatbot.add_message("user", user_input)
-            response = chatbot.get_response()
+            response, roadmap = chatbot.get_response_and_roadmap()
             chatbot.add_message("assistant", response)
             
             # Print response
             print("\nAssistant:", response)
             
-            roadmap = chatbot.generate_roadmap()
             print("\nRoadmap:")
             print(roadmap)
 
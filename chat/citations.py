@@ -0,0 +1,117 @@
+import re
+from typing import Dict, Tuple
+
+_MARKER_PREFIX = '[DOC:'
+# Longer bracketed text is passed through instead of being held back as a marker
+_MAX_MARKER_LENGTH = 64
+# A whole citation marker, e.g. [DOC:3] or [DOC:1, DOC:4], no longer than a streamed one can be
+_MARKER_RE = re.compile(r'\[DOC:[^\[\]]{0,%d}\]' % (_MAX_MARKER_LENGTH - len(_MARKER_PREFIX) - 1))
+_DOC_ID_RE = re.compile(r'DOC:\d+')
+
+
+class CitationFormatter:
+    """Rewrite [DOC:n] markers to sequential citations in a single pass.
+
+    Sources are deduplicated by (content, url) and numbered in order of first
+    citation; markers citing no known doc are dropped. Text can be fed all at once
+    or chunk by chunk as tokens arrive, only a possible partial marker is held back.
+    """
+
+    def __init__(self, docs: Dict[str, Dict[str, str]]):
+        self.docs = docs
+        self.sources = {}  # DOC:{n-1} -> doc, for citation [n]
+        self._citations = {}  # (content, url) -> citation number
+        self._pending = ''  # possible start of a marker
+        self._whitespace = ''  # trailing whitespace, dropped if a marker follows
+        self._started = False
+        self._after_marker = False
+        self._drop_leading = False  # a dropped marker already has whitespace before it
+
+    def feed(self, text: str) -> str:
+        """Format the next piece of the response, returning the text that is final."""
+        out = []
+        buffer = self._pending + text
+        self._pending = ''
+        i = 0
+        while i < len(buffer):
+            j = buffer.find('[', i)
+            if j == -1:
+                self._text(buffer[i:], out)
+                break
+            self._text(buffer[i:j], out)
+            match = _MARKER_RE.match(buffer, j)
+            if match:
+                self._marker(match.group(), out)
+                i = match.end()
+            elif self._could_be_marker(buffer[j:]):
+                self._pending = buffer[j:]
+                break
+            else:
+                self._text('[', out)
+                i = j + 1
+        return ''.join(out)
+
+    def close(self) -> str:
+        """Flush what is left at the end of the response."""
+        out = []
+        pending, self._pending = self._pending, ''
+        self._text(pending, out)
+        self._whitespace = ''
+        return ''.join(out)
+
+    def _could_be_marker(self, rest: str) -> bool:
+        if len(rest) >= _MAX_MARKER_LENGTH:
+            return False
+        if len(rest) <= len(_MARKER_PREFIX):
+            return _MARKER_PREFIX.startswith(rest)
+        return rest.startswith(_MARKER_PREFIX) and ']' not in rest and '[' not in rest[1:]
+
+    def _text(self, text: str, out: list) -> None:
+        if self._drop_leading:
+            text = text.lstrip()
+            if text:
+                self._drop_leading = False
+        if not text:
+            return
+        text = self._whitespace + text
+        body = text.strip()
+        if not body:
+            self._whitespace = text
+            return
+        start = len(text) - len(text.lstrip())
+        leading = text[:start]
+        self._whitespace = text[start + len(body):]
+        if not self._started:
+            leading = ''
+        elif self._after_marker:
+            # Keep paragraph breaks after a citation, otherwise separate it with one space
+            leading = leading if '\n' in leading else ' '
+        out.append(leading + body)
+        self._started = True
+        self._after_marker = False
+
+    def _marker(self, marker: str, out: list) -> None:
+        numbers = sorted({self._cite(doc_id) for doc_id in _DOC_ID_RE.findall(marker) if doc_id in self.docs})
+        if not numbers:
+            self._drop_leading = bool(self._whitespace)
+            return
+        self._whitespace = ''
+        out.append((' ' if self._started else '') + f"[{','.join(map(str, numbers))}]")
+        self._started = True
+        self._after_marker = True
+
+    def _cite(self, doc_id: str) -> int:
+        doc = self.docs[doc_id]
+        key = (doc.get('content', '').strip(), doc.get('url', '').strip())
+        if key not in self._citations:
+            number = len(self._citations) + 1
+            self._citations[key] = number
+            self.sources[f"DOC:{number - 1}"] = doc
+        return self._citations[key]
+
+
+def format_citations(response_text: str, docs: Dict[str, Dict[str, str]]) -> Tuple[str, Dict[str, Dict[str, str]]]:
+    """Format a complete response, returning the text and its sources keyed DOC:{n-1}."""
+    formatter = CitationFormatter(docs)
+    text = formatter.feed(response_text) + formatter.close()
+    return text, formatter.sources
@@ -0,0 +1,30 @@
+"""Settings and state shared by the Flask app (app.py), the ASGI gateway (gateway.py) and the CLI (chatbot.py)."""
+import os
+from sessions import SessionStore
+
+# Shown when get-actions fails to reach the RAG server
+ERROR_ROADMAP = """IMMEDIATE ACTIONS:
+1. Contact Forbrukerrådet (Norwegian Consumer Authority)
+   - Call 23 400 500 for urgent guidance
+   - Opening hours: Mon-Fri, 9:00-15:00
+
+REQUIRED DOCUMENTS:
+• Lease Agreement
+• Any communication with landlord
+
+HELPFUL RESOURCES:
+• Forbrukerrådet
+  Website: forbrukerradet.no/housing
+  Phone: 23 400 500"""
+
+# Shown when the retrieved sources hold no roadmap facets (see chatbot.build_roadmap)
+NO_SOURCES_ROADMAP = """IMMEDIATE ACTIONS:
+• Contact appropriate authorities for guidance
+• Review official documentation requirements
+
+HELPFUL RESOURCES:
+• udi.no/en
+• norway.no/en"""
+
+# Conversation turns per browser session; set CHAT_SESSION_DB to a file to persist them
+sessions = SessionStore(os.environ.get('CHAT_SESSION_DB', ':memory:'))
@@ -0,0 +1,250 @@
+"""ASGI port of the chat app.
+
+All routes share one keep-alive connection pool to the RAG server, so a slow LLM
+call waits on a socket instead of holding a worker thread:
+
+    poetry run uvicorn gateway:app --port 5000
+"""
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from starlette.background import BackgroundTask
+from config import ERROR_ROADMAP, NO_SOURCES_ROADMAP, sessions
+from citations import CitationFormatter, format_citations
+from chatbot import build_roadmap
+
+RAG_URL = os.environ.get('RAG_URL', 'http://localhost:8888')
+# Upstream read timeout covers the whole LLM generation of a non-streaming /query
+RAG_TIMEOUT = float(os.environ.get('RAG_TIMEOUT', 60.0))
+RAG_MAX_CONNECTIONS = int(os.environ.get('RAG_MAX_CONNECTIONS', 100))
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+client = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global client
+    client = httpx.AsyncClient(
+        base_url=RAG_URL,
+        timeout=httpx.Timeout(RAG_TIMEOUT, connect=5.0, pool=5.0),
+        limits=httpx.Limits(max_connections=RAG_MAX_CONNECTIONS, max_keepalive_connections=RAG_MAX_CONNECTIONS),
+    )
+    yield
+    await client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+app.mount('/static', StaticFiles(directory=os.path.join(BASE_DIR, 'static')), name='static')
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, 'templates'))
+# The templates are written for Flask's url_for('static', filename=...)
+templates.env.globals['url_for'] = lambda endpoint, filename: f'/{endpoint}/{filename}'
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def until_disconnected(request: Request, coro, poll_interval=0.5):
+    """Run coro, cancelling it (and its upstream request) if the client goes away"""
+    task = asyncio.create_task(coro)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=poll_interval)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            task.cancel()
+            raise ClientDisconnected()
+
+
+async def history(session_id):
+    """A session's conversation context; the store is SQLite, so it is read off the event loop"""
+    if not session_id:
+        return ''
+    return await asyncio.to_thread(sessions.context, session_id)
+
+
+def _append_exchange(session_id, message, response):
+    sessions.append(session_id, 'user', message)
+    sessions.append(session_id, 'assistant', response)
+
+
+async def remember(session_id, message, response):
+    """Store a question and its answer in the session, off the event loop"""
+    if session_id:
+        await asyncio.to_thread(_append_exchange, session_id, message, response)
+
+
+def no_cache(response):
+    """Add headers to prevent caching."""
+    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '-1'
+    return response
+
+
+@app.middleware('http')
+async def add_header(request: Request, call_next):
+    return no_cache(await call_next(request))
+
+
+@app.exception_handler(ClientDisconnected)
+async def disconnected_handler(request: Request, exc):
+    return JSONResponse({'success': False, 'error': 'Client disconnected'}, status_code=499)
+
+
+@app.exception_handler(httpx.TimeoutException)
+async def timeout_handler(request: Request, exc):
+    return JSONResponse({'success': False, 'error': 'Timed out waiting for the query endpoint'}, status_code=504)
+
+
+@app.exception_handler(httpx.HTTPError)
+async def upstream_error_handler(request: Request, exc):
+    print(f"Error reaching the query endpoint: {exc!r}")
+    return JSONResponse({'success': False, 'error': str(exc)}, status_code=502)
+
+
+@app.get('/')
+async def home(request: Request):
+    return templates.TemplateResponse(request, 'index.html')
+
+
+def busy(response):
+    """The RAG server's overload answer (429 or 503) passed on with its Retry-After, or None"""
+    if response.status_code not in (429, 503):
+        return None
+    return JSONResponse(
+        {'success': False, 'error': 'The assistant is busy, please try again shortly'},
+        status_code=response.status_code, headers={'Retry-After': response.headers.get('Retry-After', '5')},
+    )
+
+
+@app.post('/api/translate')
+async def translate(request: Request):
+    data = await request.json()
+    response = await until_disconnected(request, client.post('/translate', json=data))
+    if (overloaded := busy(response)) is not None:
+        return overloaded
+    return JSONResponse(response.json(), status_code=response.status_code)
+
+
+@app.post('/api/chat')
+async def chat(request: Request):
+    body = await request.json()
+    message, session_id = body.get('message', ''), body.get('sessionId')
+    response = await until_disconnected(request, client.post('/query', json={
+        'query': message, 'k': 10, 'rerank': True, 'history': await history(session_id), 'session_id': session_id
+    }))
+    if (overloaded := busy(response)) is not None:
+        return overloaded
+    if response.status_code != 200:
+        return JSONResponse({'success': False, 'error': 'Failed to get response from query endpoint'}, status_code=500)
+    data = response.json()
+    if 'response' not in data:
+        return JSONResponse({'success': False, 'error': 'Invalid response format from query endpoint'}, status_code=500)
+    formatted_response, sources = format_citations(data['response'], data.get('docs', {}))
+    await remember(session_id, message, formatted_response)
+    return {'success': True, 'response': formatted_response, 'docs': sources}
+
+
+@app.post('/api/chat/prefetch')
+async def chat_prefetch(request: Request):
+    """Start retrieval for the message being typed, reused by /api/chat when it is sent"""
+    body = await request.json()
+    message, session_id = body.get('message', ''), body.get('sessionId')
+    if not message.strip() or not session_id:
+        return {'success': False}
+    response = await client.post('/prefetch', json={
+        'query': message, 'k': 10, 'rerank': True, 'history': await history(session_id), 'session_id': session_id
+    })
+    return {'success': response.status_code == 200}
+
+
+@app.post('/api/chat/stream')
+async def chat_stream(request: Request):
+    """Forward the RAG server's NDJSON stream with citations rewritten as tokens arrive"""
+    body = await request.json()
+    message, session_id = body.get('message', ''), body.get('sessionId')
+    upstream = await client.send(
+        client.build_request('POST', '/query/stream', json={
+            'query': message, 'k': 10, 'rerank': True, 'history': await history(session_id),
+            'session_id': session_id,
+        }),
+        stream=True,
+    )
+    if upstream.status_code != 200:
+        await upstream.aclose()
+        if (overloaded := busy(upstream)) is not None:
+            return overloaded
+        return JSONResponse({'success': False, 'error': 'Failed to get response from query endpoint'}, status_code=500)
+
+    async def events():
+        formatter = CitationFormatter({})
+        parts = []
+        async for line in upstream.aiter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event['type'] == 'sources':
+                formatter = CitationFormatter(event['docs'])
+                continue
+            if event['type'] == 'token':
+                text = formatter.feed(event['text'])
+            elif event['type'] == 'done':
+                text = formatter.close()
+            else:
+                yield json.dumps(event) + '\n'
+                continue
+            if text:
+                parts.append(text)
+                yield json.dumps({'type': 'token', 'text': text}, ensure_ascii=False) + '\n'
+            if event['type'] == 'done':
+                response = ''.join(parts)
+                if event.get('success', True):
+                    await remember(session_id, message, response)
+                yield json.dumps({
+                    'type': 'done', 'success': event.get('success', False), 'response': response, 'docs': formatter.sources
+                }, ensure_ascii=False) + '\n'
+
+    # Closing the upstream response when the client disconnects cancels the generation
+    return StreamingResponse(events(), media_type='application/x-ndjson', background=BackgroundTask(upstream.aclose))
+
+
+@app.post('/api/get-actions')
+async def get_actions(request: Request):
+    body = await request.json()
+    message, session_id = body.get('message', ''), body.get('sessionId')
+    response = await until_disconnected(request, client.post('/query', json={
+        'query': message, 'k': 10, 'rerank': True, 'include_sources': True, 'history': await history(session_id)
+    }))
+    if response.status_code != 200:
+        print(f"Error in get_actions: query endpoint returned {response.status_code}")
+        return JSONResponse({
+            'error': 'Failed to process request',
+            'response': 'I apologize, but I encountered an error. Please try again.',
+            'roadmap': ERROR_ROADMAP,
+        }, status_code=500)
+    data = response.json()
+    if not data.get('success'):
+        chat_response = "I apologize, but I couldn't process your request. Please try again."
+    else:
+        chat_response = data['response']
+        await remember(session_id, message, chat_response)
+    # The roadmap is built from the same retrieved sources as the answer
+    return {'response': chat_response, 'roadmap': build_roadmap(data.get('sources', {})) or NO_SOURCES_ROADMAP}
+
+
+@app.post('/api/get-source')
+async def get_source(request: Request):
+    data = await request.json()
+    chunk_ids = data.get('chunkIds', [])
+    response = await until_disconnected(request, client.post('/chunks', json={'ids': chunk_ids}))
+    if response.status_code != 200:
+        return {'success': False, 'error': 'Failed to fetch source content'}
+    return {'success': True, 'sources': response.json().get('chunks', {})}
@@ -0,0 +1,178 @@
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+_CITATION_RE = re.compile(r'\s*\[(?:DOC:\d+(?:,\s*DOC:\d+)*|\d+(?:,\d+)*)\]')
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?])\s')
+
+
+def count_tokens(text: str) -> int:
+    """Rough token estimate (about four characters per token)."""
+    return max(1, len(text) // 4)
+
+
+def summarize_turn(role: str, content: str, max_words: int = 30) -> str:
+    """Compress a turn into one line: its first sentence, without citations."""
+    text = _CITATION_RE.sub('', content).strip()
+    sentence = _SENTENCE_END_RE.split(text, maxsplit=1)[0]
+    words = sentence.split()
+    if len(words) > max_words:
+        sentence = ' '.join(words[:max_words]) + '...'
+    return f"{role.capitalize()}: {sentence}"
+
+
+class SessionStore:
+    """Conversation turns per session id, backed by SQLite.
+
+    Sessions neither read nor written for longer than ttl seconds expire, and the least
+    recently used ones are evicted beyond max_sessions. Reads run in a plain read
+    transaction: they note the session's use in memory, and the next write stores it
+    before evicting, so readers never wait for the write lock. Once a session's turns
+    exceed max_tokens the oldest turns are folded into a short summary, itself capped at
+    max_summary_tokens.
+    """
+
+    def __init__(self, path: str = ':memory:', max_sessions: int = 10000, ttl: float = 24 * 3600,
+                 max_tokens: int = 2000, max_summary_tokens: int = 300):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        self.max_summary_tokens = max_summary_tokens
+        self.lock = threading.Lock()
+        # Sessions read since the last write, with when
+        self.touched: Dict[str, float] = {}
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+            CREATE TABLE IF NOT EXISTS turns (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                tokens INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, seq);
+        """)
+
+    def append(self, session_id: str, role: str, content: str) -> None:
+        """Add a turn to a session, creating it if needed."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("UPDATE sessions SET updated_at = MAX(updated_at, ?) WHERE id = ?",
+                                    [(used, touched) for touched, used in self.touched.items()])
+                # An expired session starts over instead of reviving its old turns
+                self._delete_if_expired(session_id, now)
+                self.db.execute(
+                    "INSERT INTO sessions (id, updated_at) VALUES (?, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET updated_at = excluded.updated_at",
+                    (session_id, now))
+                self.db.execute(
+                    "INSERT INTO turns (session_id, role, content, tokens) VALUES (?, ?, ?, ?)",
+                    (session_id, role, content, count_tokens(content)))
+                self._compact(session_id)
+                self._evict(now)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.touched.clear()
+
+    def _load(self, session_id: str) -> Tuple[str, List[Dict[str, str]]]:
+        """A session's summary and verbatim turns; reading a session counts as using it."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                row = self.db.execute("SELECT summary, updated_at FROM sessions WHERE id = ?", (session_id,)).fetchone()
+                rows = self.db.execute(
+                    "SELECT role, content FROM turns WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            # Expired but not evicted yet, which happens on the next write
+            if row is None or max(row[1], self.touched.get(session_id, 0.0)) < now - self.ttl:
+                return '', []
+            self.touched[session_id] = now
+        return row[0], [{"role": role, "content": content} for role, content in rows]
+
+    def turns(self, session_id: str) -> List[Dict[str, str]]:
+        """Turns kept verbatim for a session, oldest first."""
+        return self._load(session_id)[1]
+
+    def summary(self, session_id: str) -> str:
+        return self._load(session_id)[0]
+
+    def context(self, session_id: Optional[str], skip_last: bool = False) -> str:
+        """Compact conversation context: the summary of old turns plus the recent turns.
+
+        Use skip_last when the latest turn is the message being answered.
+        """
+        if not session_id:
+            return ''
+        summary, turns = self._load(session_id)
+        if skip_last:
+            turns = turns[:-1]
+        lines = [line for line in summary.split('\n') if line]
+        lines.extend(summarize_turn(turn["role"], turn["content"], max_words=60) for turn in turns)
+        return '\n'.join(lines)
+
+    def delete(self, session_id: str) -> None:
+        with self.lock:
+            self.touched.pop(session_id, None)
+            self.db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            self.db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def _compact(self, session_id: str) -> None:
+        rows = self.db.execute(
+            "SELECT seq, role, content, tokens FROM turns WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        total = sum(tokens for *_, tokens in rows)
+        folded = []
+        # Always keep the latest turn verbatim
+        while total > self.max_tokens and len(rows) - len(folded) > 1:
+            seq, role, content, tokens = rows[len(folded)]
+            folded.append(seq)
+            total -= tokens
+            summary_line = summarize_turn(role, content)
+            self.db.execute(
+                "UPDATE sessions SET summary = summary || ? || char(10) WHERE id = ?", (summary_line, session_id))
+        if not folded:
+            return
+        self.db.executemany("DELETE FROM turns WHERE seq = ?", [(seq,) for seq in folded])
+        summary = self.db.execute("SELECT summary FROM sessions WHERE id = ?", (session_id,)).fetchone()[0]
+        lines = [line for line in summary.split('\n') if line]
+        while len(lines) > 1 and count_tokens('\n'.join(lines)) > self.max_summary_tokens:
+            lines.pop(0)
+        self.db.execute("UPDATE sessions SET summary = ? WHERE id = ?", ('\n'.join(lines) + '\n', session_id))
+
+    def _delete_if_expired(self, session_id: str, now: float) -> None:
+        if self.db.execute("SELECT 1 FROM sessions WHERE id = ? AND updated_at < ?",
+                           (session_id, now - self.ttl)).fetchone():
+            self.db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            self.db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def _evict(self, now: float) -> None:
+        expired = [row[0] for row in self.db.execute(
+            "SELECT id FROM sessions WHERE updated_at < ?", (now - self.ttl,))]
+        count = self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - len(expired)
+        if count > self.max_sessions:
+            expired += [row[0] for row in self.db.execute(
+                "SELECT id FROM sessions WHERE updated_at >= ? ORDER BY updated_at LIMIT ?",
+                (now - self.ttl, count - self.max_sessions))]
+        if expired:
+            self.db.executemany("DELETE FROM turns WHERE session_id = ?", [(s,) for s in expired])
+            self.db.executemany("DELETE FROM sessions WHERE id = ?", [(s,) for s in expired])
@@ -12,12 +12,42 @@ document.addEventListener('click', function(e) {
     }
 });
 
+// Identifies this tab's conversation so follow-up questions keep their context
+const sessionId = sessionStorage.getItem('sessionId') || crypto.randomUUID();
+sessionStorage.setItem('sessionId', sessionId);
+
+// Retrieval for the message is started after a pause in typing, so sending it only
+// waits for rerank and generation
+const PREFETCH_DELAY_MS = 400;
+const PREFETCH_MIN_LENGTH = 12;
+let prefetchTimer = null;
+let lastPrefetched = '';
+
+function schedulePrefetch() {
+    clearTimeout(prefetchTimer);
+    prefetchTimer = setTimeout(() => {
+        const message = document.getElementById('message-input').value.trim();
+        if (message.length < PREFETCH_MIN_LENGTH || message === lastPrefetched) return;
+        lastPrefetched = message;
+        fetch('/api/chat/prefetch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ message, sessionId })
+        }).catch(error => console.error('Prefetch error:', error));
+    }, PREFETCH_DELAY_MS);
+}
+
 async function sendMessage() {
     const messageInput = document.getElementById('message-input');
     const message = messageInput.value.trim();
 
     if (message === '') return;
 
+    clearTimeout(prefetchTimer);
+    lastPrefetched = '';
+
     // Add user message to chat
     addMessage(message, true);
 
@@ -33,7 +63,7 @@ async function sendMessage() {
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ message })
+            body: JSON.stringify({ message, sessionId })
         });
 
         // Remove loading message
@@ -260,4 +290,6 @@ document.getElementById('message-input').addEventListener('keypress', function(e
     }
 });
 
+document.getElementById('message-input').addEventListener('input', schedulePrefetch);
+
 document.getElementById('send-button').addEventListener('click', sendMessage);
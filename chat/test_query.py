@@ -1,36 +1,17 @@
 import requests
 import json
-import re
+from citations import format_citations
 
 def format_response(response_text, docs):
-    # Split into sentences (looking for [DOC: pattern)
-    parts = re.split(r'(\[DOC:[^\]]+\])', response_text)
-    formatted_text = ""
-    
-    for i in range(0, len(parts)-1, 2):
-        sentence = parts[i]
-        doc_refs = parts[i+1] if i+1 < len(parts) else ""
-        
-        # Get the doc numbers
-        doc_ids = re.findall(r'DOC:\d+', doc_refs)
-        
-        # Format sources
-        sources = "\nSources:"
-        for doc_id in doc_ids:
-            if doc_id in docs:
-                doc = docs[doc_id]
-                sources += f"\n{doc_id}:"
-                sources += f"\n  Content: {doc['content']}"
-                sources += f"\n  URL: {doc['url']}"
-        
-        # Add formatted sentence
-        formatted_text += f"\033[96m{sentence}\033[0m{sources}\n\n"
-    
-    # Add any remaining text without sources
-    if len(parts) % 2 == 1:
-        formatted_text += parts[-1]
-    
-    return formatted_text
+    text, sources = format_citations(response_text, docs)
+
+    lines = [f"\033[96m{text}\033[0m", "", "Sources:"]
+    for doc_id, doc in sources.items():
+        lines.append(f"[{int(doc_id.split(':')[1]) + 1}]")
+        lines.append(f"  Content: {doc['content']}")
+        lines.append(f"  URL: {doc['url']}")
+
+    return "\n".join(lines)
 
 def query_endpoint(message):
     try:
@@ -0,0 +1,52 @@
+import pytest
+from citations import CitationFormatter, format_citations
+
+DOCS = {
+    'DOC:0': {'content': 'Residence permits are renewed online.', 'url': 'https://www.udi.no/permits'},
+    'DOC:1': {'content': 'Deposits may not exceed six months of rent.', 'url': 'https://www.forbrukerradet.no/housing'},
+    # The same source as DOC:0 retrieved twice
+    'DOC:2': {'content': 'Residence permits are renewed online.', 'url': 'https://www.udi.no/permits'},
+}
+
+RESPONSES = [
+    'Renew your permit online [DOC:0]. The deposit is capped [DOC:1].',
+    'Renew your permit online [DOC:2] before it expires [DOC:0, DOC:1].',
+    'Cited later first [DOC:1] and then [DOC:0].\n\nA new paragraph [DOC:2]',
+    'An unknown source [DOC:7] is dropped, and so is its space.',
+    'Plain [brackets] and [DOC without a number stay as they are.',
+    '[DOC:0] A response opening with a citation.',
+    'Trailing whitespace after the last citation [DOC:1]   ',
+    'A long bracket [DOC:' + 'x' * 80 + '] is passed through.',
+    'The longest marker [DOC:1,' + ' ' * 51 + 'DOC:0] still cites.',
+    'No citations at all.',
+]
+
+
+def stream(text, sizes):
+    """text split into consecutive pieces of the given sizes, cycling through them"""
+    pieces, i, n = [], 0, 0
+    while i < len(text):
+        size = sizes[n % len(sizes)]
+        pieces.append(text[i:i + size])
+        i += size
+        n += 1
+    return pieces
+
+
+@pytest.mark.parametrize('response', RESPONSES)
+@pytest.mark.parametrize('sizes', [[1], [2], [3, 1], [5, 7, 2], [1000]])
+def test_streaming_matches_one_shot(response, sizes):
+    expected = format_citations(response, DOCS)
+    formatter = CitationFormatter(DOCS)
+    text = ''.join(formatter.feed(piece) for piece in stream(response, sizes)) + formatter.close()
+    assert (text, formatter.sources) == expected
+
+
+def test_sources_are_deduplicated_and_numbered_by_first_citation():
+    text, sources = format_citations('First [DOC:1] then [DOC:2] and [DOC:0]', DOCS)
+    assert text == 'First [1] then [2] and [2]'
+    assert sources == {'DOC:0': DOCS['DOC:1'], 'DOC:1': DOCS['DOC:0']}
+
+
+def test_unknown_citations_are_dropped():
+    assert format_citations('Nothing known [DOC:9] here.', DOCS) == ('Nothing known here.', {})
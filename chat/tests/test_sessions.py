@@ -0,0 +1,91 @@
+import pytest
+import sessions
+from sessions import SessionStore
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sessions.time, 'time', clock)
+    return clock
+
+
+def test_context_keeps_turns_in_order(clock):
+    store = SessionStore()
+    store.append('a', 'user', 'How do I renew my residence permit?')
+    store.append('a', 'assistant', 'Apply online at UDI before it expires. [DOC:1] Bring your passport.')
+    assert store.context('a') == (
+        'User: How do I renew my residence permit?\n'
+        'Assistant: Apply online at UDI before it expires.'
+    )
+    assert store.context('a', skip_last=True) == 'User: How do I renew my residence permit?'
+    assert store.context(None) == ''
+    assert store.context('unknown') == ''
+
+
+def test_old_turns_are_folded_into_summary(clock):
+    store = SessionStore(max_tokens=30, max_summary_tokens=20)
+    for i in range(6):
+        store.append('a', 'user', f'Question number {i} about tenancy deposits.' + ' filler' * 5)
+    turns = store.turns('a')
+    assert 1 <= len(turns) < 6
+    assert turns[-1]['content'].startswith('Question number 5')
+    summary = [line for line in store.summary('a').split('\n') if line]
+    assert summary and sessions.count_tokens('\n'.join(summary)) <= 20
+    # The summary holds the most recent folded turns
+    assert summary[-1].startswith(f'User: Question number {5 - len(turns)}')
+
+
+def test_expired_session_is_not_read_or_revived(clock):
+    store = SessionStore(ttl=60)
+    store.append('a', 'user', 'First question')
+    clock.now += 61
+    assert store.turns('a') == []
+    store.append('a', 'user', 'Second question')
+    assert [turn['content'] for turn in store.turns('a')] == ['Second question']
+
+
+def test_expired_sessions_are_evicted_on_write(clock):
+    store = SessionStore(ttl=60)
+    store.append('a', 'user', 'First question')
+    clock.now += 61
+    store.turns('a')
+    assert len(store) == 1
+    store.append('b', 'user', 'Another question')
+    assert len(store) == 1
+    assert store.turns('a') == []
+
+
+def test_reads_keep_a_session_alive(clock):
+    store = SessionStore(ttl=60)
+    store.append('a', 'user', 'First question')
+    clock.now += 50
+    assert store.turns('a')
+    clock.now += 50
+    # Read 50 seconds ago, so not expired although written 100 seconds ago
+    assert store.turns('a')
+    store.append('b', 'user', 'Another question')
+    assert len(store) == 2
+
+
+def test_least_recently_used_sessions_are_evicted(clock):
+    store = SessionStore(max_sessions=2)
+    store.append('a', 'user', 'Question a')
+    clock.now += 1
+    store.append('b', 'user', 'Question b')
+    clock.now += 1
+    # Reading a makes b the least recently used
+    store.turns('a')
+    clock.now += 1
+    store.append('c', 'user', 'Question c')
+    assert len(store) == 2
+    assert store.turns('b') == []
+    assert store.turns('a') and store.turns('c')
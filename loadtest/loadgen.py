@@ -0,0 +1,127 @@
+"""Open-loop load generator for the chat gateway and the RAG server.
+
+Requests are started at the target rate regardless of how many are still in flight,
+so queueing in the servers shows up as latency instead of a lower send rate:
+
+    python loadgen.py --rps 20 --duration 60 \\
+        --target query=http://localhost:8888/query --target chat=http://localhost:5000/api/chat
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+import httpx
+
+QUESTIONS = [
+    "How do i immigrate to Norway i come from Sweden and am planning to marry a norwegian, but i don't want to work",
+    "What do i need to do to get a job in Norway?",
+    "What do i need to do when i have gotten a job in Norway?",
+    "What do i need to get citizenship in Norway?",
+    "How do i get BankID?",
+    "Як подати запит на надання притулку?",
+    "Czy mogę pracować w Norwegii?",
+    "Wat doe ik als alle opties voor afspraken met de politie vol zijn?",
+]
+
+# Request body per endpoint kind, keyed by the last path segment of the target URL
+PAYLOADS = {
+    "query": lambda q: {"query": q, "k": 10, "rerank": True},
+    "chat": lambda q: {"message": q},
+    "get-actions": lambda q: {"message": q},
+}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.outcomes = Counter()
+
+    def summary(self, duration):
+        total = sum(self.outcomes.values())
+        ok = self.outcomes["200"]
+        ms = [s * 1000 for s in self.latencies]
+        return {
+            "requests": total,
+            "throughput_rps": ok / duration,
+            "error_rate": (total - ok) / total if total else 0.0,
+            "outcomes": dict(self.outcomes),
+            "latency_ms": {f"p{q}": percentile(ms, q) for q in (50, 90, 95, 99)},
+        }
+
+
+async def send(client, name, url, payload, stats):
+    start = time.perf_counter()
+    try:
+        response = await client.post(url, json=payload)
+        outcome = str(response.status_code)
+    except httpx.TimeoutException:
+        outcome = "timeout"
+    except httpx.HTTPError as e:
+        outcome = type(e).__name__
+    if outcome == "200":
+        stats[name].latencies.append(time.perf_counter() - start)
+    stats[name].outcomes[outcome] += 1
+
+
+async def run(targets, rps, duration, timeout, poisson):
+    stats = {name: Stats() for name, _ in targets}
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits, follow_redirects=True) as client:
+        tasks = []
+        start = time.perf_counter()
+        next_at = start
+        i = 0
+        while next_at - start < duration:
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            name, url = targets[i % len(targets)]
+            kind = url.rstrip("/").rsplit("/", 1)[-1]
+            payload = PAYLOADS.get(kind, PAYLOADS["chat"])(random.choice(QUESTIONS))
+            tasks.append(asyncio.create_task(send(client, name, url, payload, stats)))
+            i += 1
+            next_at += random.expovariate(rps) if poisson else 1 / rps
+        sending = time.perf_counter() - start
+        await asyncio.gather(*tasks)
+    return {name: s.summary(sending) for name, s in stats.items()}
+
+
+def parse_target(value):
+    name, sep, url = value.partition("=")
+    if not sep:
+        name, url = value.rstrip("/").rsplit("/", 1)[-1], value
+    return name, url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive /api/chat and /query at a target request rate")
+    parser.add_argument("--target", type=parse_target, action="append", required=True,
+                        help="name=url, repeat for several endpoints (requests are spread round-robin)")
+    parser.add_argument("--rps", type=float, default=5.0, help="Total request rate over all targets")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to send requests for")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request timeout in seconds")
+    parser.add_argument("--constant", action="store_true", help="Evenly spaced instead of Poisson arrivals")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.target, args.rps, args.duration, args.timeout, not args.constant))
+    for name, summary in report.items():
+        latency = summary["latency_ms"]
+        fmt = lambda v: "-" if v is None else f"{v:.0f}ms"
+        print(f"{name:>12}: {summary['requests']} requests, {summary['throughput_rps']:.2f} ok/s, "
+              f"{summary['error_rate'] * 100:.1f}% errors, p50 {fmt(latency['p50'])}, "
+              f"p95 {fmt(latency['p95'])}, p99 {fmt(latency['p99'])}  {summary['outcomes']}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""Local stand-ins for the Nebius (OpenAI chat-completions) and Cohere rerank APIs.
+
+Both APIs are served from one process with configurable latency distributions:
+
+    python stubs.py --port 9000 --ttft lognormal:0.5,0.4 --token-interval const:0.02 --rerank-latency normal:0.25,0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+import uvicorn
+
+app = FastAPI()
+
+
+class Distribution:
+    """Latency distribution in seconds parsed from 'kind:params', e.g. 'uniform:0.1,0.3'"""
+    def __init__(self, spec):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p]
+        samplers = {
+            "const": lambda v: v,
+            "uniform": random.uniform,
+            "normal": random.gauss,
+            "lognormal": lambda median, sigma: median * random.lognormvariate(0, sigma),
+            "exp": lambda mean: random.expovariate(1 / mean),
+        }
+        if kind not in samplers:
+            raise ValueError(f"Unknown distribution {spec!r}, expected one of {sorted(samplers)}")
+        self._sample = samplers[kind]
+
+    def sample(self):
+        return max(0.0, self._sample(*self.params))
+
+    def __repr__(self):
+        return self.spec
+
+
+config = {
+    "ttft": Distribution("lognormal:0.5,0.4"),
+    "token_interval": Distribution("const:0.02"),
+    "tokens": 120,
+    "rerank_latency": Distribution("normal:0.25,0.05"),
+    "error_rate": 0.0,
+}
+
+_DOC_TAG_RE = re.compile(r"\[(DOC:\d+)\]")
+_WORDS = ("You need a valid residence permit and must register with the tax office before you start "
+          "working in Norway and the police will book an appointment for you").split()
+
+
+def _answer(messages):
+    prompt = messages[-1]["content"] if messages else ""
+    if "Translate the following document" in prompt:
+        document = prompt.split("Document: ", 1)[-1].split("\n\nOutput format:", 1)[0]
+        return json.dumps({"from_lang": "no", "to_lang": "en", "translation": document})
+    tags = list(dict.fromkeys(_DOC_TAG_RE.findall(prompt)))[:3]
+    words = [random.choice(_WORDS) for _ in range(config["tokens"])]
+    sentences = []
+    for i in range(0, len(words), 20):
+        sentence = " ".join(words[i:i + 20]).capitalize() + "."
+        if tags:
+            sentence += f" [{tags[(i // 20) % len(tags)]}]"
+        sentences.append(sentence)
+    return " ".join(sentences)
+
+
+def _tokens(text):
+    return re.findall(r"\S+\s*", text)
+
+
+def _usage(messages, completion):
+    prompt_tokens = sum(len(_tokens(m.get("content", ""))) for m in messages)
+    completion_tokens = len(_tokens(completion))
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+def _maybe_fail():
+    return random.random() < config["error_rate"]
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages", [])
+    model = body.get("model", "stub")
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    if _maybe_fail():
+        await asyncio.sleep(config["ttft"].sample())
+        return StreamingResponse(iter([json.dumps({"error": {"message": "stub failure"}})]),
+                                 status_code=500, media_type="application/json")
+    text = _answer(messages)
+
+    if not body.get("stream"):
+        await asyncio.sleep(config["ttft"].sample() + sum(config["token_interval"].sample() for _ in _tokens(text)))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": _usage(messages, text),
+        }
+
+    def event(choices, **extra):
+        chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                 "model": model, "choices": choices, **extra}
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    async def stream():
+        await asyncio.sleep(config["ttft"].sample())
+        for i, token in enumerate(_tokens(text)):
+            if i:
+                await asyncio.sleep(config["token_interval"].sample())
+            delta = {"role": "assistant", "content": token} if i == 0 else {"content": token}
+            yield event([{"index": 0, "delta": delta, "finish_reason": None}])
+        yield event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield event([], usage=_usage(messages, text))
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@app.post("/v2/rerank")
+async def rerank(request: Request):
+    body = await request.json()
+    await asyncio.sleep(config["rerank_latency"].sample())
+    if _maybe_fail():
+        return StreamingResponse(iter([json.dumps({"message": "stub failure"})]),
+                                 status_code=500, media_type="application/json")
+    query_words = set(body.get("query", "").lower().split())
+    documents = body.get("documents", [])
+    # Rank by word overlap with the query so the order is stable and plausible
+    scores = []
+    for i, doc in enumerate(documents):
+        text = doc if isinstance(doc, str) else doc.get("text", "")
+        overlap = len(query_words & set(text.lower().split()))
+        scores.append((overlap / (len(query_words) or 1), i))
+    scores.sort(key=lambda s: (-s[0], s[1]))
+    top_n = body.get("top_n") or len(documents)
+    return {
+        "id": uuid.uuid4().hex,
+        "results": [{"index": i, "relevance_score": score} for score, i in scores[:top_n]],
+        "meta": {"api_version": {"version": "2"}, "billed_units": {"search_units": 1}},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub LLM and rerank APIs for load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--ttft", type=Distribution, default=config["ttft"],
+                        help="Time to first token, e.g. lognormal:0.5,0.4 (median, sigma)")
+    parser.add_argument("--token-interval", type=Distribution, default=config["token_interval"],
+                        help="Delay between streamed tokens, e.g. const:0.02")
+    parser.add_argument("--tokens", type=int, default=config["tokens"], help="Words per completion")
+    parser.add_argument("--rerank-latency", type=Distribution, default=config["rerank_latency"],
+                        help="Rerank latency, e.g. normal:0.25,0.05 (mean, stddev)")
+    parser.add_argument("--error-rate", type=float, default=config["error_rate"],
+                        help="Fraction of requests answered with HTTP 500")
+    args = parser.parse_args()
+    config.update(ttft=args.ttft, token_interval=args.token_interval, tokens=args.tokens,
+                  rerank_latency=args.rerank_latency, error_rate=args.error_rate)
+    print(f"Stub config: {config}")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
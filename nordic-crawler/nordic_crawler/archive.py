@@ -0,0 +1,87 @@
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:  # Falls back to gzip, slower to decompress but in the standard library
+    zstandard = None
+
+
+class PageArchive:
+    """Content-addressed store of fetched HTML, so extraction can be re-run without re-crawling.
+
+    Each distinct page body is compressed once into objects/<sha256[:2]>/<sha256>.html.zst
+    (.gz without the zstandard package); index.jsonl records every fetch as
+    {url, sha256, fetched_at, size}, the latest line for a URL being its current version.
+    """
+
+    def __init__(self, directory: Path, level: int = 10):
+        self.directory = Path(directory)
+        self.objects = self.directory / 'objects'
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.directory / 'index.jsonl'
+        self.level = level
+        self.suffix = '.html.zst' if zstandard is not None else '.html.gz'
+
+    def _path(self, digest: str, suffix: str) -> Path:
+        return self.objects / digest[:2] / f"{digest}{suffix}"
+
+    def put(self, url: str, html: str) -> str:
+        """Archive a fetched page and return its content hash."""
+        data = html.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest, self.suffix)
+        # Unchanged pages and pages shared by several URLs are stored once
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            if zstandard is not None:
+                compressed = zstandard.ZstdCompressor(level=self.level).compress(data)
+            else:
+                compressed = gzip.compress(data, compresslevel=6)
+            # Written under a temporary name so a crash never leaves a truncated object
+            # (per process and thread, as distributed crawl workers share the archive and
+            # each puts pages from several threads)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(compressed)
+            os.replace(tmp, path)
+        entry = {
+            'url': url,
+            'sha256': digest,
+            'fetched_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'size': len(data),
+        }
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        return digest
+
+    def entries(self) -> Dict[str, Dict]:
+        """Latest index entry per URL, in first-fetch order."""
+        latest: Dict[str, Dict] = {}
+        if self.index_path.exists():
+            with open(self.index_path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        latest[entry['url']] = entry
+        return latest
+
+    def get(self, digest: str) -> Optional[str]:
+        """HTML for a content hash, or None if it is not archived."""
+        path = self._path(digest, '.html.zst')
+        if path.exists():
+            if zstandard is None:
+                raise RuntimeError(f"{path} is zstd-compressed, install the zstandard package to read it")
+            return zstandard.ZstdDecompressor().decompress(path.read_bytes()).decode('utf-8')
+        path = self._path(digest, '.html.gz')
+        if path.exists():
+            return gzip.decompress(path.read_bytes()).decode('utf-8')
+        return None
+
+    def __iter__(self) -> Iterator[Dict]:
+        return iter(self.entries().values())
@@ -0,0 +1,305 @@
+import argparse
+import asyncio
+import functools
+import json
+import signal
+import subprocess
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from crawl4ai import AsyncWebCrawler
+
+from nordic_crawler.archive import PageArchive
+from nordic_crawler.frontier import Frontier, default_worker_id
+from nordic_crawler.main import UDICrawler, start_urls_for
+from nordic_crawler.pipeline import start_pipeline
+
+
+def load_config(crawl_dir: Path) -> Dict:
+    """The crawl's start URLs, domains, depth and journal mode, written by seed."""
+    with open(Path(crawl_dir) / 'crawl.json', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def seed(crawl_dir: Path, domains: List[str], max_depth: int, journal_mode: str = 'wal') -> Dict[str, int]:
+    """Create (or resume) a crawl in crawl_dir, queueing the domains' start URLs."""
+    crawl_dir = Path(crawl_dir)
+    config = {'domains': domains, 'max_depth': max_depth, 'start_urls': start_urls_for(domains),
+              'journal_mode': journal_mode}
+    config_path = crawl_dir / 'crawl.json'
+    if config_path.exists():
+        if load_config(crawl_dir) != config:
+            raise ValueError(f"{crawl_dir} holds a crawl with other settings, use another --crawl-dir")
+    else:
+        crawl_dir.mkdir(parents=True, exist_ok=True)
+        with open(config_path, 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=2)
+    frontier = Frontier(crawl_dir, journal_mode=journal_mode)
+    frontier.add(config['start_urls'], 0)
+    counts = frontier.counts()
+    frontier.close()
+    return counts
+
+
+class FrontierCrawler(UDICrawler):
+    """Crawl worker taking its URLs from a shared Frontier instead of recursing from the start URLs.
+
+    Any number of these, in local processes or on machines sharing the crawl directory,
+    crawl one site together. Each appends its pages to pages/<worker>.jsonl in the crawl
+    directory as {id, page} lines, merged into the usual output by merge_outputs.
+    """
+
+    def __init__(self, crawl_dir: Path, worker_id: Optional[str] = None, batch_size: int = 4,
+                 lease_seconds: float = 300.0, poll_interval: float = 2.0,
+                 page_queue: Optional[asyncio.Queue] = None, archive: Optional[PageArchive] = None):
+        config = load_config(crawl_dir)
+        self.worker_id = worker_id or default_worker_id()
+        super().__init__(start_urls=config['start_urls'],
+                         allowed_domains=config['domains'],
+                         max_depth=config['max_depth'],
+                         output_dir=Path(crawl_dir) / 'pages',
+                         output_format='jsonl',
+                         output_filename=self.worker_id,
+                         page_queue=page_queue,
+                         archive=archive)
+        # SQLite calls block, so they run on one thread of their own, which the
+        # connection is opened on, instead of on the event loop
+        self.frontier_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='frontier')
+        self.frontier = self.frontier_thread.submit(
+            Frontier, crawl_dir, lease_seconds=lease_seconds, journal_mode=config['journal_mode']).result()
+        # Concurrent fetches per worker, and seconds to wait for others' links when the frontier is drained
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.output_lock = threading.Lock()
+
+    async def call_frontier(self, method: str, *args):
+        """Run a Frontier method on the frontier thread."""
+        call = functools.partial(getattr(self.frontier, method), *args)
+        return await asyncio.get_running_loop().run_in_executor(self.frontier_thread, call)
+
+    def _append_leased_page(self, id_: int, page: Dict):
+        line = json.dumps({'id': id_, 'page': page}, ensure_ascii=False) + '\n'
+        # Pages are written from several threads, and a long line takes more than one write
+        with self.output_lock, open(self.output_dir / f"{self.output_filename}.jsonl", 'a', encoding='utf-8') as f:
+            f.write(line)
+
+    async def save_leased_page(self, id_: int, page: Dict):
+        """Append a page to this worker's output, keyed by its frontier id for the merge."""
+        await asyncio.to_thread(self._append_leased_page, id_, page)
+        self.total_processed += 1
+        if self.page_queue is not None:
+            self.page_queue.put_nowait(self.page_records(page))
+
+    async def crawl_leased(self, id_: int, url: str, depth: int, crawler: AsyncWebCrawler) -> None:
+        """Crawl a leased URL, queueing its links in the frontier instead of following them."""
+        try:
+            result = await crawler.arun(url=url)
+            if not result or not result.html:
+                print(f"Failed to fetch content from {url}")
+                await self.call_frontier('fail', id_, self.worker_id)
+                return
+
+            if self.archive is not None:
+                await asyncio.to_thread(self.archive.put, url, result.html)
+
+            if depth < self.max_depth:
+                await self.call_frontier('add', self.extract_links(result.html, url), depth + 1)
+
+            if self.should_process_url(url):
+                content = self.extract_content_from_html(result.html, url)
+                if content:
+                    await self.save_leased_page(id_, content)
+
+            # A page written after its lease expired is written twice, the merge keeps one
+            await self.call_frontier('complete', id_, self.worker_id)
+        except Exception:
+            print(f"Error crawling {url}:")
+            traceback.print_exc()
+            await self.call_frontier('fail', id_, self.worker_id)
+
+    async def crawl(self) -> int:
+        """Crawl leased batches until no URL is pending or leased by any worker."""
+        async with AsyncWebCrawler() as crawler:
+            try:
+                while True:
+                    batch = await self.call_frontier('claim', self.worker_id, self.batch_size)
+                    if not batch:
+                        # Pages leased by other workers may still add links
+                        if await self.call_frontier('finished'):
+                            break
+                        await asyncio.sleep(self.poll_interval)
+                        continue
+                    await asyncio.gather(*(self.crawl_leased(id_, url, depth, crawler) for id_, url, depth in batch))
+                    print(f"Worker {self.worker_id}: {self.total_processed} pages processed, "
+                          f"frontier {await self.call_frontier('counts')}")
+            finally:
+                # Unfinished leases go straight back to the others instead of expiring;
+                # queued behind any call still running on the frontier thread
+                await self.call_frontier('release', self.worker_id)
+                await self.call_frontier('close')
+                self.frontier_thread.shutdown()
+        return self.total_processed
+
+
+async def run_worker(crawl_dir: Path, worker_id: Optional[str] = None, batch_size: int = 4,
+                     lease_seconds: float = 300.0, archive_dir: Optional[Path] = None,
+                     ingest_url: Optional[str] = None) -> int:
+    """Run one crawl worker until the frontier is drained."""
+    page_queue, sender = start_pipeline(ingest_url)
+    crawler = FrontierCrawler(crawl_dir, worker_id=worker_id, batch_size=batch_size, lease_seconds=lease_seconds,
+                              page_queue=page_queue,
+                              archive=PageArchive(archive_dir) if archive_dir is not None else None)
+    crawl = asyncio.ensure_future(crawler.crawl())
+    stopped = []
+
+    def stop():
+        # run() stops workers with SIGTERM: cancel the crawl so that its leases are
+        # released for the other workers instead of expiring
+        if stopped:
+            return
+        print(f"Worker {crawler.worker_id} stopping")
+        stopped.append(True)
+        crawl.cancel()
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stop)
+    try:
+        processed = await crawl
+    except asyncio.CancelledError:
+        if not stopped:
+            raise
+        processed = crawler.total_processed
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+    if sender is not None:
+        # Let the last pages reach the index before exiting
+        page_queue.put_nowait(None)
+        await sender
+    return processed
+
+
+def merge_outputs(crawl_dir: Path, output_dir: Path, output_format: str, output_filename: str) -> List[Dict]:
+    """Merge the workers' pages into one output as a single crawl writes it, in frontier order."""
+    pages: Dict[int, Dict] = {}
+    for path in sorted((Path(crawl_dir) / 'pages').glob('*.jsonl')):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a worker killed while writing it
+                    continue
+                pages.setdefault(entry['id'], entry['page'])
+
+    writer = UDICrawler(start_urls=[], allowed_domains=[], output_dir=output_dir,
+                        output_format=output_format, output_filename=output_filename)
+    if output_format == 'jsonl':
+        (output_dir / f"{output_filename}.jsonl").unlink(missing_ok=True)
+    for id_ in sorted(pages):
+        writer.processed_pages.append(pages[id_])
+        writer.total_processed += 1
+        if output_format == 'jsonl':
+            writer.append_jsonl(pages[id_])
+    writer.save_intermediate_results()
+    print(f"Merged {writer.total_processed} pages into {output_dir / output_filename}.{output_format}")
+    return writer.processed_pages
+
+
+def run(crawl_dir: Path, domains: List[str], max_depth: int, workers: int, output_dir: Path,
+        output_format: str, output_filename: str, worker_args: List[str], journal_mode: str = 'wal') -> List[Dict]:
+    """Seed a crawl, run that many local worker processes on it, then merge their output."""
+    counts = seed(crawl_dir, domains, max_depth, journal_mode)
+    print(f"Crawl in {crawl_dir}: {counts}, starting {workers} workers")
+    command = [sys.executable, '-m', 'nordic_crawler.distributed', 'worker', '--crawl-dir', str(crawl_dir),
+               *worker_args]
+    processes = [subprocess.Popen(command) for _ in range(workers)]
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    frontier = Frontier(crawl_dir, journal_mode=journal_mode)
+    finished, counts = frontier.finished(), frontier.counts()
+    frontier.close()
+    if not finished:
+        print(f"Crawl stopped before the frontier was drained ({counts}), "
+              f"run again with the same --crawl-dir to resume")
+    else:
+        print(f"Crawl finished: {counts}")
+    return merge_outputs(crawl_dir, output_dir, output_format, output_filename)
+
+
+def main():
+    """Crawl with several processes sharing a persistent frontier."""
+    parser = argparse.ArgumentParser(description='Crawl Nordic government websites with several processes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Start a crawl (or resume it) with local worker processes')
+    run_parser.add_argument('--workers', type=int, default=4, help='Worker processes to start')
+    run_parser.add_argument('--max-depth', type=int, default=3, help='Maximum depth to crawl')
+    run_parser.add_argument('--domains', nargs='+', default=['udi.no'],
+                            help='List of domains to crawl (e.g., udi.no skatteetaten.no)')
+    run_parser.add_argument('--output-dir', type=Path, default=Path('output'),
+                            help='Output directory for crawled content')
+    run_parser.add_argument('--output-format', choices=['json', 'jsonl', 'markdown'], default='json',
+                            help='Output format')
+    run_parser.add_argument('--output-filename', default='nordic_distributed',
+                            help='Base name for output file (without extension)')
+    run_parser.add_argument('--network-fs', action='store_true',
+                            help='The crawl directory is shared with workers on other machines')
+
+    worker_parser = subparsers.add_parser('worker', help='Join a crawl started with run')
+    worker_parser.add_argument('--worker-id', help='Name of this worker (default: <hostname>-<pid>)')
+
+    merge_parser = subparsers.add_parser('merge', help="Merge the workers' pages into one output")
+    merge_parser.add_argument('--output-dir', type=Path, default=Path('output'),
+                              help='Output directory for crawled content')
+    merge_parser.add_argument('--output-format', choices=['json', 'jsonl', 'markdown'], default='json',
+                              help='Output format')
+    merge_parser.add_argument('--output-filename', default='nordic_distributed',
+                              help='Base name for output file (without extension)')
+
+    for sub in (run_parser, worker_parser, merge_parser):
+        sub.add_argument('--crawl-dir', type=Path, default=Path('output') / 'crawl',
+                         help='Frontier, seen-URL filter and per-worker pages')
+    for sub in (run_parser, worker_parser):
+        sub.add_argument('--batch-size', type=int, default=4, help='Pages each worker fetches at once')
+        sub.add_argument('--lease', type=float, default=300.0,
+                         help='Seconds before a URL claimed by an unresponsive worker is handed out again')
+        sub.add_argument('--ingest-url',
+                         help='Pipeline mode: send pages to this RAG server as they are crawled')
+        sub.add_argument('--archive-dir', type=Path,
+                         help='Raw page archive for reprocessing (default: <output-dir>/archive, output/archive for worker)')
+        sub.add_argument('--no-archive', action='store_true', help='Do not archive fetched pages')
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        merge_outputs(args.crawl_dir, args.output_dir, args.output_format, args.output_filename)
+    elif args.command == 'worker':
+        archive_dir = None if args.no_archive else args.archive_dir or Path('output') / 'archive'
+        asyncio.run(run_worker(args.crawl_dir, worker_id=args.worker_id, batch_size=args.batch_size,
+                               lease_seconds=args.lease, archive_dir=archive_dir, ingest_url=args.ingest_url))
+    else:
+        worker_args = ['--batch-size', str(args.batch_size), '--lease', str(args.lease)]
+        if args.ingest_url:
+            worker_args += ['--ingest-url', args.ingest_url]
+        if args.no_archive:
+            worker_args.append('--no-archive')
+        else:
+            worker_args += ['--archive-dir', str(args.archive_dir or args.output_dir / 'archive')]
+        run(args.crawl_dir, args.domains, args.max_depth, args.workers, args.output_dir, args.output_format,
+            args.output_filename, worker_args, journal_mode='delete' if args.network_fs else 'wal')
+
+
+if __name__ == "__main__":
+    main()
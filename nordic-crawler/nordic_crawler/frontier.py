@@ -0,0 +1,190 @@
+import hashlib
+import math
+import mmap
+import os
+import socket
+import sqlite3
+import struct
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+PENDING, LEASED, DONE, FAILED = 0, 1, 2, 3
+STATE_NAMES = {PENDING: 'pending', LEASED: 'leased', DONE: 'done', FAILED: 'failed'}
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class BloomFilter:
+    """Set of URLs in a memory-mapped bit array, shared by every process that opens the file.
+
+    Membership can be a false positive (at about error_rate once capacity URLs are added)
+    but never a false negative, except that two processes setting bits of the same byte
+    at once can lose one; a lost bit only costs the exact lookup it would have saved.
+    """
+
+    HEADER = struct.Struct('<8sQI')
+    MAGIC = b'NCBLOOM1'
+
+    def __init__(self, path: Path, capacity: int = 5_000_000, error_rate: float = 0.001):
+        self.path = Path(path)
+        if not self.path.exists():
+            self._create(capacity, error_rate)
+        self.file = open(self.path, 'r+b')
+        self.data = mmap.mmap(self.file.fileno(), 0)
+        magic, self.size, self.hashes = self.HEADER.unpack_from(self.data)
+        if magic != self.MAGIC:
+            raise ValueError(f"{self.path} is not a Bloom filter")
+
+    def _create(self, capacity: int, error_rate: float) -> None:
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2 / 8) * 8
+        hashes = max(1, round(size / capacity * math.log(2)))
+        # Built under a temporary name so no process maps a half-written header
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, size, hashes))
+            f.truncate(self.HEADER.size + size // 8)
+        os.replace(tmp, self.path)
+
+    def _positions(self, key: str) -> Iterable[int]:
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def __contains__(self, key: str) -> bool:
+        data, offset = self.data, self.HEADER.size
+        return all(data[offset + (pos >> 3)] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def add(self, key: str) -> None:
+        data, offset = self.data, self.HEADER.size
+        for pos in self._positions(key):
+            data[offset + (pos >> 3)] |= 1 << (pos & 7)
+
+    def close(self) -> None:
+        self.data.close()
+        self.file.close()
+
+
+class Frontier:
+    """Crawl frontier in SQLite shared by any number of crawler processes.
+
+    Every URL ever discovered is a row (url, depth, state). A worker claims a batch of
+    pending URLs, shallowest first, as a lease that expires after lease_seconds; an
+    expired lease (a crashed or stuck worker) makes the URL claimable again, up to
+    max_attempts claims. Discovered links are checked against a Bloom filter first:
+    a URL it has never seen is inserted right away, and only the filter's hits are
+    looked up in the table, in a read that doesn't wait for other workers' writes.
+
+    WAL journaling needs every process on one host; a frontier on a network filesystem
+    shared by several machines uses journal_mode='delete' instead.
+    """
+
+    def __init__(self, directory: Path, lease_seconds: float = 300.0, max_attempts: int = 3,
+                 capacity: int = 5_000_000, journal_mode: str = 'wal'):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Autocommit, with explicit BEGIN IMMEDIATE where a read must not race a write
+        self.db = sqlite3.connect(self.directory / 'frontier.sqlite', timeout=60.0, isolation_level=None)
+        self.db.execute(f'PRAGMA journal_mode={journal_mode}')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS urls (
+            id INTEGER PRIMARY KEY,
+            url TEXT NOT NULL UNIQUE,
+            depth INTEGER NOT NULL,
+            state INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS urls_claim ON urls (state, depth, id)')
+        self.seen = BloomFilter(self.directory / 'seen.bloom', capacity=capacity)
+
+    def add(self, urls: Iterable[str], depth: int) -> int:
+        """Queue the URLs not seen before at depth and return how many were new."""
+        fresh, maybe = [], []
+        for url in dict.fromkeys(urls):
+            (maybe if url in self.seen else fresh).append(url)
+        if maybe:
+            # Exact fallback for the filter's hits, most of them links already queued
+            known = set()
+            for i in range(0, len(maybe), 500):
+                batch = maybe[i:i + 500]
+                rows = self.db.execute(
+                    f"SELECT url FROM urls WHERE url IN ({','.join('?' * len(batch))})", batch)
+                known.update(url for url, in rows)
+            fresh.extend(url for url in maybe if url not in known)
+        if not fresh:
+            return 0
+        before = self.db.total_changes
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            # Another worker may have queued the same link since, the UNIQUE url keeps one
+            self.db.executemany('INSERT OR IGNORE INTO urls (url, depth) VALUES (?, ?)',
+                                ((url, depth) for url in fresh))
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        for url in fresh:
+            self.seen.add(url)
+        return self.db.total_changes - before
+
+    def claim(self, worker: str, n: int = 1) -> List[Tuple[int, str, int]]:
+        """Lease up to n pending URLs to worker, as (id, url, depth)."""
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            # Expired leases go back to pending, or fail after too many attempts
+            self.db.execute('UPDATE urls SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL '
+                            'WHERE state = ? AND lease_until < ?',
+                            (self.max_attempts, FAILED, PENDING, LEASED, now))
+            rows = self.db.execute('SELECT id, url, depth FROM urls WHERE state = ? ORDER BY depth, id LIMIT ?',
+                                   (PENDING, n)).fetchall()
+            self.db.executemany('UPDATE urls SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1 '
+                                'WHERE id = ?',
+                                ((LEASED, worker, now + self.lease_seconds, id_) for id_, _, _ in rows))
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        return rows
+
+    def complete(self, id_: int, worker: str) -> bool:
+        """Mark a leased URL done; False if the lease had expired and been taken over."""
+        cursor = self.db.execute('UPDATE urls SET state = ?, lease_until = NULL WHERE id = ? AND worker = ? AND state = ?',
+                                 (DONE, id_, worker, LEASED))
+        return cursor.rowcount == 1
+
+    def fail(self, id_: int, worker: str) -> None:
+        """Give a leased URL back for another attempt, or mark it failed after max_attempts."""
+        self.db.execute('UPDATE urls SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, '
+                        'lease_until = NULL WHERE id = ? AND worker = ? AND state = ?',
+                        (self.max_attempts, FAILED, PENDING, id_, worker, LEASED))
+
+    def release(self, worker: str) -> int:
+        """Return a worker's leases to pending without counting the attempt, e.g. on shutdown."""
+        cursor = self.db.execute('UPDATE urls SET state = ?, worker = NULL, lease_until = NULL, '
+                                 'attempts = attempts - 1 WHERE worker = ? AND state = ?',
+                                 (PENDING, worker, LEASED))
+        return cursor.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """Number of URLs per state."""
+        counts = {name: 0 for name in STATE_NAMES.values()}
+        for state, count in self.db.execute('SELECT state, COUNT(*) FROM urls GROUP BY state'):
+            counts[STATE_NAMES[state]] = count
+        return counts
+
+    def finished(self) -> bool:
+        """Whether no URL is pending or leased, so no worker can add more."""
+        return self.db.execute('SELECT 1 FROM urls WHERE state IN (?, ?) LIMIT 1',
+                               (PENDING, LEASED)).fetchone() is None
+
+    def close(self) -> None:
+        self.db.close()
+        self.seen.close()
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import math
+import re
+from collections import Counter, OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import numpy as np
+
+# Languages published on the crawled sites; restricting the model to these keeps it
+# small and avoids confusing Norwegian with languages that never occur
+LANGUAGES = ('no', 'sv', 'da', 'en', 'fi', 'de', 'fr', 'es', 'pl', 'lt', 'lv', 'et', 'ro',
+             'ru', 'uk', 'ar', 'fa', 'so', 'tr', 'vi')
+
+# First URL path segment -> language, e.g. udi.no/en/... or skatteetaten.no/nn/...
+PATH_LANGUAGES = {code: code for code in LANGUAGES}
+PATH_LANGUAGES.update({'nb': 'no', 'nn': 'no', 'nob': 'no', 'nno': 'no', 'eng': 'en', 'dk': 'da'})
+
+# Most frequent n-grams kept per language, by n-gram length
+TOP_NGRAMS = {1: 200, 2: 1500, 3: 3000}
+# A URL hint counts as this many times more likely a priori
+HINT_PRIOR = math.log(20)
+# Characters of a text looked at; more rarely changes the answer
+MAX_CHARS = 1000
+# Fewer letters than this is too little evidence, the hint (or unknown) is used instead
+MIN_LETTERS = 12
+
+_NON_LETTERS = re.compile(r'[\W\d_]+')
+
+
+def url_language_hint(url: Optional[str]) -> Optional[str]:
+    """Language named by the first path segment of url (/en, /no, /nb-no, ...), if any."""
+    if not url:
+        return None
+    segments = [s for s in urlparse(url).path.lower().split('/') if s]
+    if not segments:
+        return None
+    return PATH_LANGUAGES.get(segments[0]) or PATH_LANGUAGES.get(segments[0].split('-')[0])
+
+
+def _ngrams(text: str) -> List[str]:
+    grams = []
+    for word in _NON_LETTERS.sub(' ', text[:MAX_CHARS].lower()).split():
+        padded = f" {word} "
+        for n in (1, 2, 3):
+            grams.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return [g for g in grams if g.strip()]
+
+
+def _load_profiles(languages: Iterable[str]) -> Dict[str, dict]:
+    """The n-gram frequency profiles shipped with langdetect"""
+    import langdetect
+    directory = Path(langdetect.__file__).parent / 'profiles'
+    profiles = {}
+    for language in languages:
+        with open(directory / language, encoding='utf-8') as f:
+            profiles[language] = json.load(f)
+    return profiles
+
+
+class LanguageIdentifier:
+    """Deterministic character 1-3 gram naive Bayes language identification.
+
+    Built from langdetect's profiles, restricted to LANGUAGES and each profile's most
+    frequent n-grams, and scored in one pass with a small log-probability table. Results
+    are cached by content hash, so repeated sections (navigation, footers, notices) are
+    identified once.
+    """
+
+    def __init__(self, languages: Iterable[str] = LANGUAGES, cache_size: int = 65536):
+        profiles = _load_profiles(languages)
+        self.languages = list(profiles)
+        kept = {}
+        for language, profile in profiles.items():
+            for n, top in TOP_NGRAMS.items():
+                grams = [(g, c) for g, c in profile['freq'].items() if len(g) == n]
+                grams.sort(key=lambda item: -item[1])
+                kept[language, n] = dict(grams[:top])
+        vocabulary = sorted({g for grams in kept.values() for g in grams})
+        self.index = {g: i for i, g in enumerate(vocabulary)}
+        # Log-probability of each n-gram per language; n-grams a language does not keep
+        # get half a count
+        lengths = np.array([len(g) for g in vocabulary])
+        self.weights = np.zeros((len(vocabulary), len(self.languages)), dtype=np.float32)
+        for column, language in enumerate(self.languages):
+            n_words = np.array(profiles[language]['n_words'], dtype=np.float64)
+            self.weights[:, column] = np.log(0.5 / n_words[lengths - 1])
+            for n in TOP_NGRAMS:
+                for g, count in kept[language, n].items():
+                    self.weights[self.index[g], column] = math.log(count / n_words[n - 1])
+        self.cache: 'OrderedDict[Tuple[bytes, Optional[str]], str]' = OrderedDict()
+        self.cache_size = cache_size
+
+    def scores(self, text: str, hint: Optional[str] = None) -> Dict[str, float]:
+        """Log-likelihood of text per language, plus the hint prior"""
+        rows = [self.index[g] for g in _ngrams(text) if g in self.index]
+        totals = self.weights[rows].sum(axis=0) if rows else np.zeros(len(self.languages), dtype=np.float32)
+        scores = {language: float(total) for language, total in zip(self.languages, totals)}
+        if hint in scores:
+            scores[hint] += HINT_PRIOR
+        return scores
+
+    def _detect(self, text: str, hint: Optional[str]) -> str:
+        if len(_NON_LETTERS.sub('', text[:MAX_CHARS])) < MIN_LETTERS:
+            return hint or 'unknown'
+        scores = self.scores(text, hint)
+        return max(scores, key=scores.get)
+
+    def detect(self, text: str, hint: Optional[str] = None) -> str:
+        """Language code of text; hint (e.g. from url_language_hint) breaks near-ties."""
+        key = (hashlib.blake2b(text[:MAX_CHARS].encode('utf-8'), digest_size=12).digest(), hint)
+        language = self.cache.get(key)
+        if language is not None:
+            self.cache.move_to_end(key)
+            return language
+        language = self._detect(text, hint)
+        self.cache[key] = language
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return language
+
+
+def page_language(sections: List[Dict]) -> str:
+    """Language of most of a page's text, from its sections' languages."""
+    weights = Counter()
+    for section in sections:
+        if section.get('language', 'unknown') != 'unknown':
+            weights[section['language']] += len(section.get('content', ''))
+    return weights.most_common(1)[0][0] if weights else 'unknown'
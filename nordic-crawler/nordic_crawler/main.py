@@ -8,8 +8,9 @@ from crawl4ai import AsyncWebCrawler
 import re
 import datetime
 import argparse
-from langdetect import detect
-from langdetect.lang_detect_exception import LangDetectException
+from nordic_crawler.archive import PageArchive
+from nordic_crawler.langid import LanguageIdentifier, url_language_hint, page_language
+from nordic_crawler.pipeline import start_pipeline
 
 class UDICrawler:
     def __init__(self, 
@@ -18,19 +19,27 @@ class UDICrawler:
                  max_depth: int = 3, 
                  output_dir: Path = Path('output'),
                  output_format: str = 'json',
-                 output_filename: str = None):
+                 output_filename: str = None,
+                 page_queue: Optional[asyncio.Queue] = None,
+                 archive: Optional[PageArchive] = None):
         self.start_urls = start_urls
         self.allowed_domains = allowed_domains
         self.max_depth = max_depth
         self.output_dir = output_dir
         self.output_dir.mkdir(exist_ok=True)
         self.output_format = output_format.lower()
-        if self.output_format not in ['json', 'markdown']:
-            raise ValueError("output_format must be either 'json' or 'markdown'")
+        if self.output_format not in ['json', 'jsonl', 'markdown']:
+            raise ValueError("output_format must be 'json', 'jsonl' or 'markdown'")
         
         # Set default output filename if none provided
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         self.output_filename = output_filename or f"nordic_pages_{timestamp}"
+
+        # Pipeline mode: each processed page's records are also put on this queue
+        self.page_queue = page_queue
+
+        # Raw HTML of every fetched page, for re-running extraction (see reprocess.py)
+        self.archive = archive
         
         # URL tracking
         self.visited_urls: Set[str] = set()
@@ -43,6 +52,9 @@ class UDICrawler:
         
         # Save intermediate state periodically
         self.save_interval = 5  # Save every 5 pages
+
+        # Per-section language identification, cached by content hash
+        self.language_id = LanguageIdentifier()
     
     def normalize_url(self, url: str) -> str:
         """Normalize URL to prevent duplicates with different formats."""
@@ -95,7 +107,6 @@ class UDICrawler:
             # Only include URLs we should crawl
             if self.should_crawl_url(normalized_url):
                 links.add(normalized_url)
-                self.found_urls.add(normalized_url)
         
         return links
     
@@ -225,7 +236,6 @@ class UDICrawler:
         sections = []
         current_heading = None
         current_content = []
-        all_text = title_text + "\n"  # Start with title for language detection
         
         for element in main_content.find_all(['h2', 'h3', 'p', 'ul', 'ol', 'div']):
             if self.should_skip_element(element):
@@ -242,14 +252,15 @@ class UDICrawler:
                             if not any(clean_text_content.startswith(h['heading']) for h in sections):
                                 clean_content.append(clean_text_content)
                                 seen_content.add(clean_text_content)
-                                all_text += clean_text_content + "\n"
                     
                     if clean_content:
                         combined_content = '\n'.join(clean_content)
                         cleaned_combined_content = self.clean_text(combined_content)
+                        heading_text = self.extract_content(current_heading)
                         sections.append({
-                            'heading': self.extract_content(current_heading),
-                            'content': cleaned_combined_content
+                            'heading': heading_text,
+                            'content': cleaned_combined_content,
+                            'language': self.detect_language(f"{heading_text}\n{cleaned_combined_content}", url)
                         })
                 
                 current_heading = element
@@ -280,41 +291,31 @@ class UDICrawler:
                     if not any(clean_text_content.startswith(h['heading']) for h in sections):
                         clean_content.append(clean_text_content)
                         seen_content.add(clean_text_content)
-                        all_text += clean_text_content + "\n"
             
             if clean_content:
                 combined_content = '\n'.join(clean_content)
                 cleaned_combined_content = self.clean_text(combined_content)
+                heading_text = self.extract_content(current_heading)
                 sections.append({
-                    'heading': self.extract_content(current_heading),
-                    'content': cleaned_combined_content
+                    'heading': heading_text,
+                    'content': cleaned_combined_content,
+                    'language': self.detect_language(f"{heading_text}\n{cleaned_combined_content}", url)
                 })
         
         if not sections:
             return None
 
-        # Detect language from all collected text
-        language = self.detect_language(all_text)
-            
         return {
             'url': url,
             'title': title_text,
             'sections': sections,
-            'language': language
+            # The language of most of the page's text
+            'language': page_language(sections)
         }
     
-    def detect_language(self, content: str) -> str:
-        """Detect the language of the given text content."""
-        try:
-            # Combine a reasonable amount of text for better language detection
-            return detect(content[:10000])  # Use first 10000 chars for faster processing
-        except LangDetectException:
-            # If language detection fails, try to determine from URL
-            if '/no/' in content:
-                return 'no'
-            elif '/en/' in content:
-                return 'en'
-            return 'unknown'
+    def detect_language(self, content: str, url: Optional[str] = None) -> str:
+        """Detect the language of a section, with the URL's language path as a prior."""
+        return self.language_id.detect(content, url_language_hint(url))
 
     def save_page(self, page: Dict):
         """Save a single page to files."""
@@ -342,7 +343,7 @@ class UDICrawler:
                 'metadata': {
                     'type': 'nordic_guide',
                     'source': 'nordic government websites',
-                    'language': page['language']
+                    'language': section.get('language', page['language'])
                 }
             })
         
@@ -353,29 +354,41 @@ class UDICrawler:
         if self.total_processed % self.save_interval == 0:
             self.save_intermediate_results()
     
+    def page_records(self, page: Dict) -> List[Dict]:
+        """RAG records for a page, one per section."""
+        return [{
+            'url': page['url'],
+            'title': page['title'],
+            'heading': section['heading'],
+            'content': section['content'],
+            'metadata': {
+                'type': 'nordic_guide',
+                'source': 'nordic government websites',
+                'language': section.get('language', page.get('language', 'unknown'))
+            }
+        } for section in page['sections']]
+
+    def append_jsonl(self, page: Dict):
+        """Append a page's records to the JSON Lines output as soon as it is processed."""
+        with open(self.output_dir / f"{self.output_filename}.jsonl", 'a', encoding='utf-8') as f:
+            for record in self.page_records(page):
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
     def save_intermediate_results(self):
         """Save current results to files."""
         if not self.processed_pages:
             return
 
         # Save in the specified format
+        if self.output_format == 'jsonl':
+            # Already appended page by page
+            return
         if self.output_format == 'json':
             output_file = self.output_dir / f"{self.output_filename}.json"
             # Convert to RAG format
             rag_documents = []
             for page in self.processed_pages:
-                for section in page['sections']:
-                    rag_documents.append({
-                        'url': page['url'],
-                        'title': page['title'],
-                        'heading': section['heading'],
-                        'content': section['content'],
-                        'metadata': {
-                            'type': 'nordic_guide',
-                            'source': 'nordic government websites',
-                            'language': page.get('language', 'unknown')
-                        }
-                    })
+                rag_documents.extend(self.page_records(page))
             with open(output_file, 'w', encoding='utf-8') as f:
                 json.dump(rag_documents, f, ensure_ascii=False, indent=2)
         else:  # markdown
@@ -405,10 +418,14 @@ class UDICrawler:
             if not result or not result.html:
                 print(f"Failed to fetch content from {url}")
                 return
+
+            if self.archive is not None:
+                self.archive.put(url, result.html)
             
             # Extract and follow links if not at max depth
             if depth < self.max_depth:
                 links = self.extract_links(result.html, url)
+                self.found_urls.update(links)
                 for link in links:
                     await self.crawl_url(link, depth + 1, crawler)
             
@@ -418,6 +435,10 @@ class UDICrawler:
                 if content:
                     self.processed_pages.append(content)
                     self.total_processed += 1
+                    if self.output_format == 'jsonl':
+                        self.append_jsonl(content)
+                    if self.page_queue is not None:
+                        self.page_queue.put_nowait(self.page_records(content))
                     print(f"Successfully processed page {self.total_processed} of {len(self.found_urls)}")
                     
                     # Save intermediate results periodically
@@ -438,6 +459,24 @@ class UDICrawler:
             
             return self.processed_pages
 
+# Map domains to their start URLs
+DOMAIN_URLS = {
+    'udi.no': ['https://udi.no/en', 'https://udi.no/no'],
+    'skatteetaten.no': ['https://www.skatteetaten.no/en/', 'https://www.skatteetaten.no/no/']
+}
+
+def start_urls_for(domains: List[str]) -> List[str]:
+    """Collect start URLs for selected domains."""
+    start_urls = []
+    for domain in domains:
+        if domain in DOMAIN_URLS:
+            start_urls.extend(DOMAIN_URLS[domain])
+        else:
+            print(f"Warning: No predefined URLs for domain {domain}")
+            # Add a default URL pattern
+            start_urls.extend([f'https://www.{domain}', f'https://{domain}'])
+    return start_urls
+
 async def async_main():
     """Entry point for the crawler."""
     parser = argparse.ArgumentParser(description='Crawl Nordic government websites')
@@ -445,42 +484,43 @@ async def async_main():
                       help='Maximum depth to crawl')
     parser.add_argument('--output-dir', type=Path, default=Path('output'),
                       help='Output directory for crawled content')
-    parser.add_argument('--output-format', choices=['json', 'markdown'], 
+    parser.add_argument('--output-format', choices=['json', 'jsonl', 'markdown'], 
                       default='json', help='Output format')
     parser.add_argument('--output-filename', 
                       help='Base name for output file (without extension)')
     parser.add_argument('--domains', nargs='+', default=['udi.no'],
                       help='List of domains to crawl (e.g., udi.no skatteetaten.no)')
+    parser.add_argument('--ingest-url',
+                      help='Pipeline mode: send pages to this RAG server as they are crawled')
+    parser.add_argument('--archive-dir', type=Path,
+                      help='Raw page archive for reprocessing (default: <output-dir>/archive)')
+    parser.add_argument('--no-archive', action='store_true',
+                      help='Do not archive fetched pages')
     
     args = parser.parse_args()
     
-    # Map domains to their start URLs
-    domain_urls = {
-        'udi.no': ['https://udi.no/en', 'https://udi.no/no'],
-        'skatteetaten.no': ['https://www.skatteetaten.no/en/', 'https://www.skatteetaten.no/no/']
-    }
-    
-    # Collect start URLs for selected domains
-    start_urls = []
-    for domain in args.domains:
-        if domain in domain_urls:
-            start_urls.extend(domain_urls[domain])
-        else:
-            print(f"Warning: No predefined URLs for domain {domain}")
-            # Add a default URL pattern
-            start_urls.extend([f'https://www.{domain}', f'https://{domain}'])
+    start_urls = start_urls_for(args.domains)
     
+    page_queue, sender = start_pipeline(args.ingest_url)
+
     crawler = UDICrawler(
         start_urls=start_urls,
         allowed_domains=args.domains,
         max_depth=args.max_depth,
         output_dir=args.output_dir,
         output_format=args.output_format,
-        output_filename=args.output_filename
+        output_filename=args.output_filename,
+        page_queue=page_queue,
+        archive=None if args.no_archive else PageArchive(args.archive_dir or args.output_dir / 'archive')
     )
     
     await crawler.crawl()
 
+    if sender is not None:
+        # Let the last pages reach the index before exiting
+        page_queue.put_nowait(None)
+        await sender
+
 def main():
     """Entry point for the crawler."""
     asyncio.run(async_main())
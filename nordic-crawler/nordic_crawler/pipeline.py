@@ -0,0 +1,53 @@
+import asyncio
+import json
+import time
+import urllib.request
+from typing import Dict, List, Optional
+
+
+def post_records(ingest_url: str, records: List[Dict], timeout: float = 60.0) -> Dict:
+    """Send a batch of RAG records to the RAG server's /ingest endpoint."""
+    body = json.dumps({'records': records}, ensure_ascii=False).encode('utf-8')
+    request = urllib.request.Request(f"{ingest_url.rstrip('/')}/ingest", data=body,
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.load(response)
+
+
+async def send_pages(queue: asyncio.Queue, ingest_url: str, interval: float = 1.0, max_records: int = 200) -> None:
+    """Forward pages from the crawler's queue to the RAG server as they arrive.
+
+    Each queue item is the list of records of one page; None ends the stream. Pages
+    arriving within interval seconds are sent together, so pages become searchable
+    about a second after extraction while the crawl carries on.
+    """
+    done = False
+    while not done:
+        page = await queue.get()
+        if page is None:
+            break
+        batch = list(page)
+        deadline = time.monotonic() + interval
+        while len(batch) < max_records:
+            try:
+                page = await asyncio.wait_for(queue.get(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                break
+            if page is None:
+                done = True
+                break
+            batch.extend(page)
+        try:
+            result = await asyncio.to_thread(post_records, ingest_url, batch)
+            print(f"Ingested {result['pages']} pages ({result['chunks']} chunks), "
+                  f"{result['live_chunks']} live chunks")
+        except Exception as e:
+            print(f"Failed to ingest {len(batch)} records: {e}")
+
+
+def start_pipeline(ingest_url: Optional[str]):
+    """Queue and sender task for pipeline mode, or (None, None) without an ingest URL."""
+    if not ingest_url:
+        return None, None
+    queue = asyncio.Queue()
+    return queue, asyncio.create_task(send_pages(queue, ingest_url))
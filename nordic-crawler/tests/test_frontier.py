@@ -0,0 +1,110 @@
+import pytest
+from nordic_crawler import frontier as frontier_module
+from nordic_crawler.frontier import BloomFilter, Frontier
+
+URLS = [f"https://www.udi.no/page-{i}" for i in range(5)]
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(frontier_module.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def frontier(tmp_path, clock):
+    frontier = Frontier(tmp_path, lease_seconds=60, max_attempts=2, capacity=1000)
+    yield frontier
+    frontier.close()
+
+
+def test_add_queues_each_url_once(frontier):
+    assert frontier.add(URLS, 0) == 5
+    assert frontier.add(URLS[:2] + ["https://www.udi.no/new"], 1) == 1
+    assert frontier.counts() == {'pending': 6, 'leased': 0, 'done': 0, 'failed': 0}
+
+
+def test_claim_is_shallowest_first_and_exclusive(frontier):
+    frontier.add(URLS[2:], 1)
+    frontier.add(URLS[:2], 0)
+    first = frontier.claim('a', 3)
+    assert [url for _, url, _ in first] == [URLS[0], URLS[1], URLS[2]]
+    second = frontier.claim('b', 5)
+    assert [url for _, url, _ in second] == URLS[3:]
+    assert frontier.claim('c', 5) == []
+    for id_, _, _ in first:
+        assert frontier.complete(id_, 'a')
+    assert not frontier.finished()
+    for id_, _, _ in second:
+        assert frontier.complete(id_, 'b')
+    assert frontier.finished()
+
+
+def test_expired_lease_is_claimable_again(frontier, clock):
+    frontier.add(URLS[:1], 0)
+    [(id_, url, _)] = frontier.claim('a')
+    clock.now += 30
+    assert frontier.claim('b') == []
+    clock.now += 31
+    assert frontier.claim('b') == [(id_, url, 0)]
+    # The first worker's lease was taken over, so its late result doesn't count
+    assert not frontier.complete(id_, 'a')
+    assert frontier.complete(id_, 'b')
+    assert frontier.counts()['done'] == 1
+
+
+def test_url_fails_after_max_attempts(frontier, clock):
+    frontier.add(URLS[:2], 0)
+    (first, _, _), (second, _, _) = frontier.claim('a', 2)
+    # Attempts end either by an expired lease or by the worker failing the URL
+    frontier.fail(first, 'a')
+    clock.now += 61
+    assert sorted(id_ for id_, _, _ in frontier.claim('b', 2)) == [first, second]
+    frontier.fail(first, 'b')
+    clock.now += 61
+    assert frontier.claim('c', 2) == []
+    assert frontier.counts() == {'pending': 0, 'leased': 0, 'done': 0, 'failed': 2}
+    assert frontier.finished()
+
+
+def test_release_returns_leases_without_counting_the_attempt(frontier):
+    frontier.add(URLS[:2], 0)
+    claimed = frontier.claim('a', 2)
+    assert frontier.release('a') == 2
+    assert frontier.release('a') == 0
+    assert frontier.counts()['pending'] == 2
+    # Released twice without using up an attempt, so still claimable
+    frontier.claim('b', 2)
+    frontier.release('b')
+    assert sorted(frontier.claim('c', 2)) == sorted(claimed)
+
+
+def test_state_is_shared_across_connections(tmp_path, clock):
+    first = Frontier(tmp_path, capacity=1000)
+    first.add(URLS, 0)
+    first.claim('a', 2)
+    first.close()
+    second = Frontier(tmp_path, capacity=1000)
+    assert second.add(URLS, 0) == 0
+    assert second.counts() == {'pending': 3, 'leased': 2, 'done': 0, 'failed': 0}
+    second.close()
+
+
+def test_bloom_filter_persists(tmp_path):
+    seen = BloomFilter(tmp_path / 'seen.bloom', capacity=1000)
+    for url in URLS:
+        seen.add(url)
+    seen.close()
+    seen = BloomFilter(tmp_path / 'seen.bloom', capacity=1000)
+    assert all(url in seen for url in URLS)
+    assert sum(f"https://www.udi.no/other-{i}" in seen for i in range(1000)) < 20
+    seen.close()
@@ -0,0 +1,66 @@
+import pytest
+from nordic_crawler.langid import LanguageIdentifier, page_language, url_language_hint
+
+
+@pytest.fixture(scope='module')
+def identifier():
+    return LanguageIdentifier()
+
+
+@pytest.mark.parametrize('text, language', [
+    ('Søk om oppholdstillatelse', 'no'),
+    ('Informasjon om skatt', 'no'),
+    ('Apply for a residence permit', 'en'),
+    ('Ansök om uppehållstillstånd', 'sv'),
+    ('Ansøg om opholdstilladelse', 'da'),
+    ('Antrag auf Aufenthaltserlaubnis', 'de'),
+])
+def test_short_text(identifier, text, language):
+    assert identifier.detect(text) == language
+
+
+@pytest.mark.parametrize('text', ['Hei', 'Om oss', 'Skatt', '12 345 678', ''])
+def test_too_little_text_falls_back_to_hint(identifier, text):
+    assert identifier.detect(text) == 'unknown'
+    assert identifier.detect(text, 'no') == 'no'
+    assert identifier.detect(text, 'en') == 'en'
+
+
+def test_hint_breaks_near_ties(identifier):
+    assert identifier.detect('Hjem og familie') == 'da'
+    assert identifier.detect('Hjem og familie', 'no') == 'no'
+    assert identifier.detect('Skatten din her') == 'sv'
+    assert identifier.detect('Skatten din her', 'no') == 'no'
+
+
+def test_hint_does_not_override_clear_text(identifier):
+    assert identifier.detect('Apply for a residence permit', 'no') == 'en'
+    assert identifier.detect('Søk om oppholdstillatelse', url_language_hint('https://www.udi.no/en/')) == 'no'
+
+
+def test_cache_is_keyed_by_hint(identifier):
+    assert identifier.detect('Hjem og familie', 'no') == 'no'
+    assert identifier.detect('Hjem og familie') == 'da'
+    assert identifier.detect('Hjem og familie', 'no') == 'no'
+
+
+@pytest.mark.parametrize('url, language', [
+    ('https://www.udi.no/en/want-to-apply/', 'en'),
+    ('https://www.skatteetaten.no/nb-no/person/', 'no'),
+    ('https://www.skatteetaten.no/nn/person/', 'no'),
+    ('https://www.udi.no/', None),
+    ('https://www.udi.no/ord-og-begreper/', None),
+    (None, None),
+])
+def test_url_language_hint(url, language):
+    assert url_language_hint(url) == language
+
+
+def test_page_language_weights_sections_by_length():
+    sections = [
+        {'language': 'en', 'content': 'Short English menu'},
+        {'language': 'no', 'content': 'En lengre norsk tekst om oppholdstillatelse og arbeid i Norge'},
+        {'language': 'unknown', 'content': 'x' * 500},
+    ]
+    assert page_language(sections) == 'no'
+    assert page_language([{'language': 'unknown', 'content': 'x'}]) == 'unknown'
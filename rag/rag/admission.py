@@ -0,0 +1,168 @@
+"""Admission control for calls to rate-limited upstreams (the LLM, the reranker).
+
+Each upstream gets a Gate admitting a bounded number of concurrent calls. Further
+calls wait in a priority queue, interactive chat ahead of bulk work such as source
+translation, for at most their priority's queue timeout. When the queue is full a
+call is rejected right away (or displaces a queued call of lower priority), so under
+a burst the server answers some requests quickly and sheds the rest with a
+Retry-After estimate, instead of slowing every request down until all time out.
+
+A slot is held until the thread making the call returns, not just until the request
+that made it gives up, since a thread can't be cancelled and its call still loads the
+upstream.
+
+Queue depth, calls in flight, queue wait and sheds are exported in /metrics as
+rag_admission_queue_depth, rag_admission_in_flight, rag_admission_wait_seconds and
+rag_admission_shed_total.
+"""
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from rag.tracing import registry
+
+INTERACTIVE, BULK = 0, 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+
+class Overloaded(Exception):
+    """A call shed by a Gate: 429 when its queue was full, 503 when it waited too long"""
+    def __init__(self, upstream, reason, status, retry_after):
+        super().__init__(f"{upstream} is overloaded ({reason}), retry after {retry_after}s")
+        self.upstream = upstream
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Gate:
+    def __init__(self, name, limit, queue_limit, queue_timeouts):
+        self.name = name
+        self.limit = limit
+        self.queue_limit = queue_limit
+        # Seconds a call may wait for a slot, by priority
+        self.queue_timeouts = queue_timeouts
+        self.active = 0
+        # Heap of [priority, arrival, future]; a waiter is handed its slot through the future
+        self.waiters = []
+        self.arrivals = itertools.count()
+        # Moving average of call duration, for Retry-After
+        self.service_time = 1.0
+        self._metrics()
+
+    def _metrics(self):
+        registry.set("rag_admission_queue_depth", len(self.waiters), upstream=self.name)
+        registry.set("rag_admission_in_flight", self.active, upstream=self.name)
+
+    def retry_after(self):
+        """Seconds until the queue has likely drained, 1 to 60"""
+        seconds = (len(self.waiters) + 1) * self.service_time / self.limit
+        return max(1, min(60, math.ceil(seconds)))
+
+    def _shed(self, priority, reason, status):
+        registry.inc("rag_admission_shed", upstream=self.name, priority=PRIORITY_NAMES[priority], reason=reason)
+        return Overloaded(self.name, reason, status, self.retry_after())
+
+    def idle(self):
+        """Whether a call would be admitted without waiting"""
+        return self.active < self.limit and not self.waiters
+
+    def check(self, priority=INTERACTIVE):
+        """Raise Overloaded if a call of priority would be rejected outright"""
+        if self.idle() or len(self.waiters) < self.queue_limit:
+            return
+        # A full queue only admits a call that can displace one of lower priority
+        if not self.waiters or max(self.waiters)[0] <= priority:
+            raise self._shed(priority, "queue_full", 429)
+
+    def _remove(self, entry):
+        if entry in self.waiters:
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+
+    async def acquire(self, priority=INTERACTIVE):
+        if self.idle():
+            self.active += 1
+            registry.observe("rag_admission_wait_seconds", 0.0, upstream=self.name, priority=PRIORITY_NAMES[priority])
+            self._metrics()
+            return
+        self.check(priority)
+        if len(self.waiters) >= self.queue_limit:
+            # The youngest of the lowest-priority waiters gives way
+            worst = max(self.waiters)
+            self._remove(worst)
+            worst[2].set_exception(self._shed(worst[0], "displaced", 429))
+        entry = [priority, next(self.arrivals), asyncio.get_running_loop().create_future()]
+        heapq.heappush(self.waiters, entry)
+        self._metrics()
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(entry[2], self.queue_timeouts[priority])
+        except asyncio.TimeoutError:
+            self._remove(entry)
+            raise self._shed(priority, "queue_timeout", 503) from None
+        except BaseException:
+            self._remove(entry)
+            future = entry[2]
+            # Cancelled just after being handed a slot: pass it on
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release()
+            raise
+        finally:
+            registry.observe("rag_admission_wait_seconds", time.monotonic() - start,
+                             upstream=self.name, priority=PRIORITY_NAMES[priority])
+            self._metrics()
+
+    def release(self, seconds=None):
+        if seconds is not None:
+            self.service_time = 0.8 * self.service_time + 0.2 * seconds
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                # The slot passes straight to the waiter, so active stays the same
+                future.set_result(None)
+                self._metrics()
+                return
+        self.active -= 1
+        self._metrics()
+
+    def _release_after(self, pending, start):
+        if not pending.cancelled():
+            # Retrieved here, the caller that would have raised it is gone
+            pending.exception()
+        self.release(time.monotonic() - start)
+
+    @asynccontextmanager
+    async def admit(self, priority=INTERACTIVE):
+        """Hold one of the upstream's slots, waiting in the queue if all are taken.
+
+        Yields a Slot to run the upstream call with, so that the slot stays taken until
+        the call's thread returns even when the caller is cancelled or times out first.
+        """
+        await self.acquire(priority)
+        start = time.monotonic()
+        slot = Slot()
+        try:
+            yield slot
+        finally:
+            if slot.pending is None or slot.pending.done():
+                self.release(time.monotonic() - start)
+            else:
+                slot.pending.add_done_callback(lambda pending: self._release_after(pending, start))
+
+
+class Slot:
+    """A call admitted by a Gate"""
+    def __init__(self):
+        self.pending = None
+
+    def start(self, func, *args, **kwargs):
+        """Start func in a thread and return its future; the slot is held until it is done"""
+        self.pending = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+        return self.pending
+
+    async def run(self, func, *args, **kwargs):
+        """Run func in a thread; cancelling this leaves the thread, and the slot, to finish"""
+        return await asyncio.shield(self.start(func, *args, **kwargs))
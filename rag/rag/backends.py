@@ -0,0 +1,83 @@
+"""CPU inference backends for the query encoder.
+
+Encoding one short query through the fp32 PyTorch model is the largest local cost
+of a query on CPU-only hosts. These backends trade a little accuracy for speed:
+
+    torch      fp32 PyTorch (the default, and what passages are encoded with)
+    int8       PyTorch with Linear layers dynamically quantized to int8
+    onnx       ONNX Runtime, exported from the model on first use
+    onnx-int8  ONNX Runtime with dynamically int8-quantized weights
+
+Only queries are encoded with the selected backend; the index keeps its fp32
+passage embeddings. Check the agreement before switching with
+
+    poetry run python -m rag.bench --model intfloat/multilingual-e5-large --backends int8 onnx onnx-int8
+"""
+import os
+import time
+
+BACKENDS = ("torch", "int8", "onnx", "onnx-int8")
+# Exported and quantized ONNX models are kept here, keyed by model name
+ONNX_CACHE = os.path.expanduser(os.environ.get("RAG_ONNX_CACHE", "~/.cache/rag/onnx"))
+# Quantization config for onnx-int8: arm64, avx2, avx512 or avx512_vnni, matching the host CPU
+ONNX_QUANTIZATION = os.environ.get("RAG_ONNX_QUANTIZATION", "avx2")
+
+WARM_UP_QUERIES = [
+    "query: hei",
+    "query: hvordan søker jeg om oppholdstillatelse?",
+    "query: what documents do I need to register a new address with the tax office after moving?",
+]
+
+
+def _onnx_kwargs(threads):
+    if not threads:
+        return {}
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    return {"session_options": options}
+
+
+def _onnx_int8(model, threads):
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+    path = os.path.join(ONNX_CACHE, model.replace("/", "--"))
+    file_name = f"onnx/model_qint8_{ONNX_QUANTIZATION}.onnx"
+    if not os.path.exists(os.path.join(path, file_name)):
+        print(f"Quantizing {model} for ONNX Runtime into {path}")
+        exported = SentenceTransformer(model, backend="onnx")
+        exported.save(path)
+        export_dynamic_quantized_onnx_model(exported, ONNX_QUANTIZATION, path)
+    return SentenceTransformer(path, backend="onnx", model_kwargs={"file_name": file_name, **_onnx_kwargs(threads)})
+
+
+def load_encoder(model, backend="torch", threads=None):
+    """A SentenceTransformer for model running on backend, with threads intra-op
+    threads (default: the runtime's choice)"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend!r}, expected one of {list(BACKENDS)}")
+    from sentence_transformers import SentenceTransformer
+    start = time.perf_counter()
+    if backend in ("torch", "int8"):
+        import torch
+        if threads:
+            torch.set_num_threads(threads)
+        encoder = SentenceTransformer(model, device="cpu")
+        if backend == "int8":
+            encoder = torch.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == "onnx":
+        encoder = SentenceTransformer(model, backend="onnx", model_kwargs=_onnx_kwargs(threads))
+    else:
+        encoder = _onnx_int8(model, threads)
+    print(f"Loaded {model} on {backend} in {time.perf_counter() - start:.1f}s")
+    return encoder
+
+
+def warm_up(encoder, rounds=2):
+    """Run a few queries of different lengths so that the first real query does not
+    pay for lazy initialisation and allocation"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in WARM_UP_QUERIES:
+            encoder.encode(text, normalize_embeddings=True)
+    print(f"Warmed up query encoder in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,291 @@
+"""Offline retrieval benchmark for RagDatabase.
+
+Builds a database from a fixture corpus (or a synthetic one), then measures encode
+throughput, query latency, index memory and recall@k for every index mode:
+
+    poetry run python -m rag.bench --corpus data/test --output bench.json
+    poetry run python -m rag.bench --synthetic 20000 --baseline bench.json
+
+With --backends, query encoder backends (see rag.backends) are also checked against
+the fp32 query embeddings: cosine agreement, recall@k and top-k overlap.
+
+The embedding model must already be in the local Hugging Face cache (or be a local
+path); the hub is never contacted.
+"""
+import os
+
+# Must be set before sentence_transformers / huggingface_hub are imported
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+import argparse
+import glob
+import html
+import json
+import random
+import re
+import resource
+import time
+import numpy as np
+from rag.db import RagDatabase
+from rag.chunks import Document
+from rag.index import build_index, INDEX_MODES
+from rag.backends import BACKENDS, load_encoder, warm_up
+
+DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+_MARKUP_RE = re.compile(r"<(script|style)\b.*?</\1>|<[^>]+>", re.S | re.I)
+
+
+def load_corpus(data_dir, min_length=100):
+    """Fixture files: first line is the URL, the rest markdown, text or HTML"""
+    documents = []
+    for filename in sorted(glob.glob(os.path.join(data_dir, "**", "*"), recursive=True)):
+        if not os.path.isfile(filename):
+            continue
+        with open(filename, "r", encoding="utf-8") as f:
+            url = next(f).strip()
+            text = f.read()
+        if "<html" in text.lower():
+            text = html.unescape(_MARKUP_RE.sub("\n", text))
+        paragraphs = [" ".join(p.split()) for p in re.split(r"\n\s*\n", text)]
+        documents.append(Document(url, [p for p in paragraphs if len(p) >= min_length]))
+    return documents
+
+
+def synthetic_corpus(n_chunks, chunks_per_doc=10, seed=0):
+    """Topic-clustered pseudo-text so that queries have a well-defined answer"""
+    rng = random.Random(seed)
+    syllables = ["ka", "ve", "lo", "ri", "sun", "dal", "mor", "ten", "bi", "fjo", "ra", "hus", "ne", "sk", "at"]
+    vocabulary = list({"".join(rng.choices(syllables, k=rng.randint(2, 4))) for _ in range(5000)})
+    topics = [rng.sample(vocabulary, 200) for _ in range(max(1, n_chunks // 50))]
+    documents = []
+    for d in range(0, n_chunks, chunks_per_doc):
+        chunks = []
+        for _ in range(min(chunks_per_doc, n_chunks - d)):
+            topic = rng.choice(topics)
+            words = rng.choices(topic, k=rng.randint(40, 80)) + rng.choices(vocabulary, k=10)
+            rng.shuffle(words)
+            chunks.append(" ".join(words))
+        documents.append(Document(f"https://synthetic.example/{d // chunks_per_doc}", chunks))
+    return documents
+
+
+def _chunk_rows(db):
+    rows = {}
+    for row in range(len(db.table)):
+        rows.setdefault(db.table.chunk(row).strip(), set()).add(row)
+    return rows
+
+
+def sample_labels(db, n_queries, seed=0):
+    """Use a window of words from a random chunk as the query, that chunk as the answer"""
+    rng = random.Random(seed)
+    rows_by_chunk = _chunk_rows(db)
+    labels = []
+    for row in rng.sample(range(len(db)), min(n_queries, len(db))):
+        chunk = db.table.chunk(row)
+        words = chunk.split()
+        size = min(len(words), rng.randint(8, 14))
+        start = rng.randint(0, len(words) - size)
+        labels.append((" ".join(words[start:start + size]), rows_by_chunk[chunk.strip()]))
+    return labels
+
+
+def load_labels(db, path):
+    """JSONL of {"query": ..., "chunk": ...} where chunk is a substring of the relevant chunk(s)"""
+    rows_by_chunk = _chunk_rows(db)
+    labels = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            rows = set().union(*(r for text, r in rows_by_chunk.items() if item["chunk"] in text))
+            if rows:
+                labels.append((item["query"], rows))
+            else:
+                print(f"Skipping label with no matching chunk: {item['query']!r}")
+    return labels
+
+
+def latency_summary(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {
+        "mean": float(ms.mean()),
+        "p50": float(np.percentile(ms, 50)),
+        "p95": float(np.percentile(ms, 95)),
+        "p99": float(np.percentile(ms, 99)),
+    }
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(args):
+    db = RagDatabase(model=args.model)
+    if args.synthetic:
+        db.documents = synthetic_corpus(args.synthetic, seed=args.seed)
+        corpus = f"synthetic:{args.synthetic}"
+    else:
+        db.documents = load_corpus(args.corpus)
+        corpus = args.corpus
+
+    start = time.perf_counter()
+    db.encode()
+    encode_seconds = time.perf_counter() - start
+    n_chunks = len(db)
+    if not n_chunks:
+        raise SystemExit(f"No chunks ingested from {corpus}")
+
+    labels = load_labels(db, args.labels) if args.labels else sample_labels(db, args.queries, seed=args.seed)
+    encode_latency = []
+    query_vectors = []
+    for query, _ in labels:
+        start = time.perf_counter()
+        query_vectors.append(db.encode_query(query))
+        encode_latency.append(time.perf_counter() - start)
+
+    ks = sorted(set(args.k))
+    max_k = max(ks)
+    results = {
+        "corpus": corpus,
+        "model": args.model,
+        "documents": len(db.documents),
+        "chunks": n_chunks,
+        "queries": len(labels),
+        "encode": {
+            "seconds": encode_seconds,
+            "chunks_per_second": n_chunks / encode_seconds,
+            "embedding_bytes": int(db.embeddings.nbytes),
+        },
+        "query_encode_ms": latency_summary(encode_latency),
+        "modes": {},
+    }
+
+    exact_top = None
+    for mode in args.modes:
+        start = time.perf_counter()
+        index = build_index(db.embeddings, mode)
+        build_seconds = time.perf_counter() - start
+
+        latency = []
+        top = []
+        for vector in query_vectors:
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                _, rows = index.search(vector, max_k)
+                latency.append(time.perf_counter() - start)
+            top.append(rows.tolist())
+
+        recall = {
+            f"recall@{k}": float(np.mean([bool(relevant & set(rows[:k])) for rows, (_, relevant) in zip(top, labels)]))
+            for k in ks
+        }
+        summary = {
+            "build_seconds": build_seconds,
+            "index_bytes": int(index.nbytes),
+            "search_ms": latency_summary(latency),
+            **recall,
+        }
+        if mode == "exact":
+            exact_top = top
+        elif exact_top is not None:
+            summary[f"overlap_with_exact@{max_k}"] = float(np.mean([
+                len(set(a) & set(b)) / max(len(b), 1) for a, b in zip(top, exact_top)
+            ]))
+        results["modes"][mode] = summary
+        print(f"{mode:>10}: p95 {summary['search_ms']['p95']:.3f}ms, {summary['index_bytes'] / 2**20:.1f}MiB, "
+              + ", ".join(f"{k} {v:.3f}" for k, v in recall.items()))
+
+    if args.backends:
+        results["backends"] = validate_backends(db, labels, query_vectors, args.backends, ks, args.model, args.threads)
+
+    results["max_rss_mb"] = max_rss_mb()
+    return results
+
+
+def validate_backends(db, labels, reference, backends, ks, model, threads=None):
+    """Agreement of each query encoder backend with the fp32 query embeddings, all
+    searched against the same fp32 passage embeddings"""
+    index = build_index(db.embeddings, "exact")
+    max_k = max(ks)
+    reference = np.asarray(reference, dtype=np.float32)
+    reference_top = [index.search(vector, max_k)[1].tolist() for vector in reference]
+    summaries = {}
+    for backend in backends:
+        encoder = load_encoder(model, backend, threads)
+        warm_up(encoder)
+        vectors = []
+        latency = []
+        for query, _ in labels:
+            start = time.perf_counter()
+            vectors.append(encoder.encode(f"query: {query}", normalize_embeddings=True))
+            latency.append(time.perf_counter() - start)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        cosine = np.sum(vectors * reference, axis=1)
+        top = [index.search(vector, max_k)[1].tolist() for vector in vectors]
+        summary = {
+            "query_encode_ms": latency_summary(latency),
+            "cosine_mean": float(cosine.mean()),
+            "cosine_min": float(cosine.min()),
+        }
+        for k in ks:
+            summary[f"recall@{k}"] = float(np.mean([bool(relevant & set(rows[:k])) for rows, (_, relevant) in zip(top, labels)]))
+            summary[f"overlap_with_fp32@{k}"] = float(np.mean([
+                len(set(a[:k]) & set(b[:k])) / max(len(b[:k]), 1) for a, b in zip(top, reference_top)
+            ]))
+        summaries[backend] = summary
+        print(f"{backend:>10}: p95 {summary['query_encode_ms']['p95']:.2f}ms, cosine mean {summary['cosine_mean']:.4f} "
+              f"min {summary['cosine_min']:.4f}, overlap@{max_k} {summary[f'overlap_with_fp32@{max_k}']:.3f}")
+    return summaries
+
+
+def compare(results, baseline):
+    """Print relative changes in latency and recall against a previous run"""
+    for mode, summary in results["modes"].items():
+        before = baseline.get("modes", {}).get(mode)
+        if not before:
+            continue
+        p95, old_p95 = summary["search_ms"]["p95"], before["search_ms"]["p95"]
+        print(f"{mode:>10}: p95 {old_p95:.3f} -> {p95:.3f}ms ({(p95 / old_p95 - 1) * 100:+.1f}%)")
+        for key, value in summary.items():
+            if key.startswith("recall@") and key in before:
+                print(f"{'':>10}  {key} {before[key]:.3f} -> {value:.3f}")
+    for backend, summary in results.get("backends", {}).items():
+        before = baseline.get("backends", {}).get(backend)
+        if not before:
+            continue
+        p95, old_p95 = summary["query_encode_ms"]["p95"], before["query_encode_ms"]["p95"]
+        print(f"{backend:>10}: query encode p95 {old_p95:.2f} -> {p95:.2f}ms ({(p95 / old_p95 - 1) * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline retrieval benchmark for RagDatabase")
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(__file__), "..", "data", "test"),
+                        help="Fixture directory, one document per file with its URL on the first line")
+    parser.add_argument("--synthetic", type=int, help="Use a synthetic corpus with this many chunks instead")
+    parser.add_argument("--labels", help="JSONL of labelled query/chunk pairs (default: sampled from the corpus)")
+    parser.add_argument("--queries", type=int, default=200, help="Number of sampled queries")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Local embedding model name or path")
+    parser.add_argument("--modes", nargs="+", default=list(INDEX_MODES), choices=list(INDEX_MODES))
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--repeat", type=int, default=3, help="Timed searches per query")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backends", nargs="+", default=[], choices=list(BACKENDS),
+                        help="Query encoder backends to validate against the fp32 query embeddings")
+    parser.add_argument("--threads", type=int, help="Intra-op threads for the validated backends")
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--baseline", help="Previous results JSON to compare against")
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
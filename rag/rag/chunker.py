@@ -0,0 +1,87 @@
+"""Split crawled sections into embedding-sized chunks.
+
+Chunks never cross a section boundary, except that sections too short to stand on
+their own are folded into the next section of the same page. Lengths are counted
+in whitespace-separated words, which is close enough to model tokens for sizing.
+"""
+import re
+
+_PARAGRAPH_RE = re.compile(r"\n\s*\n|\n")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def count_tokens(text):
+    return len(text.split())
+
+
+def _units(text, target_tokens):
+    """Paragraphs, with those over target_tokens broken into sentences and word windows"""
+    for paragraph in _PARAGRAPH_RE.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph) <= target_tokens:
+            yield paragraph
+            continue
+        for sentence in _SENTENCE_RE.split(paragraph):
+            words = sentence.split()
+            for start in range(0, len(words), target_tokens):
+                yield " ".join(words[start:start + target_tokens])
+
+
+class Chunker:
+    def __init__(self, target_tokens=200, overlap_tokens=30, min_tokens=20):
+        self.target_tokens = target_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_tokens = min_tokens
+
+    def split(self, text):
+        """Pack the units of one section into chunks of about target_tokens, overlapping by
+        up to overlap_tokens of whole trailing units"""
+        chunks = []
+        current, size = [], 0
+        for unit in _units(text, self.target_tokens):
+            tokens = count_tokens(unit)
+            if current and size + tokens > self.target_tokens:
+                chunks.append("\n\n".join(current))
+                overlap, overlap_size = [], 0
+                for previous in reversed(current):
+                    previous_tokens = count_tokens(previous)
+                    if overlap_size + previous_tokens > self.overlap_tokens:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_size += previous_tokens
+                # Never carry over so much that the new unit would not fit
+                while overlap and overlap_size + tokens > self.target_tokens:
+                    overlap_size -= count_tokens(overlap.pop(0))
+                current, size = overlap, overlap_size
+            current.append(unit)
+            size += tokens
+        if current:
+            chunks.append("\n\n".join(current))
+        return chunks
+
+    def chunk_page(self, sections):
+        """(heading, chunk) pairs for a page's (heading, content) sections, in order"""
+        chunks = []
+        carry_heading, carry = None, []
+        for heading, content in sections:
+            content = (content or "").strip()
+            if not content:
+                continue
+            if carry:
+                content = "\n\n".join(carry + [content])
+                heading = heading or carry_heading
+                carry_heading, carry = None, []
+            if count_tokens(content) < self.min_tokens:
+                # Too short to embed on its own, fold it into the next section
+                carry_heading, carry = heading, [content]
+                continue
+            chunks.extend((heading, chunk) for chunk in self.split(content))
+        if carry:
+            last = "\n\n".join(carry)
+            if chunks and count_tokens(chunks[-1][1]) + count_tokens(last) <= self.target_tokens:
+                chunks[-1] = (chunks[-1][0], chunks[-1][1] + "\n\n" + last)
+            else:
+                chunks.append((carry_heading, last))
+        return chunks
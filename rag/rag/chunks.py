@@ -0,0 +1,344 @@
+"""Columnar chunk storage.
+
+All chunk text lives in one UTF-8 buffer sliced by an offsets array, and rows point
+into the document, URL and heading lists through int32 columns. Each row is one
+unique chunk text: pages repeating a chunk (menus, legal notices, shared boilerplate)
+add to the row's posting list of documents instead of adding a row, so the vector
+and lexical indexes hold every text once. The arrays pickle compactly and can be
+memory-mapped from an exported index version, so loading does not rebuild an object
+per chunk.
+"""
+import os
+import hashlib
+import numpy as np
+from rag import tracing
+from rag.filters import active_filters, document_matches, filter_key
+from rag.roadmap import find_spans, spans_to_facets, text_facets
+
+
+def chunk_id(url, chunk):
+    """Stable identifier of a chunk, derived from its URL and text"""
+    return hashlib.sha1(f"{url}\n{chunk.strip()}".encode("utf-8")).hexdigest()[:16]
+
+
+def clean_chunk(chunk):
+    for s in ['Start editortext']:
+        chunk = chunk.replace(s,'').strip()
+    return chunk
+
+
+def passage_text(heading, chunk):
+    """Text embedded and indexed for a chunk: its section heading and content"""
+    return f"{heading}: {chunk}" if heading else chunk
+
+
+class Document:
+    # Defaults for documents pickled before metadata was kept
+    title = None
+    headings = None
+    metadata = {}
+
+    def __init__(self, url, chunks, title=None, headings=None, metadata=None):
+        self.url = url
+        self.chunks = chunks
+        self.title = title
+        # Section heading of each chunk, aligned with chunks
+        self.headings = headings
+        # Page-level crawler metadata: language, type, source
+        self.metadata = metadata or {}
+
+    def heading(self, i):
+        return self.headings[i] if self.headings else None
+
+    def __repr__(self):
+        return f"<Document: {len(self.chunks)} chunks from {self.url!r}>"
+
+    def __hash__(self):
+        return hash(self.url)
+
+    def __eq__(self, other):
+        return self.url == other.url
+
+
+def text_key(chunk):
+    """64-bit hash of a chunk's stripped text, equal for duplicate chunks"""
+    return int.from_bytes(hashlib.sha1(chunk.strip().encode("utf-8")).digest()[:8], "little")
+
+
+# Column name -> file in an index version
+COLUMNS = {
+    "offsets": "chunk_offsets",
+    "heading_ids": "chunk_headings",
+    "posting_offsets": "chunk_postings",
+    "doc_ids": "chunk_docs",
+    "url_ids": "chunk_urls",
+    "ids": "chunk_ids",
+    "roadmap_offsets": "chunk_roadmap_offsets",
+    "roadmap_kinds": "chunk_roadmap_kinds",
+    "roadmap_spans": "chunk_roadmap_spans",
+}
+
+
+def pack_spans(spans):
+    """Roadmap columns (offsets, kinds, spans) of per-row (kind, start, end) lists"""
+    offsets = np.zeros(len(spans) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in spans], out=offsets[1:])
+    flat = [span for row in spans for span in row]
+    kinds = np.array([kind for kind, _, _ in flat], dtype=np.uint8)
+    bounds = np.array([(start, end) for _, start, end in flat], dtype=np.int32).reshape(-1, 2)
+    return offsets, kinds, bounds
+
+
+class ChunkView:
+    """One row of a ChunkTable"""
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def text(self):
+        return self.table.chunk(self.row)
+
+    @property
+    def document(self):
+        return self.table.document(self.row)
+
+    @property
+    def url(self):
+        return self.document.url
+
+    @property
+    def urls(self):
+        return self.table.chunk_urls(self.row)
+
+    @property
+    def heading(self):
+        return self.table.heading(self.row)
+
+    @property
+    def id(self):
+        return self.table.ids[self.table.posting_offsets[self.row]].decode("ascii")
+
+    @property
+    def passage(self):
+        return passage_text(self.heading, self.text)
+
+    def __repr__(self):
+        return f"<Chunk {self.row} from {self.url!r}>"
+
+
+class ChunkTable:
+    def __init__(self, text, offsets, heading_ids, posting_offsets, doc_ids, url_ids, ids, documents, urls, headings,
+                 roadmap_offsets=None, roadmap_kinds=None, roadmap_spans=None):
+        self.text = text  # uint8 UTF-8 buffer, row i is text[offsets[i]:offsets[i+1]]
+        self.offsets = offsets
+        self.heading_ids = heading_ids  # heading where the text first appeared, -1 without one
+        # Postings: row i appeared in documents doc_ids[posting_offsets[i]:posting_offsets[i+1]],
+        # first occurrence first, with the URL id and stable chunk id (see chunk_id) of each
+        self.posting_offsets = posting_offsets
+        self.doc_ids = doc_ids
+        self.url_ids = url_ids
+        self.ids = ids
+        self.documents = documents  # Documents without chunks: url, title, metadata
+        self.urls = urls
+        self.headings = headings
+        # Roadmap facets (see rag.roadmap): row i has kinds and character spans into its
+        # text roadmap_kinds/roadmap_spans[roadmap_offsets[i]:roadmap_offsets[i+1]]
+        self.roadmap_offsets = roadmap_offsets
+        self.roadmap_kinds = roadmap_kinds
+        self.roadmap_spans = roadmap_spans
+        self.rows_by_id = None
+        # filter_key -> whether each row has a document passing the filters
+        self.matching = {}
+
+    @classmethod
+    def from_documents(cls, documents, index, collapse=True):
+        """Pack the (document, chunk) rows of ingested Documents, one row per unique
+        text unless collapse is off"""
+        rows_by_key, postings = {}, []
+        texts, heading_ids, spans = [], [], []
+        packed_docs, doc_map, urls, url_map, headings, heading_map = [], {}, [], {}, [], {}
+        for di, ci in index:
+            doc = documents[di]
+            if di not in doc_map:
+                doc_map[di] = len(packed_docs)
+                packed_docs.append(Document(doc.url, [], title=doc.title, metadata=doc.metadata))
+            if doc.url not in url_map:
+                url_map[doc.url] = len(urls)
+                urls.append(doc.url)
+            chunk = doc.chunks[ci]
+            key = text_key(chunk)
+            row = rows_by_key.get(key) if collapse else None
+            if row is None:
+                row = len(texts)
+                rows_by_key[key] = row
+                texts.append(chunk.encode("utf-8"))
+                spans.append(find_spans(chunk))
+                postings.append([])
+                heading = doc.heading(ci)
+                if heading is not None and heading not in heading_map:
+                    heading_map[heading] = len(headings)
+                    headings.append(heading)
+                heading_ids.append(heading_map[heading] if heading is not None else -1)
+            postings[row].append((doc_map[di], url_map[doc.url], chunk_id(doc.url, chunk)))
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([len(data) for data in texts], out=offsets[1:])
+        posting_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([len(entries) for entries in postings], out=posting_offsets[1:])
+        flat = [entry for entries in postings for entry in entries]
+        return cls(
+            np.frombuffer(b"".join(texts), dtype=np.uint8), offsets, np.array(heading_ids, dtype=np.int32), posting_offsets,
+            np.array([doc for doc, _, _ in flat], dtype=np.int32), np.array([url for _, url, _ in flat], dtype=np.int32),
+            np.array([cid.encode("ascii") for _, _, cid in flat], dtype="S16"), packed_docs, urls, headings,
+            *pack_spans(spans),
+        )
+
+    def __len__(self):
+        return len(self.heading_ids)
+
+    def __getitem__(self, row):
+        return ChunkView(self, row)
+
+    def __iter__(self):
+        return (ChunkView(self, row) for row in range(len(self)))
+
+    def posting_rows(self):
+        """Row of every posting, aligned with doc_ids"""
+        return np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.posting_offsets))
+
+    def chunk(self, row):
+        return self.text[self.offsets[row]:self.offsets[row + 1]].tobytes().decode("utf-8")
+
+    def matching_rows(self, rows, filters):
+        """Those of rows (selected by Partitions, so passing each filtered field through
+        some document) with one document passing every filter"""
+        if rows is None or len(active_filters(filters)) < 2:
+            return rows
+        key = filter_key(filters)
+        matching = self.matching.get(key)
+        if matching is None:
+            with tracing.span("filter_documents"):
+                doc_matches = np.array([document_matches(doc, filters) for doc in self.documents], dtype=bool)
+                matching = np.zeros(len(self), dtype=bool)
+                if len(self):
+                    matching = np.logical_or.reduceat(doc_matches[np.asarray(self.doc_ids)],
+                                                      np.asarray(self.posting_offsets[:-1]))
+            # Filters come from a handful of UI options, so this stays small
+            if len(self.matching) < 1024:
+                self.matching[key] = matching
+        return rows[matching[rows]]
+
+    def document(self, row, filters=None):
+        """Document the text first appeared in, or the first one passing filters"""
+        start, end = self.posting_offsets[row], self.posting_offsets[row + 1]
+        if filters and end - start > 1:
+            for doc_id in self.doc_ids[start:end].tolist():
+                if document_matches(self.documents[doc_id], filters):
+                    return self.documents[doc_id]
+        return self.documents[self.doc_ids[start]]
+
+    def chunk_urls(self, row):
+        """Every URL the text appeared on"""
+        start, end = self.posting_offsets[row], self.posting_offsets[row + 1]
+        return list(dict.fromkeys(self.urls[url] for url in self.url_ids[start:end].tolist()))
+
+    def heading(self, row):
+        heading = self.heading_ids[row]
+        return self.headings[heading] if heading >= 0 else None
+
+    def passage(self, row):
+        return passage_text(self.heading(row), self.chunk(row))
+
+    def roadmap(self, row):
+        """{kind: [text]} roadmap facets of a row"""
+        if self.roadmap_offsets is None:
+            # Tables built before facets were tagged at ingest time
+            return text_facets(self.chunk(row))
+        start, end = self.roadmap_offsets[row], self.roadmap_offsets[row + 1]
+        if start == end:
+            return {}
+        spans = zip(self.roadmap_kinds[start:end].tolist(), *self.roadmap_spans[start:end].T.tolist())
+        return spans_to_facets(self.chunk(row), spans)
+
+    def sources(self, rows, filters=None):
+        """(document, chunk) per row"""
+        return [(self.document(row, filters), self.chunk(row)) for row in rows]
+
+    def _posting(self, cid):
+        """(posting, row) of a chunk id, or None"""
+        if self.rows_by_id is None:
+            rows_by_id = {}
+            for posting, key in enumerate(self.ids.tolist()):
+                rows_by_id.setdefault(key.decode("ascii"), posting)
+            self.rows_by_id = rows_by_id
+        posting = self.rows_by_id.get(cid)
+        if posting is None:
+            return None
+        return posting, int(np.searchsorted(self.posting_offsets, posting, side="right")) - 1
+
+    def get_chunk(self, cid):
+        """(doc, chunk, heading) for a chunk id, or None"""
+        found = self._posting(cid)
+        if found is None:
+            return None
+        posting, row = found
+        return self.documents[self.doc_ids[posting]], self.chunk(row), self.heading(row)
+
+    def get_roadmap(self, cid):
+        """Roadmap facets of a chunk id, or None"""
+        found = self._posting(cid)
+        return self.roadmap(found[1]) if found is not None else None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["rows_by_id"] = None
+        state["matching"] = {}
+        return state
+
+    def __setstate__(self, state):
+        # Tables pickled before duplicates were collapsed have one posting per row
+        if "posting_offsets" not in state:
+            state["posting_offsets"] = np.arange(len(state["heading_ids"]) + 1, dtype=np.int64)
+            state.pop("canonical", None)
+        for column in ("roadmap_offsets", "roadmap_kinds", "roadmap_spans"):
+            state.setdefault(column, None)
+        state["matching"] = {}
+        self.__dict__.update(state)
+
+    def meta(self):
+        return {
+            "documents": [{"url": doc.url, "title": doc.title, "metadata": doc.metadata} for doc in self.documents],
+            "urls": self.urls,
+            "headings": self.headings,
+        }
+
+    def save(self, directory):
+        with open(os.path.join(directory, "chunks.bin"), "wb") as f:
+            f.write(np.asarray(self.text).tobytes())
+        for column, name in COLUMNS.items():
+            if getattr(self, column) is not None:
+                np.save(os.path.join(directory, f"{name}.npy"), np.asarray(getattr(self, column)))
+
+    @classmethod
+    def load(cls, directory, meta):
+        """Memory-map the chunk table of an index version"""
+        columns = {}
+        for column, name in COLUMNS.items():
+            if os.path.exists(os.path.join(directory, f"{name}.npy")):
+                columns[column] = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+        if columns["offsets"][-1]:
+            text = np.memmap(os.path.join(directory, "chunks.bin"), dtype=np.uint8, mode="r")
+        else:
+            text = np.zeros(0, dtype=np.uint8)
+        # Versions exported before duplicates were collapsed have one posting per row,
+        # and before the chunk table one document per URL. Without roadmap columns the
+        # facets are found when looked up.
+        columns.setdefault("posting_offsets", np.arange(len(columns["heading_ids"]) + 1, dtype=np.int64))
+        columns.setdefault("doc_ids", columns["url_ids"])
+        documents = [
+            Document(doc["url"] if "url" in doc else meta["urls"][i], [], title=doc["title"], metadata=doc["metadata"])
+            for i, doc in enumerate(meta["documents"])
+        ]
+        return cls(text, documents=documents, urls=meta["urls"], headings=meta["headings"], **columns)
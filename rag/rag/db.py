@@ -1,40 +1,139 @@
 import os
-import json
+import re
+import math
 import numpy as np
 from sentence_transformers import SentenceTransformer
 import glob
-import torch
-from collections import defaultdict
+from collections import defaultdict, Counter
 import cohere
 import pickle
+from rag import tracing
+from rag.index import build_index
+from rag.chunker import Chunker
+from rag.filters import Partitions
+from rag.records import iter_records, iter_pages
+from rag.chunks import ChunkTable, Document, clean_chunk
 
 def _get_paragraphs(content, min_length=100):
     paragraphs = [para.strip() for para in content.split("\n\n") if len(para.strip()) >= min_length]
     return paragraphs
 
 
-class Document:
-    def __init__(self, url, chunks):
-        self.url = url
-        self.chunks = chunks
+_TOKEN_RE = re.compile(r"\w+")
 
-    def __repr__(self):
-        return f"<Document: {len(self.chunks)} chunks from {self.url!r}>"
+def _tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
 
-    def __hash__(self):
-        return hash(self.url)
 
-    def __eq__(self, other):
-        return self.url == other.url
+class LexicalIndex:
+    """Okapi BM25 over the encoded chunks, keyed by row in RagDatabase.table"""
+    # Default for indexes pickled before it was kept
+    total_length = None
+
+    def __init__(self, texts, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        postings = defaultdict(list)
+        self.lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = _tokenize(text)
+            self.lengths[row] = len(tokens)
+            for token, tf in Counter(tokens).items():
+                postings[token].append((row, tf))
+        # Flat posting arrays, token i owns rows[offsets[i]:offsets[i+1]]
+        self.vocabulary = {}
+        rows, tfs, offsets = [], [], [0]
+        for token, entries in postings.items():
+            self.vocabulary[token] = len(self.vocabulary)
+            rows.extend(row for row, _ in entries)
+            tfs.extend(tf for _, tf in entries)
+            offsets.append(len(rows))
+        self.rows = np.array(rows, dtype=np.int32)
+        self.tfs = np.array(tfs, dtype=np.float32)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.total_length = float(self.lengths.sum())
+        self.avg_length = max(float(self.lengths.mean()), 1.0) if len(texts) else 1.0
+
+    def arrays(self):
+        return {"lengths": self.lengths, "rows": self.rows, "tfs": self.tfs, "offsets": self.offsets}
+
+    @classmethod
+    def from_arrays(cls, arrays, vocabulary, k1=1.5, b=0.75):
+        index = cls.__new__(cls)
+        index.k1 = k1
+        index.b = b
+        index.vocabulary = vocabulary
+        for name in ("lengths", "rows", "tfs", "offsets"):
+            setattr(index, name, arrays[name])
+        index.total_length = float(index.lengths.sum())
+        index.avg_length = max(float(index.lengths.mean()), 1.0) if len(index.lengths) else 1.0
+        return index
+
+    def stats(self, query):
+        """Corpus size, total length and document frequency of each query token; summed
+        over the shards of a sharded index they give every shard the global BM25 statistics"""
+        df = {}
+        for token in set(_tokenize(query)):
+            token_id = self.vocabulary.get(token)
+            df[token] = int(self.offsets[token_id + 1] - self.offsets[token_id]) if token_id is not None else 0
+        if self.total_length is None:
+            self.total_length = float(self.lengths.sum())
+        return {"n": len(self.lengths), "length": self.total_length, "df": df}
+
+    def scored_search(self, query, k=10, rows=None, corpus=None):
+        """(rows, scores) of the top k rows by BM25, among rows (sorted) when given;
+        corpus (see stats) replaces this index's own statistics"""
+        n = corpus["n"] if corpus else len(self.lengths)
+        avg_length = max(corpus["length"] / max(n, 1), 1.0) if corpus else self.avg_length
+        scores = np.zeros(len(self.lengths), dtype=np.float32)
+        for token in set(_tokenize(query)):
+            token_id = self.vocabulary.get(token)
+            if token_id is None:
+                continue
+            start, end = self.offsets[token_id], self.offsets[token_id + 1]
+            matches, tfs = self.rows[start:end], self.tfs[start:end]
+            df = corpus["df"].get(token, len(matches)) if corpus else len(matches)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[matches] / avg_length)
+            scores[matches] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+        if rows is not None:
+            top = rows[np.argsort(-scores[rows])[:k]]
+        else:
+            top = np.argsort(-scores)[:k]
+        top = top[scores[top] > 0]
+        return top, scores[top]
+
+    def search(self, query, k=10, rows=None):
+        """Top k rows by BM25, among rows (sorted) when given"""
+        return self.scored_search(query, k, rows)[0].tolist()
 
 
 class RagDatabase:
-    def __init__(self, model="intfloat/multilingual-e5-large"):
+    def __init__(self, model="intfloat/multilingual-e5-large", index_mode="exact"):
         self.model = model
         self.st = SentenceTransformer(model)
+        # Ingested Documents; encode() packs their chunks into self.table
         self.documents = []
         self.embeddings = None
-        self.index = []
+        self.table = None
+        self.index_mode = index_mode
+        self.vectors = None
+        self.lexical = None
+        self.partitions = None
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Pickles from before the chunk table kept every Document and a (doc, chunk) row index.
+        # Their embeddings have a row per chunk, so duplicates stay until the next encode()
+        index = state.get("index")
+        if getattr(self, "table", None) is None and index is not None:
+            self.table = ChunkTable.from_documents(self.documents, index, collapse=False)
+            self.documents = self.table.documents
+        self.__dict__.pop("index", None)
+        self.__dict__.pop("rows_by_id", None)
+
+    def __len__(self):
+        return len(self.table) if self.table is not None else 0
 
     def ingest(self, data_dir):
         self.documents = []
@@ -45,69 +144,151 @@ class RagDatabase:
                 self.documents.append(doc)
                 print(f"Ingested {doc}")
 
-    def ingest_json(self, json_path):
-        by_url = defaultdict(list)
-        with open(json_path) as f:
-            chunks = json.load(f)
-            for chunk in chunks:
-                by_url[chunk["url"]].append(f"{chunk['content']}: {chunk['content']}")
-        self.documents = [Document(url=url, chunks=chunks) for url, chunks in by_url.items()]
-
-    def encode(self):
-        chunks = []
-        self.index = []
+    def ingest_json(self, json_path, chunker=None):
+        """Ingest crawler output (JSON array or JSON Lines): one record per page section
+        with url, title, heading, content and metadata"""
+        chunker = chunker or Chunker()
+        self.documents = []
+        for page in iter_pages(iter_records(json_path)):
+            chunked = chunker.chunk_page(page["sections"])
+            self.documents.append(Document(
+                page["url"],
+                [chunk for _, chunk in chunked],
+                title=page["title"],
+                headings=[heading for heading, _ in chunked],
+                metadata=page["metadata"],
+            ))
+        print(f"Ingested {len(self.documents)} pages, {sum(len(doc.chunks) for doc in self.documents)} chunks")
+
+    def encode(self, min_length=100):
+        index = []
+        skipped = 0
         for i, document in enumerate(self.documents):
             for j, chunk in enumerate(document.chunks):
-                # clean
-                for s in ['Start editortext']:
-                    chunk = chunk.replace(s,'').strip()
-                if len(chunk) < 100:
+                chunk = clean_chunk(chunk)
+                if len(chunk) < min_length:
+                    skipped += 1
                     continue
                 document.chunks[j] = chunk
-                chunks.append(f"passage: {chunk}")
-                self.index.append((i, j))
+                index.append((i, j))
+        n_documents = len(self.documents)
+        # One row per unique text, so duplicates are neither embedded nor take up top-k slots
+        self.table = ChunkTable.from_documents(self.documents, index)
+        # The table holds the chunk text now, so only chunkless Documents are kept
+        self.documents = self.table.documents
+        chunks = [f"passage: {self.table.passage(row)}" for row in range(len(self.table))]
         self.embeddings = self.st.encode(chunks, normalize_embeddings=True, show_progress_bar=True)
-        print(f"Encoded {len(self.documents)} docs, {len(chunks)} chunks -> {self.embeddings.shape} embeddings")
+        self.build_vector_index()
+        self.build_lexical_index()
+        self.build_partitions()
+        print(f"Encoded {n_documents} docs, {len(chunks)} chunks -> {self.embeddings.shape} embeddings")
+        if len(index) > len(chunks):
+            print(f"Collapsed {len(index) - len(chunks)} duplicate chunks")
+        if skipped:
+            print(f"Skipped {skipped} chunks shorter than {min_length} characters")
+
+    def build_vector_index(self, mode=None):
+        self.index_mode = mode or getattr(self, "index_mode", "exact")
+        self.vectors = build_index(self.embeddings, self.index_mode)
+
+    def build_lexical_index(self):
+        self.lexical = LexicalIndex([self.table.passage(row) for row in range(len(self.table))])
+
+    def build_partitions(self):
+        self.partitions = Partitions.from_documents(self.table.documents, self.table.doc_ids, self.table.posting_rows())
 
-    def query(self, query, k=10):
+    def filter_rows(self, filters):
+        """Rows matching filters ({field: value or values}), None when unfiltered"""
+        if not filters:
+            return None
+        # Pickles from before filtering was added are partitioned lazily
+        if getattr(self, "partitions", None) is None:
+            self.build_partitions()
+        return self.table.matching_rows(self.partitions.select(filters), filters)
+
+    def get_chunk(self, cid):
+        """(doc, chunk, heading) for a chunk id, or None"""
+        return self.table.get_chunk(cid)
+
+    def get_roadmap(self, cid):
+        """Roadmap facets (see rag.roadmap) of a chunk id, or None"""
+        return self.table.get_roadmap(cid)
+
+    def _sources(self, rows, filters=None):
+        return self.table.sources(rows, filters)
+
+    def encode_query(self, query):
+        with tracing.span("encode"):
+            return self.st.encode(f"query: {query}", normalize_embeddings=True)
+
+    def search(self, encoded_query, k=10, filters=None):
         if self.embeddings is None:
             raise ValueError("Not initialized")
-        encoded_query = self.st.encode(f"query: {query}", normalize=True)
+        # Pickles from before vector indexes were added are indexed lazily
+        if getattr(self, "vectors", None) is None:
+            self.build_vector_index()
+        scores, rows = self.vectors.search(encoded_query, k, rows=self.filter_rows(filters))
+        return self._sources(rows.tolist(), filters)
+
+    def lexical_query(self, query, k=10, filters=None):
+        if self.embeddings is None:
+            raise ValueError("Not initialized")
+        # Pickles from before the lexical index was added are indexed lazily
+        if getattr(self, "lexical", None) is None:
+            self.build_lexical_index()
+        rows = self.filter_rows(filters)
+        with tracing.span("lexical"):
+            return self._sources(self.lexical.search(query, k, rows=rows), filters)
+
+    def query(self, query, k=10, filters=None):
         print(f"Running query {query!r}")
-        similarity_scores = self.st.similarity(self.embeddings, encoded_query).squeeze()
-        scores, indices = torch.topk(similarity_scores, k=min(k,len(similarity_scores)))
-
-        chunks = []
-        done = set()
-        for i in indices:
-            di, ci = self.index[i]
-            doc = self.documents[di]
-            chunk = self.documents[di].chunks[ci]
-            if chunk.strip() not in done:
-                chunks.append((self.documents[di], chunk))
-                done.add(chunk.strip())
-        return chunks
+        return self.search(self.encode_query(query), k, filters)
+
+
+def unique_sources(sources):
+    chunks = []
+    done = set()
+    for doc, chunk in sources:
+        if chunk.strip() not in done:
+            chunks.append((doc, chunk))
+            done.add(chunk.strip())
+    return chunks
+
+
+def fuse_results(*results, k=10, c=60):
+    """Reciprocal rank fusion of several (doc, chunk) result lists"""
+    scores = defaultdict(float)
+    sources = {}
+    for result in results:
+        for rank, (doc, chunk) in enumerate(result):
+            key = chunk.strip()
+            scores[key] += 1 / (c + rank + 1)
+            sources.setdefault(key, (doc, chunk))
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [sources[key] for key in ranked[:k]]
 
 def rerank(question, sources, k):
     co = cohere.ClientV2()
     docs = [c for d, c in sources]
 
-    response = co.rerank(
-        model="rerank-v3.5",
-        query=question,
-        documents=docs,
-        top_n=k,
-    )
+    with tracing.span("rerank"):
+        response = co.rerank(
+            model="rerank-v3.5",
+            query=question,
+            documents=docs,
+            top_n=k,
+        )
     ixs = [r.index for r in response.results]
     print("Rerank selected indices", ixs)
     return [sources[r.index] for r in response.results]
 
 
-def make_db():
+CRAWL_PATH = os.environ.get("RAG_CRAWL_FILE", "/home/ubuntu/cosmo/nordic-crawler/output/nordic_all.json")
+def make_db(json_path=CRAWL_PATH):
     db = RagDatabase()
     # db.ingest("../crawler/nordic-crawler/")
     #db.ingest_json("../crawler/nordic-crawler/output/udi_pages_rag.json")
-    db.ingest_json("/home/ubuntu/cosmo/nordic-crawler/output/nordic_all.json")
+    db.ingest_json(json_path)
     db.encode()
     return db
 
@@ -117,12 +298,16 @@ def pickle_db(db, filename=DB_PATH):
     with open(filename, "wb") as f:
         pickle.dump(db, f)
 
-def load_pickled_db(filename=DB_PATH):
-    try:
-        with open(os.path.expanduser(filename), "rb") as f:
-            return pickle.load(f)
-    except:
+def load_pickled_db(filename=DB_PATH, rebuild=False):
+    """Load the pickled database; a missing pickle is an error unless rebuild is set,
+    since rebuilding ingests and re-embeds the whole crawl"""
+    filename = os.path.expanduser(filename)
+    if not os.path.exists(filename):
+        if not rebuild:
+            raise FileNotFoundError(f"No database at {filename}; build one with make_db() or rag.ingest")
         print(f"Recreating db and saving to {filename}")
         db = make_db()
         pickle_db(db, filename)
-        return db
\ No newline at end of file
+        return db
+    with open(filename, "rb") as f:
+        return pickle.load(f)
@@ -0,0 +1,106 @@
+"""Shared query encoder service.
+
+One process holds the embedding model and encodes queries for all server workers,
+batching concurrent requests into a single forward pass:
+
+    RAG_ENCODER_MODEL=intfloat/multilingual-e5-large poetry run uvicorn rag.encoder:app --port 8890
+
+RAG_ENCODER_BACKEND selects the CPU inference backend (see rag.backends).
+"""
+import os
+import json
+import base64
+import asyncio
+import urllib.request
+import numpy as np
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+MODEL = os.environ.get("RAG_ENCODER_MODEL", "intfloat/multilingual-e5-large")
+# Collect requests for at most this many seconds (or until the batch is full) before encoding
+BATCH_WINDOW = float(os.environ.get("RAG_ENCODER_BATCH_WINDOW", 0.005))
+MAX_BATCH = int(os.environ.get("RAG_ENCODER_MAX_BATCH", 32))
+BACKEND = os.environ.get("RAG_ENCODER_BACKEND", "torch")
+THREADS = int(os.environ.get("RAG_ENCODER_THREADS", 0)) or None
+
+app = FastAPI()
+
+
+class EncodeRequest(BaseModel):
+    texts: list[str]
+    normalize: bool = True
+
+
+class Batcher:
+    def __init__(self, st, window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        self.st = st
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+
+    async def encode(self, text, normalize=True):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, normalize, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            for normalize in {n for _, n, _ in batch}:
+                items = [(text, future) for text, n, future in batch if n == normalize]
+                try:
+                    vectors = await asyncio.to_thread(
+                        self.st.encode, [text for text, _ in items], normalize_embeddings=normalize
+                    )
+                except Exception as e:
+                    for _, future in items:
+                        future.set_exception(e)
+                    continue
+                for (_, future), vector in zip(items, vectors):
+                    future.set_result(vector)
+
+
+batcher = None
+
+
+@app.on_event("startup")
+async def startup_event():
+    global batcher
+    from rag.backends import load_encoder, warm_up
+    encoder = await asyncio.to_thread(load_encoder, MODEL, BACKEND, THREADS)
+    await asyncio.to_thread(warm_up, encoder)
+    batcher = Batcher(encoder)
+    asyncio.create_task(batcher.run())
+
+
+@app.post("/encode")
+async def encode_endpoint(request: EncodeRequest):
+    vectors = await asyncio.gather(*(batcher.encode(text, request.normalize) for text in request.texts))
+    matrix = np.asarray(vectors, dtype=np.float32)
+    return {"shape": matrix.shape, "data": base64.b64encode(matrix.tobytes()).decode()}
+
+
+class RemoteEncoder:
+    """Drop-in for SentenceTransformer.encode backed by the encoder service"""
+    def __init__(self, url, timeout=10.0):
+        self.url = url.rstrip("/") + "/encode"
+        self.timeout = timeout
+
+    def encode(self, texts, normalize_embeddings=False, **kwargs):
+        single = isinstance(texts, str)
+        body = json.dumps({"texts": [texts] if single else list(texts), "normalize": normalize_embeddings})
+        request = urllib.request.Request(self.url, data=body.encode(), headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            result = json.load(response)
+        matrix = np.frombuffer(base64.b64decode(result["data"]), dtype=np.float32).reshape(result["shape"])
+        return matrix[0] if single else matrix
@@ -0,0 +1,167 @@
+"""Metadata partitions for filtered search.
+
+Every chunk row is assigned to one partition per field (its document's language,
+domain and type), or to several when its text appeared in several documents. A
+filter resolves to the sorted rows of the matching partitions, and the vector and
+lexical indexes then score only those rows. A row in several documents can match
+each filtered field through a different one, so with more than one field the rows
+are narrowed down to those with a single document matching them all (see
+rag.chunks.ChunkTable.matching_rows).
+"""
+from urllib.parse import urlsplit
+import numpy as np
+from rag import tracing
+
+FILTER_FIELDS = ("language", "domain", "type")
+
+
+def url_domain(url):
+    host = (urlsplit(url).hostname or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+def document_facets(doc):
+    """Partition values of a document's chunks"""
+    metadata = doc.metadata or {}
+    return {
+        "language": str(metadata.get("language") or "unknown").lower(),
+        "domain": url_domain(doc.url),
+        "type": str(metadata.get("type") or "unknown").lower(),
+    }
+
+
+def _value_matches(field, value, wanted):
+    # A domain filter also matches its subdomains
+    return value == wanted or (field == "domain" and value.endswith("." + wanted))
+
+
+def active_filters(filters):
+    """The fields of filters that filter anything"""
+    return {field: wanted for field, wanted in (filters or {}).items() if wanted}
+
+
+def filter_key(filters):
+    """Hashable form of active filters, for caching what they select"""
+    return tuple(sorted((field, tuple(sorted([wanted] if isinstance(wanted, str) else wanted)))
+                        for field, wanted in active_filters(filters).items()))
+
+
+def document_matches(doc, filters):
+    """Whether a document passes filters, by the same rules as Partitions.select"""
+    facets = document_facets(doc)
+    for field, wanted in filters.items():
+        if wanted:
+            wanted = [wanted] if isinstance(wanted, str) else wanted
+            if not any(_value_matches(field, facets[field], w.lower()) for w in wanted):
+                return False
+    return True
+
+
+class Partitions:
+    """Row ids per (field, value) as flat sorted arrays, value i of a field owns
+    rows[offsets[i]:offsets[i+1]]"""
+    def __init__(self, facets):
+        values = {field: {} for field in FILTER_FIELDS}
+        codes = {field: np.zeros(len(facets), dtype=np.int32) for field in FILTER_FIELDS}
+        for row, row_facets in enumerate(facets):
+            for field in FILTER_FIELDS:
+                codes[field][row] = values[field].setdefault(row_facets[field], len(values[field]))
+        self._build(codes, {field: list(values[field]) for field in FILTER_FIELDS})
+
+    @classmethod
+    def from_codes(cls, codes, values, owners=None):
+        """Partitions from value indexes ({field: int array}) into values ({field: list}),
+        one per row, or per entry of owners giving the row each code belongs to (an
+        array, or {field: array} when the fields' codes differ in length)"""
+        partitions = cls.__new__(cls)
+        partitions._build(codes, values, owners)
+        return partitions
+
+    @classmethod
+    def from_documents(cls, documents, doc_ids, owners=None):
+        """Partitions of rows whose document is documents[doc_ids[row]], or of
+        owners[i] for each documents[doc_ids[i]] when a row has several documents"""
+        values = {field: {} for field in FILTER_FIELDS}
+        doc_codes = {field: np.zeros(len(documents), dtype=np.int32) for field in FILTER_FIELDS}
+        for i, doc in enumerate(documents):
+            facets = document_facets(doc)
+            for field in FILTER_FIELDS:
+                doc_codes[field][i] = values[field].setdefault(facets[field], len(values[field]))
+        doc_ids = np.asarray(doc_ids)
+        return cls.from_codes({field: doc_codes[field][doc_ids] for field in FILTER_FIELDS},
+                              {field: list(values[field]) for field in FILTER_FIELDS}, owners)
+
+    def _build(self, codes, values, owners=None):
+        self.values = values
+        self.rows = {}
+        self.offsets = {}
+        for field in FILTER_FIELDS:
+            if owners is None:
+                order = np.argsort(codes[field], kind="stable")
+                rows, sorted_codes = order, codes[field][order]
+            else:
+                # A row belongs to a value once however many of its documents have it
+                field_owners = owners[field] if isinstance(owners, dict) else owners
+                n = int(field_owners.max()) + 1 if len(field_owners) else 1
+                pairs = np.unique(codes[field].astype(np.int64) * n + field_owners)
+                rows, sorted_codes = pairs % n, pairs // n
+            self.rows[field] = rows.astype(np.int32)
+            self.offsets[field] = np.searchsorted(sorted_codes, np.arange(len(values[field]) + 1)).astype(np.int64)
+        self._cache = {}
+
+    @staticmethod
+    def array_names():
+        return [f"{field}.{name}" for field in FILTER_FIELDS for name in ("rows", "offsets")]
+
+    def arrays(self):
+        arrays = {}
+        for field in FILTER_FIELDS:
+            arrays[f"{field}.rows"] = self.rows[field]
+            arrays[f"{field}.offsets"] = self.offsets[field]
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, values):
+        partitions = cls.__new__(cls)
+        partitions.values = values
+        partitions.rows = {field: arrays[f"{field}.rows"] for field in FILTER_FIELDS}
+        partitions.offsets = {field: arrays[f"{field}.offsets"] for field in FILTER_FIELDS}
+        partitions._cache = {}
+        return partitions
+
+    def _matches(self, field, wanted):
+        for i, value in enumerate(self.values[field]):
+            if _value_matches(field, value, wanted):
+                yield i
+
+    def _field_rows(self, field, wanted):
+        wanted = [wanted] if isinstance(wanted, str) else wanted
+        parts = [
+            self.rows[field][self.offsets[field][i]:self.offsets[field][i + 1]]
+            for value in {w.lower() for w in wanted}
+            for i in self._matches(field, value)
+        ]
+        if not parts:
+            return np.zeros(0, dtype=np.int32)
+        return parts[0] if len(parts) == 1 else np.union1d(parts[0], np.concatenate(parts[1:]))
+
+    def select(self, filters):
+        """Sorted rows matching every given field (any of its values), None when unfiltered"""
+        filters = active_filters(filters)
+        if not filters:
+            return None
+        unknown = set(filters) - set(FILTER_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown filter fields {sorted(unknown)}, expected some of {list(FILTER_FIELDS)}")
+        key = filter_key(filters)
+        rows = self._cache.get(key)
+        if rows is None:
+            with tracing.span("filter"):
+                rows = None
+                for field, wanted in filters.items():
+                    field_rows = self._field_rows(field, wanted)
+                    rows = field_rows if rows is None else np.intersect1d(rows, field_rows, assume_unique=True)
+            # Filters come from a handful of UI options, so this stays small
+            if len(self._cache) < 1024:
+                self._cache[key] = rows
+        return rows
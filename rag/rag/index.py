@@ -0,0 +1,221 @@
+import numpy as np
+from rag import tracing
+
+
+def _subset_topk(score_rows, rows, k):
+    """Top k of a filtered search: score only the given rows and map back to row ids"""
+    rows = np.asarray(rows, dtype=np.int64)
+    with tracing.span("similarity"):
+        scores = score_rows(rows)
+    with tracing.span("topk"):
+        scores, positions = _topk(scores, k)
+        return scores, rows[positions]
+
+
+def _topk(scores, k):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=scores.dtype), np.zeros(0, dtype=np.int64)
+    rows = np.argpartition(-scores, k - 1)[:k]
+    rows = rows[np.argsort(-scores[rows])]
+    return scores[rows], rows
+
+
+def _quantized_topk(codes, scales, query, k, rows=None, block=16384):
+    """Top k of int8 codes (among rows when given), scored block by block: each block is
+    converted to float32, scored and cut to its own top k, and those are merged, so a
+    query never copies more than block rows of the matrix"""
+    n = len(codes) if rows is None else len(rows)
+    best_scores, best_rows = [], []
+    for start in range(0, n, block):
+        if rows is None:
+            block_rows = np.arange(start, min(start + block, n), dtype=np.int64)
+            block_codes = codes[start:start + block]
+        else:
+            block_rows = rows[start:start + block]
+            block_codes = codes[block_rows]
+        scores, positions = _topk((block_codes.astype(np.float32) @ query) * scales[block_rows], k)
+        best_scores.append(scores)
+        best_rows.append(block_rows[positions])
+    if not best_scores:
+        return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+    scores, positions = _topk(np.concatenate(best_scores), k)
+    return scores, np.concatenate(best_rows)[positions]
+
+
+def quantize(embeddings):
+    """Per-row symmetric int8 codes and float32 scales"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    scales = (np.abs(embeddings).max(axis=1) / 127).astype(np.float32)
+    scales[scales == 0] = 1
+    codes = np.round(embeddings / scales[:, None]).astype(np.int8)
+    return codes, scales
+
+
+def train_centroids(embeddings, nlist=None, iterations=10, seed=0, sample=65536):
+    """Spherical k-means centroids, trained on at most sample rows"""
+    n = len(embeddings)
+    nlist = max(1, min(n, nlist or int(np.sqrt(n))))
+    if not n:
+        return np.zeros((0, 0), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    if n > sample:
+        embeddings = np.asarray(embeddings[np.sort(rng.choice(n, sample, replace=False))], dtype=np.float32)
+    centroids = embeddings[rng.choice(len(embeddings), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(embeddings @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = embeddings[assignment == c]
+            if len(members):
+                centroid = members.mean(axis=0)
+                centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+    return centroids
+
+
+def assign_lists(embeddings, centroids, block=65536):
+    """Rows grouped by nearest centroid: rows and per-list offsets, computed block by block"""
+    n = len(embeddings)
+    assignment = np.zeros(n, dtype=np.int64)
+    for start in range(0, n if len(centroids) else 0, block):
+        assignment[start:start + block] = np.argmax(embeddings[start:start + block] @ centroids.T, axis=1)
+    order = np.argsort(assignment, kind="stable")
+    return order.astype(np.int64), np.searchsorted(assignment[order], np.arange(len(centroids) + 1))
+
+
+class ExactIndex:
+    """Brute-force inner product over normalized float32 embeddings"""
+    mode = "exact"
+
+    def __init__(self, embeddings):
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def arrays(self):
+        return {"embeddings": self.embeddings}
+
+    def params(self):
+        return {}
+
+    @classmethod
+    def from_arrays(cls, arrays, **params):
+        index = cls.__new__(cls)
+        index.embeddings = arrays["embeddings"]
+        return index
+
+    @property
+    def nbytes(self):
+        return self.embeddings.nbytes
+
+    def search(self, query, k=10, rows=None):
+        query = np.asarray(query, dtype=np.float32)
+        if rows is not None:
+            return _subset_topk(lambda rows: self.embeddings[rows] @ query, rows, k)
+        with tracing.span("similarity"):
+            scores = self.embeddings @ query
+        with tracing.span("topk"):
+            return _topk(scores, k)
+
+
+class QuantizedIndex:
+    """Per-row symmetric int8 quantization, a quarter of the float32 memory"""
+    mode = "quantized"
+
+    def __init__(self, embeddings):
+        self.codes, self.scales = quantize(embeddings)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def arrays(self):
+        return {"codes": self.codes, "scales": self.scales}
+
+    def params(self):
+        return {}
+
+    @classmethod
+    def from_arrays(cls, arrays, **params):
+        index = cls.__new__(cls)
+        index.codes = arrays["codes"]
+        index.scales = arrays["scales"]
+        return index
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def search(self, query, k=10, rows=None):
+        query = np.asarray(query, dtype=np.float32)
+        if rows is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+        with tracing.span("similarity"):
+            return _quantized_topk(self.codes, self.scales, query, k, rows)
+
+
+class IVFIndex:
+    """Inverted file index: k-means lists over the embeddings, nprobe lists are scanned per query"""
+    mode = "ann"
+
+    def __init__(self, embeddings, nlist=None, nprobe=8, iterations=10, seed=0):
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.centroids = train_centroids(self.embeddings, nlist, iterations, seed)
+        self.nlist = max(1, len(self.centroids))
+        self.nprobe = min(nprobe, self.nlist)
+        self.rows, self.offsets = assign_lists(self.embeddings, self.centroids)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def arrays(self):
+        return {"embeddings": self.embeddings, "centroids": self.centroids, "rows": self.rows, "offsets": self.offsets}
+
+    def params(self):
+        return {"nprobe": self.nprobe}
+
+    @classmethod
+    def from_arrays(cls, arrays, nprobe=8):
+        index = cls.__new__(cls)
+        for name in ("embeddings", "centroids", "rows", "offsets"):
+            setattr(index, name, arrays[name])
+        index.nlist = len(index.centroids)
+        index.nprobe = min(nprobe, index.nlist)
+        return index
+
+    @property
+    def nbytes(self):
+        return self.embeddings.nbytes + self.centroids.nbytes + self.rows.nbytes + self.offsets.nbytes
+
+    def search(self, query, k=10, rows=None):
+        query = np.asarray(query, dtype=np.float32)
+        # A filter selecting no more rows than the probed lists hold is cheaper (and exact)
+        # to scan directly
+        if rows is not None and len(rows) <= self.nprobe * len(self.embeddings) / max(self.nlist, 1):
+            return _subset_topk(lambda rows: self.embeddings[rows] @ query, rows, k)
+        with tracing.span("similarity"):
+            _, lists = _topk(self.centroids @ query, self.nprobe)
+            candidates = np.concatenate([self.rows[self.offsets[c]:self.offsets[c + 1]] for c in lists]) if len(lists) else self.rows[:0]
+        if rows is not None:
+            # Drop filtered-out rows before scoring, and scan the whole filter if too few are left
+            candidates = candidates[np.isin(candidates, rows, assume_unique=True)]
+            if len(candidates) < k:
+                return _subset_topk(lambda rows: self.embeddings[rows] @ query, rows, k)
+        rows = candidates
+        with tracing.span("similarity"):
+            scores = self.embeddings[rows] @ query
+        with tracing.span("topk"):
+            scores, positions = _topk(scores, k)
+            return scores, rows[positions]
+
+
+INDEX_MODES = {
+    "exact": ExactIndex,
+    "quantized": QuantizedIndex,
+    "ann": IVFIndex,
+}
+
+
+def build_index(embeddings, mode="exact", **kwargs):
+    if mode not in INDEX_MODES:
+        raise ValueError(f"Unknown index mode {mode!r}, expected one of {sorted(INDEX_MODES)}")
+    return INDEX_MODES[mode](embeddings, **kwargs)
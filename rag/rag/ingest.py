@@ -0,0 +1,350 @@
+"""Streaming ingest from crawler output straight into a new index version.
+
+    poetry run python -m rag.ingest output/nordic_all.jsonl --root ~/rag_index --mode ann
+
+Records are read one at a time (see rag.records), chunked per page and encoded in
+fixed-size batches. Chunk text, embeddings, per-row columns and postings are
+appended to files as they are produced and only turned into the memory-mapped
+arrays of rag.store at the end, and postings are sorted on disk in bounded blocks
+(see _sort_postings), so none of them is ever held in memory whole. What is kept in
+memory grows with the number of distinct texts and pages, not with the crawl
+itself: the text hash -> row map, the URL, document and heading lists, the lexical
+vocabulary, and for the "ann" mode and filter partitions a few integers per row.
+Text repeated across pages is stored, indexed and encoded once, as rag.db does (see
+rag.chunks).
+"""
+import os
+import time
+import shutil
+import argparse
+from collections import Counter
+import numpy as np
+from rag.db import _tokenize
+from rag.chunks import Document, chunk_id, clean_chunk, passage_text, text_key
+from rag.chunker import Chunker
+from rag.encoder import RemoteEncoder
+from rag.filters import FILTER_FIELDS, Partitions, document_facets
+from rag.index import INDEX_MODES, quantize, train_centroids, assign_lists
+from rag.records import iter_records, iter_pages
+from rag.roadmap import find_spans
+from rag.store import new_version, publish
+
+DEFAULT_MODEL = "intfloat/multilingual-e5-large"
+
+
+class _Column:
+    """Append-only array in a raw file, copied into name.npy block by block when done"""
+    def __init__(self, directory, name, dtype):
+        self.directory = directory
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.shape = None
+        self.rows = 0
+        self.raw_path = os.path.join(directory, f"{name}.raw")
+        self.file = open(self.raw_path, "wb")
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        self.shape = self.shape or values.shape[1:]
+        self.file.write(values.tobytes())
+        self.rows += len(values)
+
+    def finish(self, block=65536):
+        """Write name.npy and return it memory-mapped"""
+        self.file.close()
+        path = os.path.join(self.directory, f"{self.name}.npy")
+        shape = (self.rows,) + (self.shape or ())
+        if self.rows:
+            raw = np.memmap(self.raw_path, dtype=self.dtype, mode="r", shape=shape)
+            out = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=shape)
+            for start in range(0, self.rows, block):
+                out[start:start + block] = raw[start:start + block]
+            out.flush()
+            del raw, out
+        else:
+            np.save(path, np.zeros(shape, dtype=self.dtype))
+        os.remove(self.raw_path)
+        return np.load(path, mmap_mode="r")
+
+
+def _sort_postings(directory, keys, columns, n_keys, block=1 << 20):
+    """Stable sort of postings by an integer key in [0, n_keys), without loading them.
+
+    columns maps output names (directory/name.npy) to arrays aligned with keys, usually
+    memory-mapped. A first pass counts each key's postings, which places every key's
+    run in the output. A second one distributes the postings block by block into
+    buckets of consecutive keys holding about block postings each, written where the
+    bucket's postings end up, and each bucket is then sorted in memory. Memory is
+    bounded by block and n_keys, not by the number of postings. Returns the offsets of
+    each key's postings.
+    """
+    n = len(keys)
+    counts = np.zeros(n_keys, dtype=np.int64)
+    for start in range(0, n, block):
+        counts += np.bincount(keys[start:start + block], minlength=n_keys)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    # First key of each bucket, a bucket being cut where another block of postings starts
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(offsets, np.arange(0, n, block), side="right") - 1]))
+    bounds = np.append(bounds[bounds < n_keys], n_keys)
+    cursor = offsets[bounds[:-1]].copy()
+
+    spilled_path = os.path.join(directory, "postings.spilled_keys.raw")
+    spilled = np.memmap(spilled_path, dtype=np.int64, mode="w+", shape=(max(n, 1),))
+    outs = {name: np.lib.format.open_memmap(os.path.join(directory, f"{name}.npy"), mode="w+",
+                                            dtype=column.dtype, shape=column.shape)
+            for name, column in columns.items()}
+    for start in range(0, n, block):
+        block_keys = np.asarray(keys[start:start + block], dtype=np.int64)
+        buckets = np.searchsorted(bounds, block_keys, side="right") - 1
+        order = np.argsort(buckets, kind="stable")
+        values = {name: np.asarray(column[start:start + block])[order] for name, column in columns.items()}
+        block_keys = block_keys[order]
+        present, firsts, sizes = np.unique(buckets[order], return_index=True, return_counts=True)
+        for bucket, first, size in zip(present.tolist(), firsts.tolist(), sizes.tolist()):
+            at = cursor[bucket]
+            spilled[at:at + size] = block_keys[first:first + size]
+            for name, out in outs.items():
+                out[at:at + size] = values[name][first:first + size]
+            cursor[bucket] += size
+    for bucket in range(len(bounds) - 1):
+        low, high = offsets[bounds[bucket]], offsets[bounds[bucket + 1]]
+        if high - low < 2:
+            continue
+        order = np.argsort(spilled[low:high], kind="stable")
+        for out in outs.values():
+            out[low:high] = out[low:high][order]
+    for out in outs.values():
+        out.flush()
+    del spilled, outs
+    os.remove(spilled_path)
+    return offsets
+
+
+class _LexicalWriter:
+    """Collects (token, row, tf) postings on disk and sorts them into LexicalIndex arrays"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.vocabulary = {}
+        self.tokens = _Column(directory, "postings.tokens", np.int32)
+        self.rows = _Column(directory, "postings.rows", np.int32)
+        self.tfs = _Column(directory, "postings.tfs", np.float32)
+        self.lengths = _Column(directory, "lexical.lengths", np.float32)
+
+    def add(self, row, text):
+        tokens = _tokenize(text)
+        counts = Counter(tokens)
+        self.tokens.append(np.array([self.vocabulary.setdefault(token, len(self.vocabulary)) for token in counts], dtype=np.int32))
+        self.rows.append(np.full(len(counts), row, dtype=np.int32))
+        self.tfs.append(np.array(list(counts.values()), dtype=np.float32))
+        self.lengths.append(np.array([len(tokens)], dtype=np.float32))
+
+    def finish(self):
+        self.lengths.finish()
+        tokens, rows, tfs = self.tokens.finish(), self.rows.finish(), self.tfs.finish()
+        # Stable, so each token's postings stay in row order as in LexicalIndex
+        offsets = _sort_postings(self.directory, tokens, {"lexical.rows": rows, "lexical.tfs": tfs},
+                                 len(self.vocabulary))
+        np.save(os.path.join(self.directory, "lexical.offsets.npy"), offsets)
+        del tokens, rows, tfs
+        for name in ("tokens", "rows", "tfs"):
+            os.remove(os.path.join(self.directory, f"postings.{name}.npy"))
+
+
+def _row_codes(directory, name, chunk_postings, block=1 << 20):
+    """Distinct (code, row) pairs of postings sorted by row, read block by block; there
+    are about as many as rows, however often texts repeat across pages"""
+    sorted_codes = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+    rows = len(chunk_postings) - 1
+    pairs = []
+    for start in range(0, len(sorted_codes), block):
+        block_codes = sorted_codes[start:start + block].astype(np.int64)
+        owners = np.searchsorted(chunk_postings, np.arange(start, start + len(block_codes)), side="right") - 1
+        pairs.append(np.unique(block_codes * rows + owners))
+    pairs = np.unique(np.concatenate(pairs)) if pairs else np.zeros(0, dtype=np.int64)
+    return (pairs // rows).astype(np.int32), pairs % rows
+
+
+def stream_ingest(records, root, encoder, model=DEFAULT_MODEL, mode="exact", batch_size=256, chunker=None,
+                  min_length=100, activate_version=True):
+    """Chunk, encode and index crawler records as a new version under root"""
+    if mode not in INDEX_MODES:
+        raise ValueError(f"Unknown index mode {mode!r}, expected one of {sorted(INDEX_MODES)}")
+    chunker = chunker or Chunker()
+    # Pages are read from here on, so live pages (see rag.live) ingested earlier are held by the version
+    built_at = time.time()
+    version, tmp = new_version(root)
+    try:
+        meta = _write_version(records, tmp, encoder, mode, batch_size, chunker, min_length)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    meta.update(version=version, model=model, built_at=built_at)
+    return publish(root, version, tmp, meta, activate_version)
+
+
+def _write_version(records, tmp, encoder, mode, batch_size, chunker, min_length):
+    chunk_offsets = _Column(tmp, "chunk_offsets", np.int64)
+    chunk_offsets.append(np.zeros(1, dtype=np.int64))
+    chunk_headings = _Column(tmp, "chunk_headings", np.int32)
+    roadmap_offsets = _Column(tmp, "chunk_roadmap_offsets", np.int64)
+    roadmap_offsets.append(np.zeros(1, dtype=np.int64))
+    roadmap_kinds = _Column(tmp, "chunk_roadmap_kinds", np.uint8)
+    roadmap_spans = _Column(tmp, "chunk_roadmap_spans", np.int32)
+    # Postings in crawl order, sorted by row when done
+    posting_rows = _Column(tmp, "postings.chunk_rows", np.int32)
+    posting_urls = _Column(tmp, "postings.chunk_urls", np.int32)
+    posting_ids = _Column(tmp, "postings.chunk_ids", "S16")
+    partition_codes = {field: _Column(tmp, f"partition_codes.{field}", np.int32) for field in FILTER_FIELDS}
+    if mode == "quantized":
+        vector_columns = {"codes": _Column(tmp, "vectors.codes", np.int8), "scales": _Column(tmp, "vectors.scales", np.float32)}
+    else:
+        vector_columns = {"embeddings": _Column(tmp, "vectors.embeddings", np.float32)}
+    lexical = _LexicalWriter(tmp)
+
+    urls, url_ids, documents = [], {}, []
+    headings, heading_ids = [], {}
+    partition_values = {field: {} for field in FILTER_FIELDS}
+    url_codes = []
+    pending = []
+    # Row of each unique text; 8-byte keys, so this grows far slower than the crawl
+    rows_by_key = {}
+    rows = postings = skipped = offset = spans = 0
+
+    def flush():
+        if not pending:
+            return
+        embeddings = np.asarray(encoder.encode(pending, normalize_embeddings=True), dtype=np.float32)
+        if mode == "quantized":
+            codes, scales = quantize(embeddings)
+            vector_columns["codes"].append(codes)
+            vector_columns["scales"].append(scales)
+        else:
+            vector_columns["embeddings"].append(embeddings)
+        pending.clear()
+
+    with open(os.path.join(tmp, "chunks.bin"), "wb") as text:
+        for page in iter_pages(records):
+            url = page["url"]
+            for heading, chunk in chunker.chunk_page(page["sections"]):
+                chunk = clean_chunk(chunk)
+                if len(chunk) < min_length:
+                    skipped += 1
+                    continue
+                if url not in url_ids:
+                    url_ids[url] = len(urls)
+                    urls.append(url)
+                    documents.append({"url": url, "title": page["title"], "metadata": page["metadata"]})
+                    facets = document_facets(Document(url, [], metadata=page["metadata"]))
+                    url_codes.append({
+                        field: partition_values[field].setdefault(facets[field], len(partition_values[field]))
+                        for field in FILTER_FIELDS
+                    })
+                url_id = url_ids[url]
+                key = text_key(chunk)
+                row = rows_by_key.get(key)
+                if row is None:
+                    # First occurrence of this text: store, index and encode it
+                    row = rows_by_key[key] = rows
+                    data = chunk.encode("utf-8")
+                    text.write(data)
+                    offset += len(data)
+                    chunk_offsets.append(np.array([offset], dtype=np.int64))
+                    if heading is not None and heading not in heading_ids:
+                        heading_ids[heading] = len(headings)
+                        headings.append(heading)
+                    chunk_headings.append(np.array([heading_ids[heading] if heading is not None else -1], dtype=np.int32))
+                    chunk_spans = find_spans(chunk)
+                    spans += len(chunk_spans)
+                    roadmap_offsets.append(np.array([spans], dtype=np.int64))
+                    roadmap_kinds.append(np.array([kind for kind, _, _ in chunk_spans], dtype=np.uint8))
+                    roadmap_spans.append(np.array([(start, end) for _, start, end in chunk_spans], dtype=np.int32).reshape(-1, 2))
+                    passage = passage_text(heading, chunk)
+                    lexical.add(rows, passage)
+                    pending.append(f"passage: {passage}")
+                    rows += 1
+                    if len(pending) >= batch_size:
+                        flush()
+                        print(f"Encoded {rows} chunks from {len(urls)} pages")
+                posting_rows.append(np.array([row], dtype=np.int32))
+                posting_urls.append(np.array([url_id], dtype=np.int32))
+                posting_ids.append(np.array([chunk_id(url, chunk).encode("ascii")], dtype="S16"))
+                for field in FILTER_FIELDS:
+                    partition_codes[field].append(np.array([url_codes[url_id][field]], dtype=np.int32))
+                postings += 1
+        flush()
+    if not rows:
+        raise ValueError("No chunks to index")
+
+    for column in (chunk_offsets, chunk_headings, roadmap_offsets, roadmap_kinds, roadmap_spans):
+        column.finish()
+    # Stable, so each row's postings stay in crawl order with its first occurrence first
+    owners = posting_rows.finish()
+    columns = {"chunk_urls": posting_urls.finish(), "chunk_ids": posting_ids.finish()}
+    columns.update({f"partition_codes.{field}.sorted": column.finish() for field, column in partition_codes.items()})
+    chunk_postings = _sort_postings(tmp, owners, columns, rows)
+    np.save(os.path.join(tmp, "chunk_postings.npy"), chunk_postings)
+    del owners, columns
+    for name in ["chunk_rows", "chunk_urls", "chunk_ids"]:
+        os.remove(os.path.join(tmp, f"postings.{name}.npy"))
+    # One document per URL, so the document column is the URL column
+    shutil.copyfile(os.path.join(tmp, "chunk_urls.npy"), os.path.join(tmp, "chunk_docs.npy"))
+    vectors = {name: column.finish() for name, column in vector_columns.items()}
+    params = {}
+    if mode == "ann":
+        centroids = train_centroids(vectors["embeddings"])
+        ivf_rows, ivf_offsets = assign_lists(vectors["embeddings"], centroids)
+        for name, array in (("centroids", centroids), ("rows", ivf_rows), ("offsets", ivf_offsets)):
+            np.save(os.path.join(tmp, f"vectors.{name}.npy"), array)
+        params = {"nprobe": min(8, len(centroids))}
+    lexical.finish()
+
+    codes, code_rows = {}, {}
+    for field in FILTER_FIELDS:
+        codes[field], code_rows[field] = _row_codes(tmp, f"partition_codes.{field}.sorted", chunk_postings)
+        for name in (f"partition_codes.{field}", f"partition_codes.{field}.sorted"):
+            os.remove(os.path.join(tmp, f"{name}.npy"))
+    partitions = Partitions.from_codes(codes, {field: list(values) for field, values in partition_values.items()},
+                                       code_rows)
+    for name, array in partitions.arrays().items():
+        np.save(os.path.join(tmp, f"partitions.{name}.npy"), array)
+
+    print(f"Indexed {rows} chunks from {len(urls)} pages")
+    if postings > rows:
+        print(f"Collapsed {postings - rows} duplicate chunks")
+    if skipped:
+        print(f"Skipped {skipped} chunks shorter than {min_length} characters")
+    return {
+        "index_mode": mode,
+        "params": params,
+        "vector_arrays": sorted(list(vectors) + (["centroids", "rows", "offsets"] if mode == "ann" else [])),
+        "chunks": rows,
+        "urls": urls,
+        "documents": documents,
+        "headings": headings,
+        "vocabulary": lexical.vocabulary,
+        "partitions": partitions.values,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream crawler output into a new index version")
+    parser.add_argument("path", help="Crawler output, JSON Lines (.jsonl) or a JSON array")
+    parser.add_argument("--root", required=True, help="Index directory (see rag.store)")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--encoder-url", help="Encode with a running rag.encoder service instead of loading the model")
+    parser.add_argument("--mode", choices=list(INDEX_MODES), default="exact", help="Vector index mode")
+    parser.add_argument("--batch-size", type=int, default=256, help="Chunks per encoder call")
+    parser.add_argument("--no-activate", action="store_true", help="Export without switching CURRENT")
+    args = parser.parse_args()
+
+    if args.encoder_url:
+        encoder = RemoteEncoder(args.encoder_url)
+    else:
+        from sentence_transformers import SentenceTransformer
+        encoder = SentenceTransformer(args.model)
+    stream_ingest(iter_records(args.path), args.root, encoder, model=args.model, mode=args.mode,
+                  batch_size=args.batch_size, activate_version=not args.no_activate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""In-memory index segment for pages ingested while the server runs.
+
+In pipeline mode the crawler posts page records to /ingest as soon as they are
+extracted (see nordic_crawler.pipeline). They are chunked, encoded and appended
+here, and searched next to the main index, so fresh pages are retrievable within
+seconds of being crawled. A re-ingested URL replaces its earlier chunks and
+shadows the main index's copy of that page, and pages are dropped again once a
+newly loaded index version was built after they were ingested (see drop_urls).
+
+Each batch is indexed on its own: embeddings, BM25 postings and partitions grow in
+place, and the chunks of replaced or dropped pages are compacted away once they
+outnumber the live ones.
+"""
+import math
+import time
+import threading
+from collections import Counter
+import numpy as np
+from rag import tracing
+from rag.chunker import Chunker
+from rag.db import _tokenize, unique_sources
+from rag.chunks import Document, chunk_id, clean_chunk, passage_text
+from rag.filters import FILTER_FIELDS, _value_matches, document_facets
+from rag.index import _topk
+from rag.roadmap import text_facets
+
+
+def _grow(buffer, end, shape=(), dtype=np.float32):
+    """buffer with room for end rows, reallocated by doubling"""
+    if buffer is not None and len(buffer) >= end:
+        return buffer
+    grown = np.zeros((max(end, 2 * len(buffer) if buffer is not None else 1024), *shape), dtype=dtype)
+    if buffer is not None:
+        grown[:len(buffer)] = buffer
+    return grown
+
+
+class _Postings:
+    """BM25 postings appended to per batch; a search reads rows below its state's end"""
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # token -> [(row, tf)]
+        self.lengths = None
+
+    def add(self, start, texts):
+        self.lengths = _grow(self.lengths, start + len(texts))
+        for row, text in enumerate(texts, start):
+            tokens = _tokenize(text)
+            self.lengths[row] = len(tokens)
+            for token, tf in Counter(tokens).items():
+                self.postings.setdefault(token, []).append((row, tf))
+
+    def search(self, query, k, rows, alive):
+        """Top k of rows (sorted, alive) by BM25 over the alive rows"""
+        lengths = self.lengths[:len(alive)]
+        n = int(alive.sum())
+        avg_length = max(float(lengths[alive].mean()), 1.0) if n else 1.0
+        scores = np.zeros(len(alive), dtype=np.float32)
+        for token in set(_tokenize(query)):
+            entries = np.array(self.postings.get(token, [])[:], dtype=np.int64).reshape(-1, 2)
+            entries = entries[entries[:, 0] < len(alive)]
+            matches, tfs = entries[:, 0], entries[:, 1].astype(np.float32)
+            matches, tfs = matches[alive[matches]], tfs[alive[matches]]
+            if not len(matches):
+                continue
+            idf = math.log(1 + (n - len(matches) + 0.5) / (len(matches) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * lengths[matches] / avg_length)
+            scores[matches] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+        top = rows[np.argsort(-scores[rows])[:k]]
+        return top[scores[top] > 0].tolist()
+
+
+class _Partitions:
+    """Rows per (field, value), appended to per batch, selected like rag.filters.Partitions"""
+    def __init__(self):
+        self.rows = {field: {} for field in FILTER_FIELDS}
+
+    def add(self, row, facets):
+        for field in FILTER_FIELDS:
+            self.rows[field].setdefault(facets[field], []).append(row)
+
+    def select(self, filters, end):
+        """Sorted rows below end matching every given field, None when unfiltered"""
+        filters = {field: wanted for field, wanted in (filters or {}).items() if wanted}
+        if not filters:
+            return None
+        unknown = set(filters) - set(FILTER_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown filter fields {sorted(unknown)}, expected some of {list(FILTER_FIELDS)}")
+        selected = None
+        for field, wanted in filters.items():
+            wanted = {w.lower() for w in ([wanted] if isinstance(wanted, str) else wanted)}
+            parts = [np.array(rows[:], dtype=np.int64) for value, rows in list(self.rows[field].items())
+                     if any(_value_matches(field, value, w) for w in wanted)]
+            field_rows = np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+            field_rows = field_rows[field_rows < end]
+            selected = field_rows if selected is None else np.intersect1d(selected, field_rows, assume_unique=True)
+        return selected
+
+
+class _State:
+    """What a search reads. The structures only grow past end, or are replaced whole
+    by a compaction, so a state stays valid while later batches are appended"""
+    def __init__(self, rows, alive, embeddings, lexical, partitions, rows_by_id):
+        self.rows = rows
+        self.alive = alive
+        self.embeddings = embeddings
+        self.lexical = lexical
+        self.partitions = partitions
+        self.rows_by_id = rows_by_id
+
+
+class LiveSegment:
+    def __init__(self, encoder, chunker=None, min_length=100, compact_after=1024):
+        self.encoder = encoder
+        self.chunker = chunker or Chunker()
+        self.min_length = min_length
+        # Dead rows (replaced or dropped pages) are compacted away once there are this
+        # many and they outnumber the live ones
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+        # url -> when the page was last ingested, kept across compactions
+        self.ingested = {}
+        self._reset()
+        self.state = _State([], np.zeros(0, dtype=bool), None, self.lexical, self.partitions, self.rows_by_id)
+
+    def _reset(self):
+        # url -> (first row, end row) of the page's latest chunks
+        self.ranges = {}
+        self.documents = {}  # url -> latest Document
+        self.rows = []  # (doc, chunk index) per row
+        self.alive = None
+        self.dead = 0
+        self.buffer = None  # embeddings, grown by doubling
+        self.lexical = _Postings()
+        self.partitions = _Partitions()
+        self.rows_by_id = {}
+
+    def __len__(self):
+        return int(self.state.alive.sum())
+
+    def __contains__(self, url):
+        """Whether url has live chunks, which shadow the main index's copy of the page"""
+        first, last = self.ranges.get(url, (0, 0))
+        return last > first
+
+    def add_pages(self, pages):
+        """Chunk, encode and append pages ({url, title, metadata, sections}), returning
+        the number of chunks added"""
+        ingested_at = time.time()
+        documents, passages = [], []
+        for page in pages:
+            chunks, headings = [], []
+            for heading, chunk in self.chunker.chunk_page(page["sections"]):
+                chunk = clean_chunk(chunk)
+                if len(chunk) >= self.min_length:
+                    chunks.append(chunk)
+                    headings.append(heading)
+            documents.append(Document(page["url"], chunks, title=page["title"], headings=headings, metadata=page["metadata"]))
+            passages.extend(f"passage: {passage_text(heading, chunk)}" for heading, chunk in zip(headings, chunks))
+        # Encode before taking the lock so searches and other batches are not held up
+        with tracing.span("ingest_encode"):
+            embeddings = np.asarray(self.encoder.encode(passages, normalize_embeddings=True), dtype=np.float32) if passages else None
+        with self.lock:
+            self._append(documents, embeddings)
+            for doc in documents:
+                self.ingested[doc.url] = ingested_at
+            self._compact_if_sparse()
+        return len(passages)
+
+    def drop_urls(self, urls, before=None):
+        """Remove the pages whose URL is in urls, only those ingested before the time
+        before if given, e.g. once an index version built after them holds them;
+        returns how many were dropped"""
+        with self.lock:
+            dropped = [url for url in self.ranges
+                       if url in urls and (before is None or self.ingested[url] < before)]
+            for url in dropped:
+                self._kill(*self.ranges.pop(url))
+                del self.documents[url]
+                del self.ingested[url]
+            self._compact_if_sparse()
+        return len(dropped)
+
+    def _kill(self, first, last):
+        self.alive[first:last] = False
+        self.dead += last - first
+
+    def _append(self, documents, embeddings):
+        start = len(self.rows)
+        end = start + (len(embeddings) if embeddings is not None else 0)
+        self.alive = _grow(self.alive, end, dtype=bool)
+        if embeddings is not None:
+            self.buffer = _grow(self.buffer, end, embeddings.shape[1:])
+            self.buffer[start:end] = embeddings
+        replaced, texts = [], []
+        for doc in documents:
+            if doc.url in self.ranges:
+                replaced.append(self.ranges[doc.url])
+            first = len(self.rows)
+            facets = document_facets(doc)
+            for ci, chunk in enumerate(doc.chunks):
+                self.partitions.add(len(self.rows), facets)
+                self.rows_by_id[chunk_id(doc.url, chunk)] = len(self.rows)
+                self.rows.append((doc, ci))
+                texts.append(passage_text(doc.heading(ci), chunk))
+            self.ranges[doc.url] = (first, len(self.rows))
+            self.documents[doc.url] = doc
+        # Only the new rows are indexed, past the end of every state searches hold
+        self.lexical.add(start, texts)
+        self.alive[start:end] = True
+        self.state = _State(self.rows, self.alive[:end], self.buffer[:end] if self.buffer is not None else None,
+                            self.lexical, self.partitions, self.rows_by_id)
+        # Killed once the new rows are visible, so a search never misses a re-ingested page
+        for first, last in replaced:
+            self._kill(first, last)
+
+    def _compact_if_sparse(self):
+        if self.dead < self.compact_after or 2 * self.dead < len(self.rows):
+            return
+        # Re-appends the live pages into fresh structures; searches keep the old state
+        # until it is swapped, and the rows re-indexed are at most the dead ones dropped
+        pages = sorted(((first, last, self.documents[url]) for url, (first, last) in self.ranges.items()),
+                       key=lambda page: page[0])
+        buffer = self.buffer
+        self._reset()
+        documents = [doc for _, _, doc in pages]
+        if not documents:
+            self.state = _State([], np.zeros(0, dtype=bool), None, self.lexical, self.partitions, self.rows_by_id)
+            return
+        keep = np.concatenate([np.arange(first, last) for first, last, _ in pages])
+        embeddings = buffer[keep] if buffer is not None and len(keep) else None
+        self._append(documents, embeddings)
+
+    def _candidates(self, state, filters):
+        rows = np.flatnonzero(state.alive)
+        selected = state.partitions.select(filters, len(state.alive)) if filters and len(rows) else None
+        return rows if selected is None else np.intersect1d(rows, selected, assume_unique=True)
+
+    def _sources(self, state, rows):
+        return unique_sources((doc, doc.chunks[ci]) for doc, ci in (state.rows[row] for row in rows))
+
+    def search(self, encoded_query, k=10, filters=None):
+        state = self.state
+        rows = self._candidates(state, filters)
+        if not len(rows):
+            return []
+        with tracing.span("live_similarity"):
+            scores, positions = _topk(state.embeddings[rows] @ np.asarray(encoded_query, dtype=np.float32), k)
+        return self._sources(state, rows[positions].tolist())
+
+    def lexical_query(self, query, k=10, filters=None):
+        state = self.state
+        rows = self._candidates(state, filters)
+        if not len(rows):
+            return []
+        with tracing.span("live_lexical"):
+            return self._sources(state, state.lexical.search(query, k, rows, state.alive))
+
+    def get_chunk(self, cid):
+        """(doc, chunk, heading) for a chunk id, or None"""
+        state = self.state
+        row = state.rows_by_id.get(cid)
+        if row is None or row >= len(state.alive) or not state.alive[row]:
+            return None
+        doc, ci = state.rows[row]
+        return doc, doc.chunks[ci], doc.heading(ci)
+
+    def get_roadmap(self, cid):
+        """Roadmap facets of a chunk id, or None; live chunks are tagged on lookup"""
+        found = self.get_chunk(cid)
+        return text_facets(found[1]) if found is not None else None
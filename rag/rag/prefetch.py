@@ -0,0 +1,81 @@
+"""Speculative retrieval while the user is typing.
+
+The chat UI posts the partial message to /prefetch after a pause in typing. The
+server starts encoding and retrieval for it right away and keeps the pending
+result per session, so when the message is sent /query awaits (or finds finished)
+the prefetched candidates instead of retrieving from scratch, as long as the sent
+text is close enough to the prefetched one. Rerank and generation still run on the
+final question.
+"""
+import asyncio
+import difflib
+import time
+from collections import OrderedDict
+
+
+def normalize(text):
+    return " ".join(text.lower().split())
+
+
+def similar(a, b, threshold):
+    """Whether two queries are close enough to share retrieval results"""
+    a, b = normalize(a), normalize(b)
+    return a == b or difflib.SequenceMatcher(None, a, b).ratio() >= threshold
+
+
+class _Entry:
+    __slots__ = ("database", "query", "n", "filters", "task", "created")
+
+    def __init__(self, database, query, n, filters, task):
+        self.database = database
+        self.query = query
+        self.n = n
+        self.filters = filters
+        self.task = task
+        self.created = time.monotonic()
+
+
+class PrefetchCache:
+    """Latest prefetched retrieval per session, LRU over sessions, expiring after ttl"""
+
+    def __init__(self, ttl=30.0, similarity=0.9, max_sessions=10000):
+        self.ttl = ttl
+        self.similarity = similarity
+        self.max_sessions = max_sessions
+        self.entries = OrderedDict()
+
+    def start(self, session_id, database, query, n, filters, retrieval):
+        """Run retrieval(), the retrieval coroutine of query, in the background as
+        session_id's prefetch"""
+        entry = self.entries.get(session_id)
+        if (entry is not None and entry.database is database and entry.filters == filters and entry.n >= n
+                and normalize(entry.query) == normalize(query) and not self._expired(entry)):
+            # Same text as the pending prefetch, e.g. the user paused twice
+            return entry.task
+        if entry is not None:
+            # The user kept typing: that text's retrieval would only be discarded
+            entry.task.cancel()
+        task = asyncio.create_task(retrieval())
+        # A failed prefetch only means /query retrieves itself
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.entries[session_id] = _Entry(database, query, n, filters, task)
+        self.entries.move_to_end(session_id)
+        while len(self.entries) > self.max_sessions:
+            self.entries.popitem(last=False)[1].task.cancel()
+        return task
+
+    def _expired(self, entry):
+        return time.monotonic() - entry.created > self.ttl
+
+    async def take(self, session_id, database, query, n, filters):
+        """Top-n candidates prefetched for a query close to this one, or None"""
+        entry = self.entries.pop(session_id, None) if session_id else None
+        if (entry is None or entry.database is not database or entry.filters != filters or entry.n < n
+                or self._expired(entry) or not similar(entry.query, query, self.similarity)):
+            return None
+        try:
+            candidates = await entry.task
+        except Exception as e:
+            print(f"Prefetch failed, retrieving again: {e!r}")
+            return None
+        return candidates[:n]
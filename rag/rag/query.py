@@ -1,8 +1,12 @@
 import os
+import functools
 from openai import OpenAI
 import re
 import json
 import pprint
+import time
+from rag import tracing
+from rag.chunks import chunk_id
 
 SYSTEM_PROMPT = """
 You are an expert assistant tasked with answering questions accurately using only the provided context.
@@ -28,9 +32,11 @@ You are an expert assistant tasked with answering questions accurately using onl
 """
 
 
+@functools.lru_cache(maxsize=None)
 def create_client():
+    # Shared so that requests reuse one keep-alive connection pool
     return OpenAI(
-        base_url="https://api.studio.nebius.ai/v1/",
+        base_url=os.environ.get("NEBIUS_BASE_URL", "https://api.studio.nebius.ai/v1/"),
         api_key=os.environ.get("NEBIUS_KEY"),
     )
 
@@ -61,32 +67,81 @@ def translate_query(question, document):
     pprint.pprint(result)
     return result
 
-def query_with_context(question, sources, temperature=0.3):
+def build_prompt(question, sources, history=""):
+    with tracing.span("prompt_build"):
+        user_prompt = "# Context:\n"
+
+        docs_by_tag = {}
+        for i, (doc, chunk) in enumerate(sources):
+            content = chunk.replace("\n", " ")
+            tag = f"DOC:{i}"
+            user_prompt += f"- [{tag}] {content}\n"
+            docs_by_tag[tag] = dict(id=chunk_id(doc.url, chunk), url=doc.url, content=content)
+        if history:
+            user_prompt += f"\n# Conversation so far:\n{history}\n"
+        user_prompt += f"\nUser Question: {question}"
+    return user_prompt, docs_by_tag
+
+
+def stream_completion(user_prompt, temperature=0.3, stop=None):
+    """Yield the answer text as it is generated, until the stop event (a threading.Event)
+    is set, which closes the stream and so ends the LLM request"""
     client = create_client()
-    user_prompt = "# Context:\n"
-
-    docs_by_tag = {}
-    for i, (doc, chunk) in enumerate(sources):
-        content = chunk.replace("\n", " ")
-        tag = f"DOC:{i}"
-        user_prompt += f"- [{tag}] {content}\n"
-        docs_by_tag[tag] = dict(url=doc.url, content=content)
-    user_prompt += f"\nUser Question: {question}"
-
-    print(f"Sending prompt with question {question!r} and {len(sources)} sources")
-    completion = client.chat.completions.create(
+    start = time.perf_counter()
+    stream = client.chat.completions.create(
         model="meta-llama/Llama-3.3-70B-Instruct",
         messages=[{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}],
         temperature=temperature,
+        stream=True,
+        stream_options={"include_usage": True},
     )
-    response = completion.choices[0].message.content
-    print(f"Response: {response!r}")
-
-    parsed_response = parse_response(response)
-    parsed_response['docs'] = {k: v for k,v in docs_by_tag.items() if k in parsed_response['tags']}
+    first = True
+    for chunk in stream:
+        if stop is not None and stop.is_set():
+            stream.close()
+            tracing.annotate(llm_aborted=True)
+            return
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first:
+                tracing.record("llm_ttft", time.perf_counter() - start, start)
+                first = False
+            yield chunk.choices[0].delta.content
+        if chunk.usage:
+            tracing.annotate(prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens)
+    tracing.record("llm_total", time.perf_counter() - start, start)
+
+
+def finish_response(response, docs_by_tag, include_sources=False):
+    with tracing.span("parse"):
+        parsed_response = parse_response(response)
+        parsed_response['docs'] = {k: v for k,v in docs_by_tag.items() if k in parsed_response['tags']}
+        if include_sources:
+            # Every source given to the LLM, cited or not, e.g. for building a roadmap
+            parsed_response['sources'] = docs_by_tag
     return parsed_response
 
 
+def query_with_context(question, sources, temperature=0.3, include_sources=False, history="", stop=None):
+    user_prompt, docs_by_tag = build_prompt(question, sources, history)
+    print(f"Sending prompt with question {question!r} and {len(sources)} sources")
+    response = "".join(stream_completion(user_prompt, temperature, stop))
+    print(f"Response: {response!r}")
+    return finish_response(response, docs_by_tag, include_sources)
+
+
+def stream_with_context(question, sources, temperature=0.3, include_sources=False, history="", stop=None):
+    """Like query_with_context, but yields a sources event, token events and then the parsed response"""
+    user_prompt, docs_by_tag = build_prompt(question, sources, history)
+    print(f"Streaming prompt with question {question!r} and {len(sources)} sources")
+    # Sent first so that clients can resolve citations while tokens arrive
+    yield {"type": "sources", "docs": docs_by_tag}
+    parts = []
+    for text in stream_completion(user_prompt, temperature, stop):
+        parts.append(text)
+        yield {"type": "token", "text": text}
+    yield {"type": "done", **finish_response("".join(parts), docs_by_tag, include_sources)}
+
+
 def parse_response(response):
     tags = []
     success = True
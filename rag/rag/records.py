@@ -0,0 +1,72 @@
+"""Read crawler output one record at a time.
+
+The crawler writes one record per page section (url, title, heading, content,
+metadata), either as JSON Lines or as one JSON array. Both are read incrementally,
+so memory does not grow with the size of the crawl.
+"""
+import json
+
+_SEPARATORS = " \t\r\n,"
+
+
+def _iter_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def _iter_array(f, read_size):
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+    started = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in _SEPARATORS:
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise ValueError("Unterminated JSON array" if started else "Expected a JSON array of records")
+            more = f.read(read_size)
+            buffer, pos, eof = more, 0, not more
+            continue
+        if not started:
+            if buffer[pos] != "[":
+                raise ValueError("Expected a JSON array of records")
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            record, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The record continues past the end of the buffer
+            more = f.read(read_size)
+            buffer, pos, eof = buffer[pos:] + more, 0, not more
+            continue
+        yield record
+
+
+def iter_records(path, read_size=1 << 20):
+    """Records from a .jsonl file or a JSON array file, parsed one at a time"""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            yield from _iter_jsonl(f)
+        else:
+            yield from _iter_array(f, read_size)
+
+
+def iter_pages(records):
+    """Group consecutive section records into pages: dicts with url, title, metadata
+    and (heading, content) sections"""
+    page = None
+    for record in records:
+        if page is None or record["url"] != page["url"]:
+            if page is not None:
+                yield page
+            page = dict(url=record["url"], title=record.get("title"), metadata=record.get("metadata") or {}, sections=[])
+        page["sections"].append((record.get("heading"), record["content"]))
+    if page is not None:
+        yield page
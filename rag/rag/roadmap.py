@@ -0,0 +1,91 @@
+"""Roadmap facets of a chunk, tagged once at ingest time.
+
+Each chunk gets spans (kind, start, end) into its text: sentences stating an action
+to take, a document to bring, a deadline or a place to turn to, and contact details
+(email addresses, phone numbers, links). The chat roadmap is built by looking these
+up for the retrieved chunk ids instead of scanning every returned chunk per request.
+Patterns match whole words and phrases in English and Norwegian.
+"""
+import re
+
+ROADMAP_KINDS = ("action", "document", "deadline", "resource", "contact")
+ACTION, DOCUMENT, DEADLINE, RESOURCE, CONTACT = range(len(ROADMAP_KINDS))
+# Sentences kept per kind and chunk
+MAX_SENTENCES = 2
+
+_NUMBER = r"(?:\d+|one|two|three|four|five|six|seven|eight|nine|ten|twelve|en|ett|to|tre|fire|fem|seks|sju|syv|åtte|ni|ti|tolv)"
+# Norwegian modals and "pass" are common in ordinary prose ("det må være", "passet godt"),
+# so they only count in a phrase with a verb of what to do, or a word marking the passport
+_NO_ACTION_VERBS = (r"(?:søke|levere|sende|registrere|melde|ta med|ha med|bestille|fylle ut|betale|legge ved|"
+                    r"møte|dokumentere|vise|kontakte|fornye|oppgi|laste opp|signere)")
+_SENTENCE_PATTERNS = {
+    ACTION: re.compile(
+        r"\b(?:must|need(?:s)? to|ha(?:ve|s) to|should|required to|apply(?: for)?|register|submit|book an appointment|"
+        rf"(?:må|skal|bør)(?: (?:du|man|dere|de|vi|han|hun|søkeren|arbeidsgiveren))?(?: også| ikke)? {_NO_ACTION_VERBS}|"
+        r"søk(?:e)? om|registrer(?:e)?|send(?:e)? inn|bestill(?:e)? time)\b", re.I),
+    DOCUMENT: re.compile(
+        r"\b(?:documents?|documentation|forms?|passports?|id[- ]cards?|identity cards?|identification|certificates?|"
+        r"residence cards?|d-number|dokument(?:er|ene|asjon)?|skjema(?:er|et)?|id-kort|legitimasjon|"
+        r"(?:gyldig|ditt|nytt|norsk|utenlandsk|kopi av|med|ta med|vis|fremvis) pass(?:et)?|pass(?:et)? ditt|"
+        r"pass (?:og|eller)|reisedokument(?:er|et)?|"
+        r"attest(?:er)?|fødselsattest|vigselsattest|oppholdskort|d-nummer)\b", re.I),
+    DEADLINE: re.compile(
+        rf"\b(?:deadlines?|no later than|at the latest|expires?|within {_NUMBER} (?:days?|weeks?|months?|years?)|"
+        rf"frist(?:en)?|senest|utløper|innen {_NUMBER} (?:dager|dag|uker|uke|måneder|måned|år))\b", re.I),
+    RESOURCE: re.compile(
+        r"\b(?:contact(?: us)?|service cent(?:re|er)s?|tax office|police station|website|helpline|customer service|"
+        r"kontakt(?:e)?|tjenestested(?:et)?|servicesenter(?:et)?|skattekontor(?:et)?|politistasjon(?:en)?|nettside(?:n)?|"
+        r"veiledning)\b", re.I),
+}
+_CONTACT_PATTERNS = [
+    re.compile(r"\b[\w.+-]+@[\w-]+(?:\.[\w-]+)+\b"),
+    re.compile(r"\bhttps?://[^\s<>\"')\]]+[^\s<>\"')\].,;:!?]"),
+    re.compile(r"(?<!/)\bwww\.[^\s<>\"')\]]+[^\s<>\"')\].,;:!?]"),
+    # International numbers anywhere, otherwise only right after a phone label; the
+    # contact is the first group where there is one
+    re.compile(r"\+\d{2}(?:[ -]?\d){7,12}\b"),
+    re.compile(r"\b(?:phone|telephone|tlf|tel|telefon|ring)\.?:? (\d(?:[ -]?\d){7})\b", re.I),
+]
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def _sentences(text):
+    start = 0
+    for match in _SENTENCE_END.finditer(text):
+        yield start, match.start()
+        start = match.end()
+    if start < len(text):
+        yield start, len(text)
+
+
+def find_spans(text):
+    """(kind, start, end) facet spans of a chunk's text, in text order per kind"""
+    spans = []
+    counts = dict.fromkeys(_SENTENCE_PATTERNS, 0)
+    for start, end in _sentences(text):
+        sentence = text[start:end]
+        for kind, pattern in _SENTENCE_PATTERNS.items():
+            if counts[kind] < MAX_SENTENCES and pattern.search(sentence):
+                spans.append((kind, start, end))
+                counts[kind] += 1
+    seen = set()
+    for pattern in _CONTACT_PATTERNS:
+        group = 1 if pattern.groups else 0
+        for match in pattern.finditer(text):
+            if match.group(group) not in seen:
+                seen.add(match.group(group))
+                spans.append((CONTACT, match.start(group), match.end(group)))
+    return spans
+
+
+def spans_to_facets(text, spans):
+    """{kind: [text]} for the kinds present in spans"""
+    facets = {}
+    for kind, start, end in spans:
+        facets.setdefault(ROADMAP_KINDS[kind], {})[text[start:end].strip()] = None
+    return {kind: list(items) for kind, items in facets.items()}
+
+
+def text_facets(text):
+    """Facets of a chunk that was not tagged at ingest time"""
+    return spans_to_facets(text, find_spans(text))
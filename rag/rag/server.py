@@ -1,16 +1,114 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from rag.db import make_db, rerank, load_pickled_db
-from rag.query import query_with_context, translate_query
+from rag import tracing
+from rag.db import rerank, load_pickled_db, fuse_results, DB_PATH
+from rag.query import query_with_context, stream_with_context, translate_query, create_client
+from rag.store import MappedDatabase, current_version
+from rag.encoder import RemoteEncoder
+from rag.backends import load_encoder, warm_up
+from rag.live import LiveSegment
+from rag.records import iter_pages
+from rag.prefetch import PrefetchCache
+from rag.shards import ShardedDatabase, decode_vector, shard_search, shard_stats
+from rag.admission import BULK, INTERACTIVE, Gate, Overloaded
 import asyncio
+import contextlib
+import json
+import os
+import time
+import threading
 
 app = FastAPI()
 
+# Per-stage deadlines in seconds. Retrieval and generation are required, rerank is
+# skipped (falling back to the fused dense/lexical order) when it runs over budget.
+RETRIEVE_BUDGET = float(os.environ.get("RAG_RETRIEVE_BUDGET", 2.0))
+RERANK_BUDGET = float(os.environ.get("RAG_RERANK_BUDGET", 1.5))
+GENERATE_BUDGET = float(os.environ.get("RAG_GENERATE_BUDGET", 25.0))
+# Start generating from the fused top-k while rerank runs, keep it if rerank agrees
+SPECULATIVE_GENERATION = os.environ.get("RAG_SPECULATIVE_GENERATION", "1") == "1"
+# Vector index used for dense search: exact, ann or quantized (see rag.index)
+INDEX_MODE = os.environ.get("RAG_INDEX_MODE", "exact")
+# Shared serving mode: map the CURRENT version under this directory (see rag.store)
+# instead of loading the pickle, and poll it for new versions to hot-swap to
+INDEX_DIR = os.environ.get("RAG_INDEX_DIR")
+RELOAD_INTERVAL = float(os.environ.get("RAG_RELOAD_INTERVAL", 10.0))
+# Shared query encoder service (see rag.encoder), otherwise every worker loads the model
+ENCODER_URL = os.environ.get("RAG_ENCODER_URL")
+# Otherwise the query encoder runs in-process on this backend (see rag.backends),
+# with RAG_ENCODER_THREADS intra-op threads
+ENCODER_BACKEND = os.environ.get("RAG_ENCODER_BACKEND", "torch")
+ENCODER_THREADS = int(os.environ.get("RAG_ENCODER_THREADS", 0)) or None
+# Bind right away and load the index in the background (reported by /health and
+# /ready); with 0, startup blocks until the index is loaded and fails if it can't be
+BACKGROUND_LOAD = os.environ.get("RAG_BACKGROUND_LOAD", "1") == "1"
+# Build the index from the crawl file (RAG_CRAWL_FILE) when the pickle is missing,
+# a full ingest and re-embed; otherwise a missing index fails startup
+REBUILD_INDEX = os.environ.get("RAG_REBUILD_INDEX", "0") == "1"
+# Accept crawled pages on /ingest and serve them from an in-memory segment (see rag.live)
+LIVE_INGEST = os.environ.get("RAG_LIVE_INGEST", "0") == "1"
+# Retrieval started by /prefetch while the user types is reused by /query for the same
+# session_id within this many seconds, if the sent text is at least this similar
+PREFETCH_TTL = float(os.environ.get("RAG_PREFETCH_TTL", 30.0))
+PREFETCH_SIMILARITY = float(os.environ.get("RAG_PREFETCH_SIMILARITY", 0.9))
+# Coordinate a sharded index (see rag.shards): comma-separated shard server URLs, each
+# searched within RAG_SHARD_TIMEOUT seconds of the query or left out of its results
+SHARDS = [url for url in os.environ.get("RAG_SHARDS", "").split(",") if url]
+SHARD_TIMEOUT = float(os.environ.get("RAG_SHARD_TIMEOUT", 1.5))
+# Serve as a shard of a coordinator: queries arrive encoded, so no encoder is loaded
+SHARD_NODE = os.environ.get("RAG_SHARD_NODE", "0") == "1"
+# Admission control (see rag.admission): concurrent calls per upstream, calls queued
+# beyond them, and seconds a chat (interactive) or translation (bulk) call may queue
+LLM_CONCURRENCY = int(os.environ.get("RAG_LLM_CONCURRENCY", 16))
+RERANK_CONCURRENCY = int(os.environ.get("RAG_RERANK_CONCURRENCY", 8))
+QUEUE_LIMIT = int(os.environ.get("RAG_QUEUE_LIMIT", 64))
+QUEUE_TIMEOUT = float(os.environ.get("RAG_QUEUE_TIMEOUT", 5.0))
+BULK_QUEUE_TIMEOUT = float(os.environ.get("RAG_BULK_QUEUE_TIMEOUT", 30.0))
+
+
+class SearchFilters(BaseModel):
+    # Any of the listed values matches; a domain also matches its subdomains
+    language: list[str] = []
+    domain: list[str] = []
+    type: list[str] = []
+
 
 class QueryRequest(BaseModel):
     query: str
     k: int = 10
     rerank: bool = False
+    # Also return every retrieved source (not only the cited ones) under "sources"
+    include_sources: bool = False
+    # Compact summary of earlier turns, used for retrieval and given to the LLM
+    history: str = ""
+    # Only search chunks matching these (e.g. {"language": ["no"], "domain": ["skatteetaten.no"]})
+    filters: SearchFilters = SearchFilters()
+    # Chat session, whose /prefetch retrieval is reused when the query is close to it
+    session_id: str | None = None
+
+
+class ShardStatsRequest(BaseModel):
+    query: str
+
+
+class ShardSearchRequest(BaseModel):
+    # Base64 float32 query embedding, encoded by the coordinator
+    vector: str
+    query: str
+    k: int = 10
+    filters: SearchFilters = SearchFilters()
+    # Global BM25 statistics: n, length and df summed over the shards
+    corpus: dict | None = None
+
+
+class ChunksRequest(BaseModel):
+    ids: list[str]
+
+
+class IngestRequest(BaseModel):
+    # Crawler records: url, title, heading, content and metadata per page section
+    records: list[dict]
 
 
 class TranslateRequest(BaseModel):
@@ -19,30 +117,413 @@ class TranslateRequest(BaseModel):
 
 
 db = None
+live = None
+prefetched = PrefetchCache(PREFETCH_TTL, PREFETCH_SIMILARITY)
+llm = Gate("llm", LLM_CONCURRENCY, QUEUE_LIMIT, {INTERACTIVE: QUEUE_TIMEOUT, BULK: BULK_QUEUE_TIMEOUT})
+# Rerank is skipped rather than waited for beyond its budget
+reranker = Gate("rerank", RERANK_CONCURRENCY, QUEUE_LIMIT, {INTERACTIVE: RERANK_BUDGET, BULK: RERANK_BUDGET})
+# Startup progress: state is starting, loading, ready or failed
+status = {"state": "starting", "stage": None, "error": None, "version": None, "chunks": None}
+started_at = time.time()
+stage_started_at = started_at
+
+
+def set_stage(stage):
+    global stage_started_at
+    stage_started_at = time.time()
+    status.update(state="loading", stage=stage)
+    print(f"Startup: {stage}")
+
+
+def load_db():
+    encoder = RemoteEncoder(ENCODER_URL) if ENCODER_URL else None
+    if SHARDS:
+        set_stage("connecting to shards")
+        return ShardedDatabase(SHARDS, encoder, timeout=SHARD_TIMEOUT, backend=ENCODER_BACKEND, threads=ENCODER_THREADS)
+    if INDEX_DIR:
+        set_stage("mapping index")
+        return MappedDatabase(INDEX_DIR, encoder, backend=ENCODER_BACKEND, threads=ENCODER_THREADS, encode=not SHARD_NODE)
+    set_stage("rebuilding index" if REBUILD_INDEX and not os.path.exists(DB_PATH) else "loading index")
+    database = load_pickled_db(rebuild=REBUILD_INDEX)
+    if getattr(database, "vectors", None) is None or database.index_mode != INDEX_MODE:
+        set_stage("building vector index")
+        database.build_vector_index(INDEX_MODE)
+    if encoder is None and (ENCODER_BACKEND != "torch" or ENCODER_THREADS):
+        set_stage("loading query encoder")
+        encoder = load_encoder(database.model, ENCODER_BACKEND, ENCODER_THREADS)
+    if encoder is not None:
+        database.st = encoder
+    return database
+
+
+async def load():
+    """Load the index and warm up, then start serving queries"""
+    global db, live
+    try:
+        database = await asyncio.to_thread(load_db)
+        # Warm up the query encoder and the shared LLM client before the first request
+        set_stage("warming up")
+        if database.st is not None:
+            await asyncio.to_thread(warm_up, database.st)
+        create_client()
+    except Exception as e:
+        status.update(state="failed", error=repr(e))
+        print(f"Startup failed in stage {status['stage']!r}: {e!r}")
+        return
+    db = database
+    if LIVE_INGEST:
+        live = LiveSegment(db.st)
+    status.update(state="ready", stage=None, version=getattr(db, "version", None), chunks=len(db))
+    print(f"Ready after {time.time() - started_at:.1f}s: {len(db)} chunks")
+    if INDEX_DIR:
+        asyncio.create_task(watch_index())
+
+
+def require_ready():
+    if db is None:
+        raise HTTPException(status_code=503, detail=f"Index not ready ({status['state']})", headers={"Retry-After": "5"})
+    return db
+
+
+async def reload_db():
+    """Swap to the CURRENT index version if it changed; in-flight requests keep the old one"""
+    global db
+    if db is not None and current_version(INDEX_DIR) == db.version:
+        return False
+    db = await asyncio.to_thread(MappedDatabase, INDEX_DIR, db.st if db is not None else None, encode=not SHARD_NODE)
+    status.update(version=db.version, chunks=len(db))
+    if live is not None:
+        # Pages the new version read after they were ingested are served from it again;
+        # later re-ingests stay live, as the version's copy is older
+        dropped = await asyncio.to_thread(live.drop_urls, set(db.table.urls), db.built_at)
+        print(f"Dropped {dropped} live pages now in version {db.version}")
+    return True
+
+
+async def watch_index():
+    while True:
+        await asyncio.sleep(RELOAD_INTERVAL)
+        try:
+            await reload_db()
+        except Exception as e:
+            print(f"Index reload failed, keeping version {db.version}: {e!r}")
 
 
 @app.on_event("startup")
 async def startup_event():
-    global db
-    db = load_pickled_db()
+    if BACKGROUND_LOAD:
+        app.state.loader = asyncio.create_task(load())
+        return
+    await load()
+    if status["state"] != "ready":
+        raise RuntimeError(f"Could not load the index: {status['error']}")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if isinstance(db, ShardedDatabase):
+        await db.aclose()
+
+
+async def retrieve(database, query, k, filters=None):
+    if SHARDS:
+        return await database.retrieve(query, k, filters)
+    # Lexical search needs no embedding, so it runs while the query is being encoded
+    encoded_query, lexical = await asyncio.gather(
+        asyncio.to_thread(database.encode_query, query),
+        asyncio.to_thread(database.lexical_query, query, k, filters),
+    )
+    dense = await asyncio.to_thread(database.search, encoded_query, k, filters)
+    segment = live
+    if segment is None or not len(segment):
+        return fuse_results(dense, lexical, k=k)
+    # Freshly ingested pages with chunks replace their copy in the main index
+    dense = [source for source in dense if source[0].url not in segment]
+    lexical = [source for source in lexical if source[0].url not in segment]
+    live_dense, live_lexical = await asyncio.gather(
+        asyncio.to_thread(segment.search, encoded_query, k, filters),
+        asyncio.to_thread(segment.lexical_query, query, k, filters),
+    )
+    return fuse_results(dense, lexical, live_dense, live_lexical, k=k)
+
+
+async def generate(request, sources, stop=None):
+    # Setting stop closes the LLM stream, as cancelling the task can't stop its thread
+    stop = stop or threading.Event()
+    async with llm.admit(INTERACTIVE) as slot:
+        try:
+            return await asyncio.wait_for(
+                slot.run(query_with_context, request.query, sources,
+                         include_sources=request.include_sources, history=request.history, stop=stop),
+                GENERATE_BUDGET,
+            )
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Generation exceeded its deadline")
+        finally:
+            stop.set()
+
+
+async def retrieve_candidates(database, request, filters):
+    """Retrieval candidates for a query, reusing its session's prefetch when close enough"""
+    n = 5*request.k if request.rerank else request.k
+    query = retrieval_query(request)
+    candidates = await prefetched.take(request.session_id, database, query, n, filters)
+    if request.session_id:
+        tracing.annotate(prefetch_hit=candidates is not None)
+    if candidates is None:
+        candidates = await asyncio.wait_for(retrieve(database, query, n, filters), RETRIEVE_BUDGET)
+    return candidates
+
+
+def _same_sources(a, b):
+    return {chunk.strip() for _, chunk in a} == {chunk.strip() for _, chunk in b}
+
+
+async def admitted_rerank(query, candidates, k):
+    async with reranker.admit(INTERACTIVE) as slot:
+        return await slot.run(rerank, query, candidates, k)
+
+
+async def budgeted_rerank(query, candidates, k):
+    try:
+        return await asyncio.wait_for(admitted_rerank(query, candidates, k), RERANK_BUDGET)
+    except asyncio.TimeoutError:
+        print(f"Rerank exceeded {RERANK_BUDGET}s budget, using fused order")
+    except Overloaded as e:
+        print(f"Rerank shed ({e.reason}), using fused order")
+    except Exception as e:
+        print(f"Rerank failed, using fused order: {e!r}")
+    tracing.annotate(rerank_skipped=True)
+    return candidates[:k]
+
+
+async def rerank_and_generate(request, candidates):
+    fallback = candidates[:request.k]
+    # Only speculate with an LLM slot to spare, not at the expense of queued requests
+    speculative = None
+    if SPECULATIVE_GENERATION and llm.idle():
+        stop, started = threading.Event(), time.monotonic()
+        speculative = asyncio.create_task(generate(request, fallback, stop))
+    sources = await budgeted_rerank(retrieval_query(request), candidates, request.k)
+
+    if speculative is not None:
+        hit = _same_sources(sources, fallback)
+        tracing.annotate(speculative_hit=hit)
+        tracing.registry.inc("rag_speculative_generations", outcome="hit" if hit else "wasted")
+        if hit:
+            return await speculative
+        # Abort the LLM request rather than paying for a second full generation
+        stop.set()
+        speculative.cancel()
+        # Collected so that a generation that had already failed isn't logged as unretrieved;
+        # whatever it raised doesn't concern this request
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await speculative
+        tracing.registry.inc("rag_speculative_wasted_seconds", time.monotonic() - started)
+    return await generate(request, sources)
+
+
+def retrieval_query(request):
+    # Earlier turns make follow-up questions retrievable without repeating their context
+    return f"{request.history}\n{request.query}" if request.history else request.query
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request, exc):
+    return JSONResponse({"detail": str(exc)}, status_code=exc.status, headers={"Retry-After": str(exc.retry_after)})
 
 @app.post("/query")
 async def query_endpoint(request: QueryRequest):
     print("Got query", request)
-    if db is None:
-        return {"success": False}
-    if request.rerank:
-        sources = db.query(request.query, k=5*request.k)
-        sources = rerank(request.query, sources, request.k)
-    else:
-        sources = db.query(request.query, k=request.k)    
+    database = require_ready()
+    # Shed before retrieving for a request whose generation would be rejected anyway
+    llm.check(INTERACTIVE)
+    with tracing.trace("query") as t:
+        filters = request.filters.dict()
+        t.attributes.update(k=request.k, rerank=request.rerank, filtered=any(filters.values()))
+        try:
+            candidates = await retrieve_candidates(database, request, filters)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Retrieval exceeded its deadline")
+
+        if request.rerank:
+            result = await rerank_and_generate(request, candidates)
+        else:
+            result = await generate(request, candidates)
+        return add_roadmap(database, result)
+
+@app.post("/query/stream")
+async def query_stream_endpoint(request: QueryRequest):
+    """NDJSON stream of {"type": "token"} events, then a "done" event with the /query response"""
+    print("Got streaming query", request)
+    database = require_ready()
+    llm.check(INTERACTIVE)
+
+    async def events():
+        with tracing.trace("query_stream") as t:
+            filters = request.filters.dict()
+            t.attributes.update(k=request.k, rerank=request.rerank, filtered=any(filters.values()))
+            try:
+                candidates = await retrieve_candidates(database, request, filters)
+            except asyncio.TimeoutError:
+                yield json.dumps({"type": "error", "detail": "Retrieval exceeded its deadline"}) + "\n"
+                return
+            sources = await budgeted_rerank(retrieval_query(request), candidates, request.k) if request.rerank else candidates
+            # One thread streams the whole answer into the queue; stop ends it when the client leaves
+            stop, queue, loop = threading.Event(), asyncio.Queue(), asyncio.get_running_loop()
 
-    return query_with_context(request.query, sources)
+            def produce():
+                try:
+                    for event in stream_with_context(request.query, sources, include_sources=request.include_sources,
+                                                     history=request.history, stop=stop):
+                        loop.call_soon_threadsafe(queue.put_nowait, event)
+                finally:
+                    loop.call_soon_threadsafe(queue.put_nowait, None)
+
+            try:
+                async with llm.admit(INTERACTIVE) as slot:
+                    producing = slot.start(produce)
+                    try:
+                        while True:
+                            event = await queue.get()
+                            if event is None:
+                                break
+                            if event["type"] == "sources":
+                                # The done event shares these entries, so it carries the facets too
+                                add_roadmap(database, {"docs": event["docs"]})
+                            yield json.dumps(event, ensure_ascii=False, default=list) + "\n"
+                        await producing
+                    finally:
+                        stop.set()
+            except Overloaded as e:
+                yield json.dumps({"type": "error", "detail": str(e), "retry_after": e.retry_after}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+@app.post("/prefetch")
+async def prefetch_endpoint(request: QueryRequest):
+    """Start retrieval for a partially typed query, for /query with the same session_id
+    to reuse; returns without waiting for it"""
+    if not request.session_id:
+        raise HTTPException(status_code=400, detail="session_id is required")
+    database = require_ready()
+    n = 5*request.k if request.rerank else request.k
+    query, filters = retrieval_query(request), request.filters.dict()
+    prefetched.start(request.session_id, database, query, n, filters,
+                     lambda: asyncio.wait_for(retrieve(database, query, n, filters), RETRIEVE_BUDGET))
+    return {"prefetching": True}
+
+def get_roadmap(database, cid):
+    found = live.get_roadmap(cid) if live is not None else None
+    return found if found is not None else database.get_roadmap(cid)
+
+def add_roadmap(database, result):
+    """Attach the ingest-time roadmap facets of each cited and retrieved chunk, so a
+    roadmap needs no further query"""
+    for entries in (result.get("docs"), result.get("sources")):
+        for entry in (entries or {}).values():
+            if "roadmap" not in entry:
+                entry["roadmap"] = get_roadmap(database, entry["id"]) or {}
+    return result
+
+def chunk_record(database, cid):
+    found = live.get_chunk(cid) if live is not None else None
+    found = found or database.get_chunk(cid)
+    if found is None:
+        return None
+    doc, chunk, heading = found
+    return {"id": cid, "url": doc.url, "title": doc.title, "heading": heading, "content": chunk}
+
+@app.get("/chunks/{chunk_id}")
+async def chunk_endpoint(chunk_id: str):
+    record = await asyncio.to_thread(chunk_record, require_ready(), chunk_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Unknown chunk {chunk_id!r}")
+    return record
+
+@app.post("/chunks")
+async def chunks_endpoint(request: ChunksRequest):
+    """Chunks by id; unknown ids are left out"""
+    database = require_ready()
+    # A coordinator may ask its shards for chunks it has not retrieved recently
+    records = await asyncio.to_thread(lambda: [chunk_record(database, cid) for cid in request.ids])
+    return {"chunks": {record["id"]: record for record in records if record is not None}}
+
+@app.post("/shard/stats")
+async def shard_stats_endpoint(request: ShardStatsRequest):
+    """BM25 corpus statistics of this shard for a query, summed by the coordinator"""
+    return shard_stats(require_ready(), request.query)
+
+@app.post("/shard/search")
+async def shard_search_endpoint(request: ShardSearchRequest):
+    """Scored top k of this shard for a query encoded by the coordinator"""
+    database = require_ready()
+    with tracing.trace("shard_search"):
+        return await asyncio.to_thread(shard_search, database, decode_vector(request.vector), request.query,
+                                       request.k, request.filters.dict(), request.corpus)
+
+@app.post("/ingest")
+async def ingest_endpoint(request: IngestRequest):
+    """Chunk, encode and serve crawled pages right away"""
+    if not LIVE_INGEST:
+        raise HTTPException(status_code=400, detail="Live ingest is disabled, set RAG_LIVE_INGEST=1")
+    require_ready()
+    pages = list(iter_pages(request.records))
+    with tracing.trace("ingest") as t:
+        chunks = await asyncio.to_thread(live.add_pages, pages)
+        t.attributes.update(pages=len(pages), chunks=chunks)
+    return {"pages": len(pages), "chunks": chunks, "live_chunks": len(live)}
 
 @app.post("/translate")
 async def translate_endpoint(request: TranslateRequest):
+    # Bulk work: waits behind chat for LLM slots and is shed first
+    llm.check(BULK)
+
     async def translate_document(doc):
-        return await asyncio.to_thread(translate_query, request.question, doc)
+        async with llm.admit(BULK) as slot:
+            return await slot.run(translate_query, request.question, doc)
 
-    translations = await asyncio.gather(*(translate_document(doc) for doc in request.documents))
+    with tracing.trace("translate") as t:
+        t.attributes.update(documents=len(request.documents))
+        tasks = [asyncio.create_task(translate_document(doc)) for doc in request.documents]
+        try:
+            translations = await asyncio.gather(*tasks)
+        except Overloaded:
+            # The request fails as a whole, so its other documents give up their places
+            for task in tasks:
+                task.cancel()
+            raise
     return {"translations": translations}
+
+@app.post("/admin/reload")
+async def reload_endpoint():
+    if not INDEX_DIR:
+        raise HTTPException(status_code=400, detail="Not serving from RAG_INDEX_DIR")
+    require_ready()
+    swapped = await reload_db()
+    return {"version": db.version, "swapped": swapped}
+
+def startup_report():
+    now = time.time()
+    report = dict(status, uptime_seconds=round(now - started_at, 3))
+    if status["state"] == "loading":
+        report["stage_seconds"] = round(now - stage_started_at, 3)
+    return report
+
+@app.get("/health")
+async def health_endpoint():
+    """Liveness: 200 while starting, loading or serving, 503 once loading has failed"""
+    if status["state"] == "failed":
+        return JSONResponse(startup_report(), status_code=503)
+    return startup_report()
+
+@app.get("/ready")
+async def ready_endpoint():
+    """Readiness: 200 once the index is loaded and queries are served"""
+    if status["state"] != "ready":
+        return JSONResponse(startup_report(), status_code=503, headers={"Retry-After": "5"})
+    return startup_report()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return tracing.registry.render()
@@ -0,0 +1,361 @@
+"""Sharded index: the corpus split across shard servers, searched by a coordinator.
+
+Pages are assigned to shards by domain (an agency site stays on one shard) or by URL
+hash, and each shard is an ordinary index root served by rag.server:
+
+    poetry run python -m rag.shards build output/nordic_all.jsonl --root ~/rag_shards --shards 4
+    poetry run python -m rag.shards serve --root ~/rag_shards --port 8901
+    RAG_SHARDS=http://127.0.0.1:8901,... poetry run uvicorn rag.server:app --port 8888
+
+The coordinator encodes each query once and scatters it to every shard with one
+deadline (RAG_SHARD_TIMEOUT). BM25 scores are only comparable across shards under
+the same corpus statistics, so it first gathers each shard's document count, total
+length and query-term document frequencies, and every shard then scores with their
+sums. Dense and lexical hits are merged by score into the global top k and fused as
+on a single node, so the ranking matches one index over the whole corpus. Shards that
+fail or miss the deadline are left out of the result.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import argparse
+import threading
+import subprocess
+import urllib.request
+from queue import Queue
+from collections import Counter, OrderedDict
+from urllib.parse import urlparse
+import httpx
+import numpy as np
+from rag import tracing
+from rag.backends import load_encoder
+from rag.chunks import Document, chunk_id
+from rag.db import fuse_results
+from rag.index import INDEX_MODES
+from rag.ingest import DEFAULT_MODEL, stream_ingest
+from rag.records import iter_records
+
+SHARD_KEYS = ("domain", "hash")
+# Hits kept by the coordinator so cited chunks resolve without asking the shards
+RECENT_CHUNKS = 10000
+
+
+def shard_of(url, shards, by="domain"):
+    """Shard of a page: by its domain (without www.) or by its whole URL"""
+    key = url
+    if by == "domain":
+        key = urlparse(url).netloc.lower().removeprefix("www.")
+    return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "little") % shards
+
+
+def shard_root(root, shard):
+    return os.path.join(root, f"shard-{shard:02d}")
+
+
+def encode_vector(vector):
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def decode_vector(data):
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32)
+
+
+def shard_stats(database, query):
+    """This shard's BM25 corpus statistics for query (see LexicalIndex.stats)"""
+    if getattr(database, "lexical", None) is None:
+        database.build_lexical_index()
+    return dict(database.lexical.stats(query), model=database.model)
+
+
+def _hits(database, rows, scores, filters):
+    table = database.table
+    hits = []
+    for row, score in zip(rows.tolist(), scores.tolist()):
+        doc, chunk = table.document(row, filters), table.chunk(row)
+        hits.append({
+            "score": score, "id": chunk_id(doc.url, chunk), "url": doc.url, "title": doc.title,
+            "metadata": doc.metadata, "heading": table.heading(row), "content": chunk, "roadmap": table.roadmap(row),
+        })
+    return hits
+
+
+def shard_search(database, vector, query, k=10, filters=None, corpus=None):
+    """Scored dense and lexical top k of this shard, lexical scores under the global corpus statistics"""
+    if getattr(database, "vectors", None) is None:
+        database.build_vector_index()
+    if getattr(database, "lexical", None) is None:
+        database.build_lexical_index()
+    rows = database.filter_rows(filters)
+    scores, dense = database.vectors.search(vector, k, rows=rows)
+    with tracing.span("lexical"):
+        lexical, lexical_scores = database.lexical.scored_search(query, k, rows=rows, corpus=corpus)
+    return {"dense": _hits(database, dense, scores, filters), "lexical": _hits(database, lexical, lexical_scores, filters)}
+
+
+def _post(url, data, timeout):
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.load(response)
+
+
+class ShardedDatabase:
+    """Coordinator over shard servers, used by rag.server in place of a local index"""
+    def __init__(self, urls, st=None, timeout=1.5, backend="torch", threads=None):
+        self.urls = [url.rstrip("/") for url in urls]
+        self.timeout = timeout
+        # Chunks per shard, as of the last statistics it sent
+        self.chunks = {}
+        models = set()
+        for url in self.urls:
+            try:
+                stats = _post(f"{url}/shard/stats", json.dumps({"query": ""}).encode(), timeout)
+            except Exception as e:
+                print(f"Shard {url} is not answering yet: {e!r}")
+                continue
+            self.chunks[url] = stats["n"]
+            models.add(stats["model"])
+        if len(models) > 1:
+            raise ValueError(f"Shards were encoded with different models: {sorted(models)}")
+        self.model = models.pop() if models else DEFAULT_MODEL
+        self.st = st if st is not None else load_encoder(self.model, backend, threads)
+        self.recent = OrderedDict()
+        # Created on first use, in the server's event loop
+        self.client = None
+        print(f"Coordinating {len(self.urls)} shards, {len(self.chunks)} answering with {len(self)} chunks")
+
+    def __len__(self):
+        return sum(self.chunks.values())
+
+    def encode_query(self, query):
+        with tracing.span("encode"):
+            return self.st.encode(f"query: {query}", normalize_embeddings=True)
+
+    async def _request(self, url, data, deadline):
+        if self.client is None:
+            self.client = httpx.AsyncClient(headers={"Content-Type": "application/json"})
+        response = await self.client.post(url, content=data, timeout=max(deadline - time.monotonic(), 0.001))
+        response.raise_for_status()
+        return response.json()
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def _scatter(self, urls, path, body, deadline):
+        """{url: response} of the shards answering path before deadline"""
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        # Requests are coroutines, so a shard missing the deadline is cancelled rather
+        # than left holding a thread until its timeout
+        tasks = {asyncio.ensure_future(self._request(url + path, data, deadline)): url for url in urls}
+        done, pending = await asyncio.wait(tasks, timeout=max(deadline - time.monotonic(), 0))
+        for task in pending:
+            task.cancel()
+            print(f"Shard {tasks[task]} missed the deadline on {path}")
+        results = {}
+        for task in done:
+            if task.exception() is not None:
+                print(f"Shard {tasks[task]} failed on {path}: {task.exception()!r}")
+            else:
+                results[tasks[task]] = task.result()
+        if not results:
+            raise asyncio.TimeoutError(f"No shard answered {path} in time")
+        return {url: results[url] for url in urls if url in results}
+
+    def _merge(self, results, k):
+        """Global top k (doc, chunk) of per-shard hits, each chunk text once"""
+        hits = sorted((hit for hits in results for hit in hits), key=lambda hit: -hit["score"])
+        sources, seen = [], set()
+        for hit in hits:
+            key = hit["content"].strip()
+            if key in seen:
+                continue
+            seen.add(key)
+            self.recent[hit["id"]] = hit
+            self.recent.move_to_end(hit["id"])
+            sources.append((Document(hit["url"], [], title=hit["title"], metadata=hit["metadata"]), hit["content"]))
+            if len(sources) == k:
+                break
+        while len(self.recent) > RECENT_CHUNKS:
+            self.recent.popitem(last=False)
+        return sources
+
+    async def retrieve(self, query, k=10, filters=None):
+        """Fused dense and lexical top k over every shard answering before the deadline"""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with tracing.span("shard_stats"):
+            # Statistics are cheap, a shard not sending them within half the deadline is
+            # left out so that the others still have time to search
+            encoded, stats = await asyncio.gather(
+                asyncio.to_thread(self.encode_query, query),
+                self._scatter(self.urls, "/shard/stats", {"query": query}, start + self.timeout / 2),
+            )
+        df = Counter()
+        for url, result in stats.items():
+            self.chunks[url] = result["n"]
+            df.update(result["df"])
+        corpus = {"n": sum(r["n"] for r in stats.values()), "length": sum(r["length"] for r in stats.values()), "df": df}
+        body = {"vector": encode_vector(encoded), "query": query, "k": k, "filters": filters or {}, "corpus": corpus}
+        with tracing.span("shard_search"):
+            results = await self._scatter(list(stats), "/shard/search", body, deadline)
+        tracing.annotate(shards_partial=len(results) < len(self.urls))
+        dense = self._merge([result["dense"] for result in results.values()], k)
+        lexical = self._merge([result["lexical"] for result in results.values()], k)
+        return fuse_results(dense, lexical, k=k)
+
+    def get_chunk(self, cid):
+        """(doc, chunk, heading) for a chunk id, or None; recent hits are answered locally"""
+        hit = self.recent.get(cid)
+        if hit is not None:
+            return Document(hit["url"], [], title=hit["title"], metadata=hit["metadata"]), hit["content"], hit["heading"]
+        for url in self.urls:
+            try:
+                record = _post(f"{url}/chunks", json.dumps({"ids": [cid]}).encode(), self.timeout)["chunks"].get(cid)
+            except Exception as e:
+                print(f"Shard {url} failed on /chunks: {e!r}")
+                continue
+            if record is not None:
+                return Document(record["url"], [], title=record["title"]), record["content"], record["heading"]
+        return None
+
+    def get_roadmap(self, cid):
+        """Roadmap facets of a recently retrieved chunk id, or None"""
+        hit = self.recent.get(cid)
+        return hit["roadmap"] if hit is not None else None
+
+
+class _LockedEncoder:
+    """An encoder shared by the shard writers, encoding one batch at a time, as a
+    SentenceTransformer is not safe to call from several threads at once"""
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.lock = threading.Lock()
+
+    def encode(self, texts, **kwargs):
+        with self.lock:
+            return self.encoder.encode(texts, **kwargs)
+
+
+class _Aborted(Exception):
+    """Raised in a shard writer when the build stops before the end of the crawl"""
+
+
+def build_shards(path, root, shards, encoder, by="domain", model=DEFAULT_MODEL, mode="exact", batch_size=256):
+    """Ingest crawler output into one index root per shard under root"""
+    if by not in SHARD_KEYS:
+        raise ValueError(f"Unknown shard key {by!r}, expected one of {list(SHARD_KEYS)}")
+    # The crawl is read once: each record goes to its shard's writer, a stream_ingest
+    # running in its own thread that takes records from a bounded queue. Writers chunk
+    # and write in parallel and take turns on the encoder
+    encoder = _LockedEncoder(encoder)
+    end = object()
+    queues = [Queue(maxsize=1024) for _ in range(shards)]
+    ended = [False] * shards
+    errors = [None] * shards
+    failed, aborted = threading.Event(), threading.Event()
+
+    def records(shard):
+        while True:
+            record = queues[shard].get()
+            if record is end:
+                ended[shard] = True
+                if aborted.is_set():
+                    # Leaves no new version behind, as stream_ingest removes it on errors
+                    raise _Aborted()
+                return
+            yield record
+
+    def write(shard):
+        try:
+            stream_ingest(records(shard), shard_root(root, shard), encoder, model=model, mode=mode, batch_size=batch_size)
+        except BaseException as e:
+            errors[shard] = e
+            failed.set()
+            # Keep taking records so that the reader never blocks on this queue
+            while not ended[shard] and queues[shard].get() is not end:
+                pass
+
+    threads = [threading.Thread(target=write, args=(shard,)) for shard in range(shards)]
+    for thread in threads:
+        thread.start()
+    print(f"Building {shards} shards")
+    try:
+        for record in iter_records(path):
+            if failed.is_set():
+                break
+            queues[shard_of(record["url"], shards, by)].put(record)
+    except BaseException:
+        aborted.set()
+        raise
+    finally:
+        if failed.is_set():
+            aborted.set()
+        for queue in queues:
+            queue.put(end)
+        for thread in threads:
+            thread.join()
+    for shard, error in enumerate(errors):
+        if error is None or isinstance(error, _Aborted):
+            continue
+        if isinstance(error, ValueError):
+            raise ValueError(f"Shard {shard} got no chunks ({error}), use fewer shards or --by hash") from error
+        raise error
+    # Written last, so serve never starts a partly built layout
+    with open(os.path.join(root, "shards.json"), "w", encoding="utf-8") as f:
+        json.dump({"shards": shards, "by": by, "model": model}, f)
+
+
+def serve_shards(root, port=8901, host="127.0.0.1"):
+    """Run a shard server per shard under root as local processes until interrupted"""
+    with open(os.path.join(root, "shards.json"), encoding="utf-8") as f:
+        layout = json.load(f)
+    processes, urls = [], []
+    for shard in range(layout["shards"]):
+        env = dict(os.environ, RAG_INDEX_DIR=shard_root(root, shard), RAG_SHARD_NODE="1")
+        command = [sys.executable, "-m", "uvicorn", "rag.server:app", "--host", host, "--port", str(port + shard)]
+        processes.append(subprocess.Popen(command, env=env))
+        urls.append(f"http://{host}:{port + shard}")
+    print(f"Started {len(processes)} shards, run the coordinator with RAG_SHARDS={','.join(urls)}")
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and run a sharded index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Ingest crawler output into shards")
+    build.add_argument("path", help="Crawler output, JSON Lines (.jsonl) or a JSON array")
+    build.add_argument("--root", required=True, help="Directory holding one index root per shard")
+    build.add_argument("--shards", type=int, required=True)
+    build.add_argument("--by", choices=list(SHARD_KEYS), default="domain", help="Shard pages by domain or URL hash")
+    build.add_argument("--model", default=DEFAULT_MODEL)
+    build.add_argument("--mode", choices=list(INDEX_MODES), default="exact", help="Vector index mode")
+    build.add_argument("--batch-size", type=int, default=256, help="Chunks per encoder call")
+    serve = subparsers.add_parser("serve", help="Run every shard as a local server process")
+    serve.add_argument("--root", required=True)
+    serve.add_argument("--port", type=int, default=8901, help="Port of the first shard, the others follow")
+    serve.add_argument("--host", default="127.0.0.1")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        from sentence_transformers import SentenceTransformer
+        build_shards(args.path, args.root, args.shards, SentenceTransformer(args.model), by=args.by,
+                     model=args.model, mode=args.mode, batch_size=args.batch_size)
+    else:
+        serve_shards(args.root, args.port, args.host)
+
+
+if __name__ == "__main__":
+    main()
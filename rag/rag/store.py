@@ -0,0 +1,216 @@
+"""Versioned on-disk index that server workers memory-map instead of each loading a copy.
+
+Each export is written to versions/<version>/ and published by atomically repointing
+the CURRENT symlink, so running servers can hot-swap to it:
+
+    poetry run python -m rag.store export --root ~/rag_index --mode ann
+    poetry run python -m rag.store activate --root ~/rag_index 20250210-120000
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+from rag import tracing
+from rag.db import LexicalIndex, load_pickled_db, DB_PATH
+from rag.chunks import ChunkTable
+from rag.backends import load_encoder
+from rag.index import INDEX_MODES
+from rag.filters import Partitions
+
+CURRENT = "CURRENT"
+
+
+def _version_path(root, version):
+    return os.path.join(root, "versions", version)
+
+
+def new_version(root):
+    """A fresh version name and the temporary directory to write it in"""
+    version = time.strftime("%Y%m%d-%H%M%S")
+    while os.path.exists(_version_path(root, version)):
+        version += "-1"
+    tmp = _version_path(root, version) + ".tmp"
+    os.makedirs(tmp)
+    return version, tmp
+
+
+def _built_at(meta):
+    """When a version's pages were read, or for versions written before that was kept,
+    when it was started, which its name records"""
+    if "built_at" in meta:
+        return meta["built_at"]
+    return time.mktime(time.strptime(meta["version"][:15], "%Y%m%d-%H%M%S"))
+
+
+def publish(root, version, tmp, meta, activate_version=True):
+    """Write meta.json and move a fully written version into place"""
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    path = _version_path(root, version)
+    os.rename(tmp, path)
+    print(f"Exported {meta['chunks']} chunks to {path}")
+    if activate_version:
+        activate(root, version)
+    return version
+
+
+def export_index(db, root, mode=None, activate_version=True, built_at=None):
+    """Write the chunk table, vector index and lexical index of db as a new version;
+    built_at is when db's pages were read, by default now"""
+    built_at = time.time() if built_at is None else built_at
+    if getattr(db, "vectors", None) is None or (mode and mode != db.index_mode):
+        db.build_vector_index(mode)
+    if getattr(db, "lexical", None) is None:
+        db.build_lexical_index()
+    if getattr(db, "partitions", None) is None:
+        db.build_partitions()
+
+    version, tmp = new_version(root)
+
+    db.table.save(tmp)
+    vector_arrays = db.vectors.arrays()
+    for name, array in vector_arrays.items():
+        np.save(os.path.join(tmp, f"vectors.{name}.npy"), np.asarray(array))
+    for name, array in db.lexical.arrays().items():
+        np.save(os.path.join(tmp, f"lexical.{name}.npy"), np.asarray(array))
+    for name, array in db.partitions.arrays().items():
+        np.save(os.path.join(tmp, f"partitions.{name}.npy"), np.asarray(array))
+
+    meta = {
+        "version": version,
+        "model": db.model,
+        "built_at": built_at,
+        "index_mode": db.index_mode,
+        "params": db.vectors.params(),
+        "vector_arrays": sorted(vector_arrays),
+        "chunks": len(db.table),
+        **db.table.meta(),
+        "vocabulary": db.lexical.vocabulary,
+        "partitions": db.partitions.values,
+    }
+    return publish(root, version, tmp, meta, activate_version)
+
+
+def activate(root, version):
+    """Atomically point CURRENT at version"""
+    if not os.path.isdir(_version_path(root, version)):
+        raise ValueError(f"No index version {version!r} in {root}")
+    link = os.path.join(root, CURRENT)
+    tmp = link + ".tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(os.path.join("versions", version), tmp)
+    os.replace(tmp, link)
+    print(f"Activated {version}")
+
+
+def current_version(root):
+    return os.path.basename(os.path.realpath(os.path.join(root, CURRENT)))
+
+
+class MappedDatabase:
+    """Read-only RagDatabase backed by a memory-mapped index version
+
+    The arrays live in the page cache and are shared by every process mapping the same
+    version; only the document list, headings and lexical vocabulary are per-process.
+    """
+    def __init__(self, root, st=None, backend="torch", threads=None, encode=True):
+        path = os.path.realpath(os.path.join(root, CURRENT))
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.version = meta["version"]
+        self.model = meta["model"]
+        # Live pages (see rag.live) ingested before this are held by the version
+        self.built_at = _built_at(meta)
+        self.index_mode = meta["index_mode"]
+        # Shard nodes are sent encoded queries (see rag.shards) and load no encoder
+        self.st = st if st is not None or not encode else load_encoder(self.model, backend, threads)
+        self.table = ChunkTable.load(path, meta)
+        self.documents = self.table.documents
+        self.vectors = INDEX_MODES[self.index_mode].from_arrays(
+            {name: load(f"vectors.{name}") for name in meta["vector_arrays"]}, **meta["params"]
+        )
+        self.lexical = LexicalIndex.from_arrays(
+            {name: load(f"lexical.{name}") for name in ("lengths", "rows", "tfs", "offsets")}, meta["vocabulary"]
+        )
+        self.partitions = Partitions.from_arrays(
+            {name: load(f"partitions.{name}") for name in Partitions.array_names()}, meta["partitions"]
+        )
+        print(f"Mapped index version {self.version}: {meta['chunks']} chunks, {self.index_mode} vectors")
+
+    def __len__(self):
+        return len(self.table)
+
+    def chunk(self, row):
+        return self.table.chunk(row)
+
+    def heading(self, row):
+        return self.table.heading(row)
+
+    def get_chunk(self, cid):
+        """(doc, chunk, heading) for a chunk id, or None"""
+        return self.table.get_chunk(cid)
+
+    def get_roadmap(self, cid):
+        """Roadmap facets (see rag.roadmap) of a chunk id, or None"""
+        return self.table.get_roadmap(cid)
+
+    def _sources(self, rows, filters=None):
+        return self.table.sources(rows, filters)
+
+    def filter_rows(self, filters):
+        return self.table.matching_rows(self.partitions.select(filters), filters) if filters else None
+
+    def encode_query(self, query):
+        with tracing.span("encode"):
+            return self.st.encode(f"query: {query}", normalize_embeddings=True)
+
+    def search(self, encoded_query, k=10, filters=None):
+        scores, rows = self.vectors.search(encoded_query, k, rows=self.filter_rows(filters))
+        return self._sources(rows.tolist(), filters)
+
+    def lexical_query(self, query, k=10, filters=None):
+        rows = self.filter_rows(filters)
+        with tracing.span("lexical"):
+            return self._sources(self.lexical.search(query, k, rows=rows), filters)
+
+    def query(self, query, k=10, filters=None):
+        print(f"Running query {query!r}")
+        return self.search(self.encode_query(query), k, filters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage memory-mapped index versions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="Export a pickled database as a new version")
+    export.add_argument("--root", required=True)
+    export.add_argument("--db", default=DB_PATH, help="Pickled RagDatabase")
+    export.add_argument("--mode", choices=list(INDEX_MODES), help="Vector index mode (default: the db's)")
+    export.add_argument("--no-activate", action="store_true", help="Export without switching CURRENT")
+    activate_parser = subparsers.add_parser("activate", help="Point CURRENT at an existing version")
+    activate_parser.add_argument("--root", required=True)
+    activate_parser.add_argument("version")
+    list_parser = subparsers.add_parser("list", help="List versions")
+    list_parser.add_argument("--root", required=True)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        # The pickle was written once its pages had been read
+        export_index(load_pickled_db(args.db), args.root, args.mode, activate_version=not args.no_activate,
+                     built_at=os.path.getmtime(os.path.expanduser(args.db)))
+    elif args.command == "activate":
+        activate(args.root, args.version)
+    else:
+        current = current_version(args.root) if os.path.lexists(os.path.join(args.root, CURRENT)) else None
+        for version in sorted(os.listdir(os.path.join(args.root, "versions"))):
+            if not version.endswith(".tmp"):
+                print(("* " if version == current else "  ") + version)
+
+
+if __name__ == "__main__":
+    main()
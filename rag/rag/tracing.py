@@ -0,0 +1,165 @@
+import os
+import time
+import json
+import uuid
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict
+
+# Set RAG_TRACE_LOG to a path to append one JSON line per finished request
+TRACE_LOG = os.environ.get("RAG_TRACE_LOG")
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current = contextvars.ContextVar("rag_trace", default=None)
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bucket bound containing the q-th quantile"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class Registry:
+    def __init__(self):
+        self.histograms = defaultdict(Histogram)
+        self.counters = defaultdict(float)
+        self.gauges = {}
+
+    def observe(self, name, value, **labels):
+        with _lock:
+            self.histograms[(name, tuple(sorted(labels.items())))].observe(value)
+
+    def inc(self, name, value=1, **labels):
+        with _lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name, value, **labels):
+        with _lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self):
+        """Prometheus text exposition format"""
+        def fmt(labels, **extra):
+            items = list(labels) + list(extra.items())
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        lines = []
+        with _lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}_total{fmt(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{name}{fmt(labels)} {value}")
+            for (name, labels), hist in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{fmt(labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_bucket{fmt(labels, le='+Inf')} {hist.count}")
+                lines.append(f"{name}_sum{fmt(labels)} {hist.sum}")
+                lines.append(f"{name}_count{fmt(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Trace:
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self.attributes = {}
+
+    def record(self, name, seconds, start=None):
+        offset = (start or time.perf_counter() - seconds) - self.start
+        self.spans.append({"name": name, "offset": round(offset, 6), "seconds": round(seconds, 6)})
+        registry.observe("rag_span_seconds", seconds, span=name)
+
+    def finish(self, status="ok"):
+        duration = time.perf_counter() - self.start
+        registry.observe("rag_request_seconds", duration, endpoint=self.name, status=status)
+        registry.inc("rag_requests", endpoint=self.name, status=status)
+        for key, value in self.attributes.items():
+            if isinstance(value, bool):
+                registry.inc("rag_flags", flag=key, state=str(value).lower())
+            elif key.endswith("_tokens") and isinstance(value, (int, float)):
+                registry.inc("rag_tokens", kind=key[:-len("_tokens")], value=value)
+        if TRACE_LOG:
+            entry = {
+                "trace_id": self.id,
+                "name": self.name,
+                "started_at": self.started_at,
+                "seconds": round(duration, 6),
+                "status": status,
+                "attributes": self.attributes,
+                "spans": self.spans,
+            }
+            with _lock, open(TRACE_LOG, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+
+
+@contextmanager
+def trace(name):
+    """Start a request trace; spans recorded in this context (and threads started from it) attach to it"""
+    t = Trace(name)
+    token = _current.set(t)
+    status = "ok"
+    try:
+        yield t
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        t.finish(status)
+
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, start)
+
+
+def record(name, seconds, start=None):
+    t = _current.get()
+    if t is None:
+        registry.observe("rag_span_seconds", seconds, span=name)
+    else:
+        t.record(name, seconds, start)
+
+
+def annotate(**attributes):
+    """Attach attributes (token counts, cache hit flags, ...) to the current trace"""
+    t = _current.get()
+    if t is not None:
+        t.attributes.update(attributes)
@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import time
+import pytest
+from rag.admission import BULK, INTERACTIVE, Gate, Overloaded
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def hold(gate, release, priority=INTERACTIVE, admitted=None, name=None):
+    async with gate.admit(priority):
+        if admitted is not None:
+            admitted.append(name)
+        await release.wait()
+
+
+def test_interactive_calls_are_admitted_before_bulk():
+    async def main():
+        gate = Gate("test", 1, 10, {INTERACTIVE: 5, BULK: 5})
+        release, admitted = asyncio.Event(), []
+        holder = asyncio.create_task(hold(gate, release))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(hold(gate, release, priority, admitted, name))
+                 for name, priority in [("bulk-1", BULK), ("bulk-2", BULK), ("chat-1", INTERACTIVE), ("chat-2", INTERACTIVE)]]
+        await asyncio.sleep(0.01)
+        assert len(gate.waiters) == 4
+        release.set()
+        await asyncio.gather(holder, *tasks)
+        assert admitted == ["chat-1", "chat-2", "bulk-1", "bulk-2"]
+        assert gate.active == 0 and not gate.waiters
+    run(main())
+
+
+def test_full_queue_rejects_with_429():
+    async def main():
+        gate = Gate("test", 1, 1, {INTERACTIVE: 5, BULK: 5})
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(gate, release)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        with pytest.raises(Overloaded) as shed:
+            await hold(gate, release)
+        assert (shed.value.status, shed.value.reason) == (429, "queue_full")
+        assert 1 <= shed.value.retry_after <= 60
+        with pytest.raises(Overloaded):
+            gate.check(BULK)
+        release.set()
+        await asyncio.gather(*tasks)
+        gate.check(BULK)
+    run(main())
+
+
+def test_interactive_call_displaces_queued_bulk_call():
+    async def main():
+        gate = Gate("test", 1, 1, {INTERACTIVE: 5, BULK: 5})
+        release, admitted = asyncio.Event(), []
+        holder = asyncio.create_task(hold(gate, release))
+        await asyncio.sleep(0)
+        bulk = asyncio.create_task(hold(gate, release, BULK, admitted, "bulk"))
+        await asyncio.sleep(0.01)
+        chat = asyncio.create_task(hold(gate, release, INTERACTIVE, admitted, "chat"))
+        await asyncio.sleep(0.01)
+        with pytest.raises(Overloaded) as shed:
+            await bulk
+        assert (shed.value.status, shed.value.reason) == (429, "displaced")
+        release.set()
+        await asyncio.gather(holder, chat)
+        assert admitted == ["chat"]
+    run(main())
+
+
+def test_waiting_too_long_is_shed_with_503():
+    async def main():
+        gate = Gate("test", 1, 10, {INTERACTIVE: 0.05, BULK: 0.05})
+        gate.service_time = 30.0
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(gate, release))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold(gate, release))
+        await asyncio.sleep(0.01)
+        # Retry-After estimates how long the queue takes to drain at the current call duration
+        assert gate.retry_after() == 60
+        gate.service_time = 2.0
+        assert gate.retry_after() == 4
+        with pytest.raises(Overloaded) as shed:
+            await waiter
+        assert (shed.value.status, shed.value.reason) == (503, "queue_timeout")
+        assert shed.value.retry_after == 2
+        assert not gate.waiters and gate.active == 1
+        release.set()
+        await holder
+        assert gate.active == 0
+    run(main())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        gate = Gate("test", 1, 10, {INTERACTIVE: 5, BULK: 5})
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(gate, release))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold(gate, release))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert not gate.waiters
+        release.set()
+        await holder
+        assert gate.active == 0
+    run(main())
+
+
+def test_slot_is_held_until_the_thread_returns():
+    async def main():
+        gate = Gate("test", 1, 10, {INTERACTIVE: 5, BULK: 5})
+        finished = threading.Event()
+
+        def work(seconds):
+            time.sleep(seconds)
+            finished.set()
+            return "done"
+
+        async def call(func, *args):
+            async with gate.admit() as slot:
+                return await slot.run(func, *args)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(call(work, 0.3), 0.05)
+        # The caller gave up, but its thread still runs the upstream call
+        assert gate.active == 1 and not finished.is_set()
+        started = time.monotonic()
+        assert await call(work, 0) == "done"
+        assert time.monotonic() - started >= 0.2
+        assert gate.active == 0
+    run(main())
+
+
+def test_slot_is_released_when_an_abandoned_thread_raises():
+    async def main():
+        gate = Gate("test", 1, 10, {INTERACTIVE: 5, BULK: 5})
+
+        def fail():
+            time.sleep(0.1)
+            raise ValueError("upstream error")
+
+        async def call():
+            async with gate.admit() as slot:
+                return await slot.run(fail)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(call(), 0.01)
+        assert gate.active == 1
+        await asyncio.sleep(0.2)
+        assert gate.active == 0
+    run(main())
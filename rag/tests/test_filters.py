@@ -0,0 +1,62 @@
+import json
+import pytest
+import rag.db
+from rag.db import RagDatabase
+from rag.ingest import stream_ingest
+from rag.records import iter_records
+from rag.store import MappedDatabase, export_index
+from tests.test_ingest import HashEncoder
+
+SHARED = "Tenants may withhold rent only after notifying the landlord in writing about the defect. " * 2
+
+
+def write_crawl(path):
+    pages = [
+        ("https://www.udi.no/no/leie", "no", "Leieboere har rett til å få depositum tilbake etter at leieforholdet er avsluttet. " * 2),
+        ("https://www.skatteetaten.no/en/rent", "en", "Rental income from part of your own home is tax free in some cases, see the rules. " * 2),
+    ]
+    with open(path, "w", encoding="utf-8") as f:
+        for url, language, own in pages:
+            for heading, content in (("Own", own), ("Shared", SHARED)):
+                f.write(json.dumps({"url": url, "title": url, "heading": heading, "content": content,
+                                    "metadata": {"language": language}}) + "\n")
+
+
+@pytest.fixture(params=["memory", "stream"])
+def database(request, tmp_path, monkeypatch):
+    path = tmp_path / "crawl.jsonl"
+    write_crawl(path)
+    monkeypatch.setattr(rag.db, "SentenceTransformer", HashEncoder)
+    root = str(tmp_path / "index")
+    if request.param == "memory":
+        db = RagDatabase(model="test-model")
+        db.ingest_json(str(path))
+        db.encode()
+        export_index(db, root)
+        return db
+    stream_ingest(iter_records(str(path)), root, HashEncoder(), model="test-model")
+    return MappedDatabase(root, st=HashEncoder())
+
+
+def urls(results):
+    return sorted(doc.url for doc, _ in results)
+
+
+def test_duplicate_rows_need_one_document_matching_every_field(database):
+    query = "tenants withhold rent landlord defect"
+    # Norwegian through udi.no and skatteetaten.no through English: no document is both
+    crossed = {"language": "no", "domain": "skatteetaten.no"}
+    assert all(chunk.strip() != SHARED.strip() for _, chunk in database.query(query, 5, crossed))
+    assert all(chunk.strip() != SHARED.strip() for _, chunk in database.lexical_query(query, 5, crossed))
+    # The shared text is returned with the document that passes the filters
+    for results in (database.query(query, 5, {"language": "no", "domain": "udi.no"}),
+                    database.lexical_query(query, 5, {"language": "en", "domain": "skatteetaten.no"})):
+        shared = [doc for doc, chunk in results if chunk.strip() == SHARED.strip()]
+        assert len(shared) == 1
+    assert urls(database.lexical_query(query, 5, {"language": "en", "domain": "skatteetaten.no"})) == \
+        ["https://www.skatteetaten.no/en/rent"]
+
+
+def test_single_field_filters_match_any_document(database):
+    results = database.lexical_query("tenants withhold rent landlord defect", 5, {"language": "no"})
+    assert [doc.url for doc, chunk in results if chunk.strip() == SHARED.strip()] == ["https://www.udi.no/no/leie"]
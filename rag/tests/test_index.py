@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from rag.index import QuantizedIndex, _quantized_topk, quantize
+
+
+@pytest.fixture
+def embeddings():
+    vectors = np.random.default_rng(0).normal(size=(1000, 32)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def reference(codes, scales, query, k, rows):
+    scores = (codes[rows].astype(np.float32) @ query) * scales[rows]
+    order = np.argsort(-scores, kind="stable")[:k]
+    return scores[order], rows[order]
+
+
+@pytest.mark.parametrize("block", [1, 7, 64, 1000, 5000])
+@pytest.mark.parametrize("filtered", [False, True])
+def test_blocked_quantized_search_matches_full_scoring(embeddings, block, filtered):
+    codes, scales = quantize(embeddings)
+    query = embeddings[3]
+    rows = np.sort(np.random.default_rng(1).choice(len(codes), 300, replace=False)) if filtered else None
+    scores, found = _quantized_topk(codes, scales, query, 10, rows, block=block)
+    expected_scores, expected_rows = reference(codes, scales, query, 10, rows if filtered else np.arange(len(codes)))
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
+    np.testing.assert_array_equal(found, expected_rows)
+
+
+def test_quantized_index_search(embeddings):
+    index = QuantizedIndex(embeddings)
+    scores, rows = index.search(embeddings[42], k=5)
+    assert rows[0] == 42 and len(rows) == 5 and np.all(np.diff(scores) <= 0)
+    scores, rows = index.search(embeddings[42], k=5, rows=[1, 2, 42])
+    assert rows.tolist()[0] == 42 and sorted(rows.tolist()) == [1, 2, 42]
+    assert len(index.search(embeddings[42], k=5, rows=[])[1]) == 0
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pytest
+import rag.db
+from rag.db import RagDatabase
+from rag.ingest import stream_ingest
+from rag.records import iter_records
+from rag.store import CURRENT, export_index
+
+WORDS = ("apply permit residence work visa tax card bank police office deadline within days "
+         "must submit passport form deposit lease landlord rent").split()
+FOOTER = "Contact the office for more information about permits, visas and appointments. " * 2
+
+
+class HashEncoder:
+    """Deterministic embeddings from the words of each text"""
+    def __init__(self, model=None):
+        self.model = model
+
+    def encode(self, texts, normalize_embeddings=True, **kwargs):
+        single = isinstance(texts, str)
+        vectors = np.zeros((1 if single else len(texts), 32), dtype=np.float32)
+        for i, text in enumerate([texts] if single else texts):
+            for word in text.lower().split():
+                vectors[i, int(hashlib.md5(word.encode()).hexdigest(), 16) % 32] += 1
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-6)
+        return vectors[0] if single else vectors
+
+
+def write_crawl(path, pages=60):
+    domains = ["udi.no", "skatteetaten.no", "politiet.no"]
+    with open(path, "w", encoding="utf-8") as f:
+        for p in range(pages):
+            language = ["en", "no"][p % 2]
+            url = f"https://www.{domains[p % 3]}/{language}/page-{p}"
+            sections = [" ".join(WORDS[(p * 7 + s * 3 + i) % len(WORDS)] for i in range(40)) + f" (page {p})"
+                        for s in range(2)]
+            # Repeated on every page, and a text shared by pairs of pages
+            sections += [FOOTER, f"Shared notice {p // 2}: " + " ".join(WORDS[(p // 2 + i) % len(WORDS)] for i in range(30))]
+            for s, content in enumerate(sections):
+                f.write(json.dumps({"url": url, "title": f"Page {p}", "heading": f"Section {s}", "content": content,
+                                    "metadata": {"language": language, "type": "guide"}}) + "\n")
+
+
+def version_dir(root):
+    return os.path.realpath(os.path.join(root, CURRENT))
+
+
+@pytest.fixture
+def crawl(tmp_path):
+    path = tmp_path / "crawl.jsonl"
+    write_crawl(path)
+    return str(path)
+
+
+@pytest.mark.parametrize("mode", ["exact", "quantized", "ann"])
+def test_stream_ingest_matches_in_memory_index(crawl, tmp_path, monkeypatch, mode):
+    monkeypatch.setattr(rag.db, "SentenceTransformer", HashEncoder)
+    db = RagDatabase(model="test-model", index_mode=mode)
+    db.ingest_json(crawl)
+    db.encode()
+    export_index(db, str(tmp_path / "memory"))
+    stream_ingest(iter_records(crawl), str(tmp_path / "stream"), HashEncoder(), model="test-model", mode=mode,
+                  batch_size=7)
+
+    memory, stream = version_dir(tmp_path / "memory"), version_dir(tmp_path / "stream")
+    assert sorted(os.listdir(memory)) == sorted(os.listdir(stream))
+    for name in os.listdir(memory):
+        if name.endswith(".npy"):
+            expected, actual = np.load(os.path.join(memory, name)), np.load(os.path.join(stream, name))
+            assert expected.dtype == actual.dtype, name
+            np.testing.assert_array_equal(expected, actual, err_msg=name)
+        elif name == "meta.json":
+            with open(os.path.join(memory, name)) as f:
+                expected = json.load(f)
+            with open(os.path.join(stream, name)) as f:
+                actual = json.load(f)
+            for key in ("version", "built_at"):
+                expected.pop(key)
+                actual.pop(key)
+            assert expected == actual
+        else:
+            with open(os.path.join(memory, name), "rb") as f, open(os.path.join(stream, name), "rb") as g:
+                assert f.read() == g.read(), name
+
+
+def test_stream_ingest_collapses_duplicates(crawl, tmp_path):
+    stream_ingest(iter_records(crawl), str(tmp_path), HashEncoder(), model="test-model", batch_size=16)
+    path = version_dir(tmp_path)
+    offsets = np.load(os.path.join(path, "chunk_offsets.npy"))
+    postings = np.load(os.path.join(path, "chunk_postings.npy"))
+    text = open(os.path.join(path, "chunks.bin"), "rb").read()
+    texts = [text[offsets[row]:offsets[row + 1]].decode("utf-8") for row in range(len(offsets) - 1)]
+    assert len(texts) == len(set(texts))
+    # 60 pages of two own sections, one footer and 30 notices shared by pairs of pages
+    assert len(texts) == 60 * 2 + 1 + 30
+    footer = texts.index(FOOTER.strip())
+    assert postings[footer + 1] - postings[footer] == 60
+    assert postings[-1] == 60 * 4
@@ -0,0 +1,47 @@
+import time
+from rag.live import LiveSegment
+from tests.test_ingest import HashEncoder
+
+TEXT = "Apply for a residence permit online before your current permit expires, and bring your passport. "
+
+
+def page(url, content=TEXT * 2):
+    return {"url": url, "title": url, "metadata": {"language": "en"}, "sections": [("Permits", content)]}
+
+
+def test_pages_without_chunks_do_not_shadow_the_main_index():
+    live = LiveSegment(HashEncoder())
+    assert live.add_pages([page("https://www.udi.no/a"), page("https://www.udi.no/short", "Too short")]) == 1
+    assert "https://www.udi.no/a" in live
+    assert "https://www.udi.no/short" not in live
+
+
+def test_only_pages_ingested_before_a_version_are_dropped():
+    live = LiveSegment(HashEncoder())
+    live.add_pages([page("https://www.udi.no/old")])
+    built_at = time.time()
+    time.sleep(0.01)
+    live.add_pages([page("https://www.udi.no/new")])
+    urls = {"https://www.udi.no/old", "https://www.udi.no/new"}
+    assert live.drop_urls(urls, before=built_at) == 1
+    assert "https://www.udi.no/old" not in live
+    assert "https://www.udi.no/new" in live
+    # Re-ingesting after the build keeps the page live
+    live.add_pages([page("https://www.udi.no/new", TEXT * 3)])
+    assert live.drop_urls(urls, before=built_at) == 0
+    assert live.drop_urls(urls) == 1
+    assert not len(live)
+
+
+def test_ingest_times_survive_compaction():
+    live = LiveSegment(HashEncoder(), compact_after=1)
+    live.add_pages([page("https://www.udi.no/kept"), page("https://www.udi.no/old")])
+    built_at = time.time()
+    time.sleep(0.01)
+    # Replacing a page until dead chunks outnumber live ones compacts them away
+    for repeat in range(3, 5):
+        live.add_pages([page("https://www.udi.no/old", TEXT * repeat)])
+    assert live.dead == 0 and len(live.rows) == len(live) == 2
+    assert live.drop_urls({"https://www.udi.no/kept", "https://www.udi.no/old"}, before=built_at) == 1
+    results = live.search(HashEncoder().encode("query: residence permit"), k=5)
+    assert [doc.url for doc, _ in results] == ["https://www.udi.no/old"]
@@ -0,0 +1,45 @@
+import json
+import os
+import threading
+import time
+from rag.shards import build_shards, shard_root
+from rag.store import MappedDatabase
+from tests.test_ingest import HashEncoder, write_crawl
+
+
+class SingleThreadedEncoder(HashEncoder):
+    """Fails when called from two threads at once, as a SentenceTransformer may"""
+    def __init__(self):
+        super().__init__()
+        self.active = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def encode(self, texts, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.calls += 1
+            overlapping = self.active > 1
+        try:
+            assert not overlapping, "encode called concurrently"
+            time.sleep(0.002)
+            return super().encode(texts, **kwargs)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+def test_build_shards_encodes_one_batch_at_a_time(tmp_path):
+    crawl = tmp_path / "crawl.jsonl"
+    write_crawl(crawl)
+    encoder = SingleThreadedEncoder()
+    root = str(tmp_path / "shards")
+    build_shards(str(crawl), root, 3, encoder, by="domain", model="test-model", batch_size=4)
+    with open(os.path.join(root, "shards.json")) as f:
+        assert json.load(f) == {"shards": 3, "by": "domain", "model": "test-model"}
+    urls = set()
+    for shard in range(3):
+        database = MappedDatabase(shard_root(root, shard), st=encoder)
+        assert len({url.split("/")[2] for url in database.table.urls}) == 1
+        urls.update(database.table.urls)
+    assert len(urls) == 60 and encoder.calls > 3